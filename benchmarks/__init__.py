@@ -0,0 +1,2 @@
+"""Benchmarks of FestIn crawls against local stand-ins of S3, web sites and
+DNS servers. Run them with 'python -m benchmarks'"""
@@ -0,0 +1,243 @@
+import sys
+import json
+import asyncio
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+from pathlib import Path
+from importlib import metadata
+
+from .crawl import crawl
+from .servers import SiteGraph, MockWebServer, StubDNSServer
+
+
+def festin_version() -> dict:
+    try:
+        version = metadata.version("festin")
+    except metadata.PackageNotFoundError:
+        # Running from the source tree
+        version_file = Path(__file__).parent.parent / "VERSION"
+        version = version_file.read_text().strip()
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"version": version, "commit": commit}
+
+
+async def crawl_level(domains: list,
+                      festin_args: list,
+                      mock_port: int,
+                      verbose: bool) -> dict:
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+
+    process = context.Process(
+        target=crawl,
+        args=(domains, festin_args, mock_port, verbose, sender)
+    )
+    process.start()
+    sender.close()
+
+    # The servers keep running in this loop while the crawl runs
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, process.join)
+
+    if receiver.poll():
+        return receiver.recv()
+
+    return {"error": f"crawl process exited with code {process.exitcode}"}
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    graph = SiteGraph(sites=args.sites,
+                      seeds=args.seeds,
+                      fanout=args.fanout,
+                      bucket_ratio=args.bucket_ratio,
+                      objects=args.objects,
+                      large_ratio=args.large_ratio,
+                      large_objects=args.large_objects,
+                      page_size=args.page_size,
+                      redirect_ratio=args.redirect_ratio,
+                      cname_ratio=args.cname_ratio,
+                      cname_depth=args.cname_depth,
+                      seed=args.seed)
+
+    web_server = MockWebServer(graph, latency=args.latency / 1000)
+    dns_server = StubDNSServer(graph, latency=args.latency / 1000)
+
+    await web_server.start()
+    await dns_server.start()
+
+    runs = []
+
+    try:
+        for concurrency in args.concurrency:
+            for repeat in range(args.repeat):
+                print(f"[*] Crawling with concurrency {concurrency} "
+                      f"({repeat + 1}/{args.repeat})",
+                      file=sys.stderr,
+                      flush=True)
+
+                web_server.requests = web_server.listings = 0
+                dns_server.queries = 0
+
+                festin_args = [
+                    "-c", str(concurrency),
+                    "-M", str(args.max_recursion),
+                    "--dns-resolver", f"127.0.0.1:{dns_server.port}",
+                    *args.festin_args
+                ]
+
+                measures = await crawl_level(graph.seed_domains(),
+                                             festin_args,
+                                             web_server.port,
+                                             args.verbose)
+
+                runs.append({
+                    "concurrency": concurrency,
+                    "repeat": repeat,
+                    **measures,
+                    "served_http_requests": web_server.requests,
+                    "served_listings": web_server.listings,
+                    "served_dns_queries": dns_server.queries
+                })
+    finally:
+        await web_server.stop()
+        await dns_server.stop()
+
+    return {
+        "festin": festin_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenario": {
+            **graph.describe(),
+            "latency_ms": args.latency,
+            "max_recursion": args.max_recursion,
+            "festin_args": args.festin_args
+        },
+        "runs": runs
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark FestIn crawls against local mock S3, web and "
+                    "DNS servers. Options after '--' are passed to FestIn"
+    )
+
+    parser.add_argument("-c", "--concurrency",
+                        type=lambda v: [int(c) for c in v.split(",")],
+                        default=[10, 50, 200],
+                        help="comma separated concurrency levels. "
+                             "Default: 10,50,200")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=1,
+                        help="crawls for each concurrency level. Default: 1")
+    parser.add_argument("-o", "--output",
+                        default=None,
+                        help="write the JSON report to this file instead "
+                             "of the standard output")
+    parser.add_argument("--verbose",
+                        action="store_true",
+                        default=False,
+                        help="show the output of FestIn")
+
+    group_scenario = parser.add_argument_group("Scenario")
+    group_scenario.add_argument("--sites",
+                                type=int,
+                                default=2000,
+                                help="web sites. Default: 2000")
+    group_scenario.add_argument("--seeds",
+                                type=int,
+                                default=20,
+                                help="sites given to FestIn. Default: 20")
+    group_scenario.add_argument("--fanout",
+                                type=int,
+                                default=5,
+                                help="links to other sites in each page. "
+                                     "Default: 5")
+    group_scenario.add_argument("-M", "--max-recursion",
+                                type=int,
+                                default=5,
+                                help="max recursion level of FestIn. "
+                                     "Default: 5")
+    group_scenario.add_argument("--bucket-ratio",
+                                type=float,
+                                default=0.1,
+                                help="share of sites that are also buckets. "
+                                     "Default: 0.1")
+    group_scenario.add_argument("--objects",
+                                type=int,
+                                default=50,
+                                help="objects of the buckets. Default: 50")
+    group_scenario.add_argument("--large-ratio",
+                                type=float,
+                                default=0.1,
+                                help="share of large buckets. Default: 0.1")
+    group_scenario.add_argument("--large-objects",
+                                type=int,
+                                default=5000,
+                                help="objects of the large buckets. "
+                                     "Default: 5000")
+    group_scenario.add_argument("--page-size",
+                                type=int,
+                                default=1000,
+                                help="objects in each page of the bucket "
+                                     "listings. Default: 1000")
+    group_scenario.add_argument("--redirect-ratio",
+                                type=float,
+                                default=0.05,
+                                help="share of buckets redirected to their "
+                                     "regional endpoint. Default: 0.05")
+    group_scenario.add_argument("--cname-ratio",
+                                type=float,
+                                default=0.2,
+                                help="share of sites that are aliases. "
+                                     "Default: 0.2")
+    group_scenario.add_argument("--cname-depth",
+                                type=int,
+                                default=2,
+                                help="CNAMEs in the chain of each alias. "
+                                     "Default: 2")
+    group_scenario.add_argument("--latency",
+                                type=float,
+                                default=10,
+                                help="milliseconds that the servers wait "
+                                     "before answering. Default: 10")
+    group_scenario.add_argument("--seed",
+                                type=int,
+                                default=1,
+                                help="seed of the generated scenario. "
+                                     "Default: 1")
+
+    parser.add_argument("festin_args",
+                        nargs=argparse.REMAINDER,
+                        help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.festin_args[:1] == ["--"]:
+        args.festin_args = args.festin_args[1:]
+
+    report = json.dumps(asyncio.run(benchmark(args)), indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
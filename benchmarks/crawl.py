@@ -0,0 +1,178 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import asyncio
+import resource
+import tempfile
+
+from functools import partial
+
+from aiohttp import TCPConnector
+from aiohttp.abc import AbstractResolver
+
+import festin.session
+
+from festin.__main__ import build_parser, run
+
+
+class LocalResolver(AbstractResolver):
+    """Resolves every host to the mock web server"""
+
+    def __init__(self, port: int):
+        self.port = port
+
+    async def resolve(self, host: str, port: int = 0,
+                      family: int = socket.AF_INET) -> list:
+        return [{
+            "hostname": host,
+            "host": "127.0.0.1",
+            "port": self.port,
+            "family": socket.AF_INET,
+            "proto": 0,
+            "flags": socket.AI_NUMERICHOST
+        }]
+
+    async def close(self):
+        pass
+
+
+class LocalConnector(TCPConnector):
+    """Connector that sends every request, also the HTTPS ones, in plain
+    HTTP to the mock web server"""
+
+    def __init__(self, *, mock_port: int, **kwargs):
+        super().__init__(resolver=LocalResolver(mock_port), **kwargs)
+
+    def _get_ssl_context(self, req):
+        return None
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from sleeps of 'interval'
+    seconds. High lag means that something blocks the loop"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - started - self.interval)
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {"mean_ms": 0, "p99_ms": 0, "max_ms": 0}
+
+        samples = sorted(self.samples)
+
+        return {
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+            "p99_ms": round(samples[int(len(samples) * 0.99)] * 1000, 3),
+            "max_ms": round(samples[-1] * 1000, 3)
+        }
+
+
+def peak_rss_mb() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Bytes in macOS, KB in the rest
+    if sys.platform == "darwin":
+        usage //= 1024
+
+    return round(usage / 1024, 1)
+
+
+def count_results(path: str) -> tuple:
+    """Buckets and objects of a results file"""
+    buckets = objects = 0
+
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+
+                # Large buckets take a line for each part
+                if not result["part"]:
+                    buckets += 1
+
+                objects += len(result["objects"])
+
+    return buckets, objects
+
+
+async def measure(cli_args, domains: list) -> dict:
+    monitor = LoopLagMonitor()
+    monitor_task = asyncio.create_task(monitor.run())
+
+    started = time.perf_counter()
+
+    try:
+        await run(cli_args, domains)
+    finally:
+        elapsed = time.perf_counter() - started
+        monitor_task.cancel()
+
+    metrics = cli_args.metrics
+
+    probe_errors = sum(
+        value for (_, outcome), value in metrics.probes.values.items()
+        if outcome not in ("ok", "found")
+    )
+
+    return {
+        "elapsed": round(elapsed, 3),
+        "domains_analyzed": int(metrics.domains.value("analyzed")),
+        "probes": int(metrics.probes.total()),
+        "probe_errors": int(probe_errors),
+        "http_requests": cli_args.http_stats.requests,
+        "http_received_bytes": cli_args.http_stats.received,
+        "dns_queries": cli_args.resolver.queries,
+        "loop_lag": monitor.summary()
+    }
+
+
+def crawl(domains: list, festin_args: list, mock_port: int,
+          verbose: bool, conn):
+    """Crawl the mock servers in this process and send the measures through
+    'conn'. Runs in its own process, so peak RSS is only of this crawl"""
+    if not verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+
+    festin.session.TCPConnector = partial(LocalConnector,
+                                          mock_port=mock_port)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results_path = os.path.join(directory, "results.json")
+
+        cli_args = build_parser().parse_args(
+            festin_args + ["-rr", results_path]
+        )
+
+        if cli_args.domain_regex:
+            cli_args.domain_regex = re.compile(cli_args.domain_regex)
+
+        try:
+            measures = asyncio.run(measure(cli_args, domains))
+            measures["buckets"], measures["objects"] = \
+                count_results(results_path)
+        except Exception as e:
+            conn.send({"error": f"{type(e).__name__}: {e}"})
+            return
+
+    elapsed = measures["elapsed"] or 1
+
+    measures["domains_per_second"] = round(
+        measures["domains_analyzed"] / elapsed, 2
+    )
+    measures["objects_per_second"] = round(measures["objects"] / elapsed, 2)
+    measures["peak_rss_mb"] = peak_rss_mb()
+
+    conn.send(measures)
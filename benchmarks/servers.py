@@ -0,0 +1,417 @@
+import random
+import struct
+import asyncio
+
+from typing import Dict, List, Tuple
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+# Zone of the generated sites. Names must not contain "s3", that FestIn
+# takes as another S3 provider
+ZONE = "bench.test"
+
+S3_HOST = "s3.amazonaws.com"
+S3_REDIRECT_REGION = "s3-eu-west-1.amazonaws.com"
+
+S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+# DNS
+HEADER = struct.Struct("!HHHHHH")
+FLAGS_RESPONSE = 0x8180  # QR, RD and RA
+FLAG_TC = 0x0200
+RCODE_NXDOMAIN = 3
+TYPE_A = 1
+TYPE_CNAME = 5
+CLASS_IN = 1
+TTL = 300
+
+
+class SiteGraph:
+    """Deterministic crawl scenario.
+
+    'sites' web sites named 'site<N>.bench.test', each one linking to
+    'fanout' other sites. Crawls start from the first 'seeds' sites. A share
+    of the sites are also buckets:
+
+    - 'bucket_ratio' of them are buckets with 'objects' objects.
+    - 'large_ratio' of the buckets have 'large_objects' objects, listed in
+      pages of 'page_size'.
+    - 'redirect_ratio' of the buckets answer with a redirection to their
+      regional endpoint, that is also a bucket.
+
+    'cname_ratio' of the sites are aliases, through a chain of
+    'cname_depth' CNAMEs. Everything is generated from 'seed'.
+    """
+
+    def __init__(self,
+                 sites: int = 2000,
+                 seeds: int = 20,
+                 fanout: int = 5,
+                 bucket_ratio: float = 0.1,
+                 objects: int = 50,
+                 large_ratio: float = 0.1,
+                 large_objects: int = 5000,
+                 page_size: int = 1000,
+                 redirect_ratio: float = 0.05,
+                 cname_ratio: float = 0.2,
+                 cname_depth: int = 2,
+                 seed: int = 1):
+        self.sites = sites
+        self.seed = seed
+        self.seeds = min(seeds, sites)
+        self.fanout = fanout
+        self.page_size = max(page_size, 1)
+
+        # Bucket name -> (number of objects, redirected)
+        self.buckets: Dict[str, Tuple[int, bool]] = {}
+
+        # Alias -> canonical name
+        self.cnames: Dict[str, str] = {}
+
+        for index in range(sites):
+            rng = random.Random(f"{seed}:{index}")
+            name = self.site(index)
+
+            if rng.random() < bucket_ratio:
+                if rng.random() < large_ratio:
+                    size = large_objects
+                else:
+                    size = objects
+
+                redirected = rng.random() < redirect_ratio
+                self.buckets[name] = (size, redirected)
+
+                if redirected:
+                    self.buckets[self.endpoint(name)] = (size, False)
+
+            if rng.random() < cname_ratio:
+                chain = [name] + [
+                    f"alias{index}-{hop}.{ZONE}"
+                    for hop in range(1, cname_depth + 1)
+                ]
+
+                for alias, target in zip(chain, chain[1:]):
+                    self.cnames[alias] = target
+
+    @staticmethod
+    def site(index: int) -> str:
+        return f"site{index}.{ZONE}"
+
+    @staticmethod
+    def endpoint(bucket: str) -> str:
+        return f"{bucket}.{S3_REDIRECT_REGION}"
+
+    def seed_domains(self) -> List[str]:
+        return [self.site(index) for index in range(self.seeds)]
+
+    def links(self, index: int) -> List[str]:
+        rng = random.Random(f"{self.seed}:links:{index}")
+
+        return [
+            f"http://{self.site(rng.randrange(self.sites))}/"
+            for _ in range(self.fanout)
+        ]
+
+    def site_index(self, host: str) -> int or None:
+        if not host.startswith("site") or not host.endswith(f".{ZONE}"):
+            return None
+
+        try:
+            index = int(host[4:-len(ZONE) - 1])
+        except ValueError:
+            return None
+
+        return index if index < self.sites else None
+
+    def describe(self) -> dict:
+        return {
+            "sites": self.sites,
+            "seeds": self.seeds,
+            "fanout": self.fanout,
+            "buckets": sum(1 for b in self.buckets
+                           if not b.endswith(S3_REDIRECT_REGION)),
+            "bucket_objects": sum(size for size, _ in self.buckets.values()),
+            "page_size": self.page_size,
+            "cnames": len(self.cnames),
+            "seed": self.seed
+        }
+
+
+def object_key(index: int) -> str:
+    return f"dir{index % 10}/file{index:07d}.txt"
+
+
+def render_listing(bucket: str, total: int, start: int, page_size: int,
+                   v2: bool) -> str:
+    end = min(start + page_size, total)
+    truncated = end < total
+
+    parts = [
+        f'<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<ListBucketResult xmlns="{S3_NAMESPACE}">'
+        f'<Name>{escape(bucket)}</Name>'
+        f'<MaxKeys>{page_size}</MaxKeys>'
+        f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>'
+    ]
+
+    if truncated:
+        if v2:
+            parts.append(f"<NextContinuationToken>{end}"
+                         f"</NextContinuationToken>")
+        else:
+            parts.append(f"<NextMarker>{object_key(end - 1)}</NextMarker>")
+
+    for index in range(start, end):
+        parts.append(
+            f"<Contents><Key>{object_key(index)}</Key>"
+            f"<LastModified>2020-01-01T00:00:00.000Z</LastModified>"
+            f'<ETag>"{index:032x}"</ETag>'
+            f"<Size>{index * 7 % 65536}</Size>"
+            f"<StorageClass>STANDARD</StorageClass></Contents>"
+        )
+
+    parts.append("</ListBucketResult>")
+
+    return "".join(parts)
+
+
+def render_error(code: str, **fields) -> str:
+    extra = "".join(f"<{k}>{escape(v)}</{k}>" for k, v in fields.items())
+
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n' \
+           f"<Error><Code>{code}</Code>{extra}</Error>"
+
+
+class MockWebServer:
+    """HTTP stand-in for the web sites and S3 of a 'SiteGraph'. Requests are
+    dispatched by their Host header, so every host can be served from the
+    same port. Responses are delayed 'latency' seconds"""
+
+    def __init__(self, graph: SiteGraph, latency: float = 0):
+        self.graph = graph
+        self.latency = latency
+
+        self.requests = 0
+        self.listings = 0
+
+        self._runner = None
+        self.port = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application()
+        app.router.add_route("GET", "/{path:.*}", self.handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        host = request.host.rsplit(":", 1)[0].lower()
+        path = request.path.strip("/")
+
+        if host == S3_HOST:
+            return self.bucket(path, request.query)
+        elif host.endswith(f".{S3_REDIRECT_REGION}"):
+            return self.bucket(host, request.query)
+        elif (index := self.graph.site_index(host)) is not None:
+            return self.page(index)
+        else:
+            return web.Response(status=404, text="Not Found")
+
+    def bucket(self, name: str, query) -> web.Response:
+        try:
+            total, redirected = self.graph.buckets[name]
+        except KeyError:
+            return web.Response(
+                status=404,
+                text=render_error("NoSuchBucket", BucketName=name),
+                content_type="application/xml"
+            )
+
+        if redirected:
+            return web.Response(
+                status=301,
+                text=render_error("PermanentRedirect",
+                                  Endpoint=self.graph.endpoint(name)),
+                content_type="application/xml"
+            )
+
+        v2 = query.get("list-type") == "2"
+
+        if v2 and "continuation-token" in query:
+            start = int(query["continuation-token"])
+        elif "marker" in query:
+            start = int(query["marker"].rsplit("file", 1)[1][:7]) + 1
+        else:
+            start = 0
+
+        self.listings += 1
+
+        return web.Response(
+            text=render_listing(name, total, start, self.graph.page_size, v2),
+            content_type="application/xml"
+        )
+
+    def page(self, index: int) -> web.Response:
+        links = "".join(
+            f'<li><a href="{link}">{link}</a></li>'
+            for link in self.graph.links(index)
+        )
+
+        return web.Response(
+            text=f"<html><head><title>Site {index}</title></head><body>"
+                 f"<ul>{links}</ul></body></html>",
+            content_type="text/html"
+        )
+
+
+def encode_name(name: str) -> bytes:
+    encoded = bytearray()
+
+    for label in name.rstrip(".").split("."):
+        encoded.append(len(label))
+        encoded.extend(label.encode("ascii"))
+
+    encoded.append(0)
+
+    return bytes(encoded)
+
+
+def decode_question(data: bytes) -> Tuple[int, str, int, int]:
+    """Query id, name, type and the offset after the question"""
+    qid = HEADER.unpack_from(data)[0]
+    offset = HEADER.size
+    labels = []
+
+    while data[offset]:
+        length = data[offset]
+        labels.append(data[offset + 1:offset + 1 + length].decode("ascii"))
+        offset += length + 1
+
+    qtype = struct.unpack_from("!H", data, offset + 1)[0]
+
+    return qid, ".".join(labels).lower(), qtype, offset + 5
+
+
+class StubDNSServer(asyncio.DatagramProtocol):
+    """Recursive DNS stand-in for a 'SiteGraph'. Answers the CNAMEs of the
+    aliases, A records (127.0.0.1) for the names of the zone and NXDOMAIN
+    for the rest, over UDP and TCP on the same port. Answers are delayed
+    'latency' seconds. With 'truncate' UDP answers are truncated, so they
+    must be repeated over TCP"""
+
+    def __init__(self,
+                 graph: SiteGraph,
+                 latency: float = 0,
+                 truncate: bool = False):
+        self.graph = graph
+        self.latency = latency
+        self.truncate = truncate
+
+        self.queries = 0
+        self.tcp_queries = 0
+
+        self.transport = None
+        self.port = None
+
+        self._tcp_server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        loop = asyncio.get_running_loop()
+
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(host, port)
+        )
+        self.port = self.transport.get_extra_info("sockname")[1]
+
+        self._tcp_server = await asyncio.start_server(self._handle_tcp,
+                                                      host,
+                                                      self.port)
+
+    async def stop(self):
+        if self.transport:
+            self.transport.close()
+
+        if self._tcp_server:
+            self._tcp_server.close()
+            await self._tcp_server.wait_closed()
+
+    def datagram_received(self, data: bytes, addr):
+        self.queries += 1
+
+        try:
+            response = self.answer(data, truncated=self.truncate)
+        except (IndexError, struct.error, UnicodeDecodeError):
+            return
+
+        self.send(response, addr)
+
+    def send(self, response: bytes, addr):
+        if self.latency:
+            asyncio.get_running_loop().call_later(
+                self.latency, self.transport.sendto, response, addr
+            )
+        else:
+            self.transport.sendto(response, addr)
+
+    async def _handle_tcp(self, reader, writer):
+        try:
+            while True:
+                length, = struct.unpack("!H", await reader.readexactly(2))
+                data = await reader.readexactly(length)
+
+                self.tcp_queries += 1
+                response = self.answer(data)
+
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError,
+                IndexError, struct.error, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    def answer(self, data: bytes, truncated: bool = False) -> bytes:
+        qid, name, qtype, end = decode_question(data)
+        question = data[HEADER.size:end]
+
+        if truncated:
+            return HEADER.pack(qid, FLAGS_RESPONSE | FLAG_TC,
+                               1, 0, 0, 0) + question
+
+        # Names of the zone and the redirected buckets
+        exists = name.endswith(f".{ZONE}") or name in self.graph.buckets
+
+        if not exists:
+            return HEADER.pack(qid, FLAGS_RESPONSE | RCODE_NXDOMAIN,
+                               1, 0, 0, 0) + question
+
+        records = []
+
+        if qtype == TYPE_CNAME and name in self.graph.cnames:
+            target = encode_name(self.graph.cnames[name])
+            records.append(struct.pack("!HHHIH", 0xC00C, TYPE_CNAME,
+                                       CLASS_IN, TTL, len(target)) + target)
+        elif qtype == TYPE_A and name not in self.graph.cnames:
+            records.append(struct.pack("!HHHIH", 0xC00C, TYPE_A, CLASS_IN,
+                                       TTL, 4) + bytes((127, 0, 0, 1)))
+
+        return HEADER.pack(qid, FLAGS_RESPONSE, 1, len(records), 0, 0) + \
+            question + b"".join(records)
+
+
+__all__ = ("SiteGraph", "MockWebServer", "StubDNSServer", "ZONE", "S3_HOST")
@@ -0,0 +1,84 @@
+import os
+import uuid
+import asyncio
+
+import pytest
+import aioredis
+
+from festin.cluster import CrawlCluster
+
+# Redis server (5.0 or above) used by the tests. Its keys are deleted
+REDIS_SERVER = os.environ.get("FESTIN_TEST_REDIS", "redis://127.0.0.1:6379")
+
+
+async def connect() -> CrawlCluster:
+    cluster = CrawlCluster(REDIS_SERVER,
+                           name=f"festin-test-{uuid.uuid4().hex}",
+                           node="node1")
+
+    try:
+        await cluster.connect()
+    except (OSError, aioredis.RedisError) as e:
+        pytest.skip(f"no Redis server at {REDIS_SERVER}: {e}")
+
+    return cluster
+
+
+async def disconnect(cluster: CrawlCluster):
+    await cluster.redis.delete(cluster.frontier_key,
+                               cluster.visited_key,
+                               cluster.results_key)
+    await cluster.close()
+
+
+def run_cluster(test):
+    async def run():
+        cluster = await connect()
+
+        try:
+            return await test(cluster)
+        finally:
+            await disconnect(cluster)
+
+    return asyncio.run(run())
+
+
+def test_domains_are_queued_once():
+    async def test(cluster):
+        added = [await cluster.add_domain(domain, 3)
+                 for domain in ("a.test", "b.test", "a.test")]
+
+        # Also from another level
+        added.append(await cluster.add_domain("b.test", 2))
+
+        return added, await cluster.redis.xlen(cluster.frontier_key)
+
+    added, queued = run_cluster(test)
+
+    assert added == [True, True, False, False]
+    assert queued == 2
+
+
+def test_finished_domains_are_deleted_from_the_frontier():
+    async def test(cluster):
+        for domain in ("a.test", "b.test"):
+            await cluster.add_domain(domain, 1)
+
+        entries = await cluster.read(10)
+        read = [fields[b"domain"] for _, fields in entries]
+
+        await cluster.ack(entries[0][0])
+        pending = await cluster.redis.xlen(cluster.frontier_key)
+        finished = await cluster.is_finished()
+
+        await cluster.ack(entries[1][0])
+
+        return (read, pending, finished,
+                await cluster.redis.xlen(cluster.frontier_key),
+                await cluster.is_finished())
+
+    read, pending, finished, left, all_finished = run_cluster(test)
+
+    assert read == [b"a.test", b"b.test"]
+    assert (pending, finished) == (1, False)
+    assert (left, all_finished) == (0, True)
@@ -0,0 +1,192 @@
+import struct
+import asyncio
+
+from festin.resolver import CachingResolver
+from festin.dnsengine import DNSEngine, RCODE_NOERROR
+
+from .servers import SiteGraph, StubDNSServer, HEADER, FLAGS_RESPONSE, \
+    RCODE_NXDOMAIN, TYPE_CNAME
+
+# 'site0.bench.test' is an alias of 'alias0-1.bench.test'
+GRAPH = SiteGraph(sites=1, seeds=1, bucket_ratio=0, cname_ratio=1,
+                  cname_depth=1)
+
+ALIAS = "site0.bench.test"
+TARGET = "alias0-1.bench.test"
+
+
+class SpoofingServer(StubDNSServer):
+    """Sends NXDOMAIN answers with a wrong ID and with a wrong question
+    before the real answer"""
+
+    def datagram_received(self, data: bytes, addr):
+        self.queries += 1
+
+        qid = struct.unpack_from("!H", data)[0]
+        question = data[HEADER.size:]
+        other = question.replace(b"site0", b"site9")
+
+        for spoofed_id, spoofed_question in ((qid ^ 0xFFFF, question),
+                                             (qid, other)):
+            self.transport.sendto(
+                HEADER.pack(spoofed_id, FLAGS_RESPONSE | RCODE_NXDOMAIN,
+                            1, 0, 0, 0) + spoofed_question,
+                addr
+            )
+
+        self.transport.sendto(self.answer(data), addr)
+
+
+class DroppingServer(StubDNSServer):
+    """Doesn't answer the first 'drops' queries"""
+
+    def __init__(self, *args, drops: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drops = drops
+
+    def datagram_received(self, data: bytes, addr):
+        if self.drops:
+            self.drops -= 1
+            self.queries += 1
+            return
+
+        super().datagram_received(data, addr)
+
+
+async def resolve(server: StubDNSServer, **engine_options):
+    await server.start()
+
+    engine = DNSEngine(nameservers=[f"127.0.0.1:{server.port}"],
+                       **engine_options)
+
+    try:
+        return await engine.query(ALIAS, TYPE_CNAME), engine
+    finally:
+        engine.close()
+        await server.stop()
+
+
+def assert_alias(message):
+    assert message.rcode == RCODE_NOERROR
+    assert [(a.qtype, a.data) for a in message.an] == [(TYPE_CNAME, TARGET)]
+
+
+def test_answers_with_other_id_or_question_are_ignored():
+    server = SpoofingServer(GRAPH)
+    message, engine = asyncio.run(resolve(server, timeout=1))
+
+    assert_alias(message)
+    assert server.queries == 1
+    assert engine.servers[0].timeouts == 0
+
+
+def test_unanswered_query_is_retried():
+    server = DroppingServer(GRAPH, drops=2)
+    message, engine = asyncio.run(resolve(server, timeout=0.2, retries=2))
+
+    assert_alias(message)
+    assert server.queries == 3
+    assert engine.servers[0].timeouts == 2
+
+
+def test_truncated_answer_is_repeated_over_tcp():
+    server = StubDNSServer(GRAPH, truncate=True)
+    message, engine = asyncio.run(resolve(server, timeout=1))
+
+    assert_alias(message)
+    assert server.queries == 1
+    assert server.tcp_queries == 1
+    assert engine.servers[0].truncated == 1
+
+
+def test_prefetch_queries_each_name_once():
+    server = StubDNSServer(GRAPH, latency=0.05)
+
+    async def prefetch():
+        await server.start()
+
+        resolver = CachingResolver(
+            engine=DNSEngine(nameservers=[f"127.0.0.1:{server.port}"]),
+            prefetch_workers=4
+        )
+
+        try:
+            for _ in range(100):
+                resolver.prefetch(ALIAS, TYPE_CNAME)
+
+            await asyncio.sleep(0.2)
+
+            answers = await resolver.query(ALIAS, TYPE_CNAME)
+        finally:
+            resolver.close()
+            await server.stop()
+
+        return resolver, answers
+
+    resolver, answers = asyncio.run(prefetch())
+
+    assert [a.data for a in answers] == [TARGET]
+    assert server.queries == 1
+    assert resolver.prefetched == 1
+    assert resolver.hits == 1
+
+
+def test_least_recently_used_names_are_evicted():
+    graph = SiteGraph(sites=3, seeds=3, bucket_ratio=0, cname_ratio=1,
+                      cname_depth=1)
+    server = StubDNSServer(graph)
+    names = [f"site{i}.bench.test" for i in range(3)]
+
+    async def resolve_all():
+        await server.start()
+
+        resolver = CachingResolver(
+            engine=DNSEngine(nameservers=[f"127.0.0.1:{server.port}"]),
+            max_entries=2
+        )
+
+        try:
+            # 'site0' is used again before 'site2' is cached
+            for name in (names[0], names[1], names[0], names[2],
+                         names[0], names[1]):
+                await resolver.query(name, TYPE_CNAME)
+        finally:
+            resolver.close()
+            await server.stop()
+
+        return resolver
+
+    resolver = asyncio.run(resolve_all())
+
+    assert server.queries == 4
+    assert resolver.hits == 2
+    assert resolver.evicted == 2
+
+
+def test_default_resolver_cache_is_bounded():
+    graph = SiteGraph(sites=50, seeds=50, bucket_ratio=0, cname_ratio=1,
+                      cname_depth=1)
+    server = StubDNSServer(graph)
+
+    async def resolve_all():
+        await server.start()
+
+        resolver = CachingResolver(
+            nameservers=[f"127.0.0.1:{server.port}"],
+            max_entries=10
+        )
+
+        try:
+            for i in range(50):
+                await resolver.query(f"site{i}.bench.test", TYPE_CNAME)
+        finally:
+            resolver.close()
+            await server.stop()
+
+        return resolver
+
+    resolver = asyncio.run(resolve_all())
+
+    assert server.queries == 50
+    assert len(resolver._cache) == 10
+    assert not list(resolver.resolver.cache.iter_values())
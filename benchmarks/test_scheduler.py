@@ -0,0 +1,59 @@
+import asyncio
+
+from festin.scheduler import HostScheduler, SWEEP_BUCKETS
+
+
+async def request_hosts(scheduler: HostScheduler, hosts: int):
+    for i in range(hosts):
+        async with scheduler.slot(f"host{i}.test"):
+            pass
+
+
+def test_hosts_without_rate_have_no_bucket():
+    scheduler = HostScheduler(max_connections=10, max_per_host=2)
+
+    asyncio.run(request_hosts(scheduler, 5000))
+
+    assert not scheduler._buckets
+    assert not scheduler.hosts_in_flight
+
+
+def test_buckets_of_idle_hosts_are_dropped():
+    # A token each millisecond: buckets are full again right away
+    scheduler = HostScheduler(max_connections=10,
+                              max_per_host=2,
+                              host_rate=1000)
+
+    async def requests():
+        await request_hosts(scheduler, SWEEP_BUCKETS)
+        await asyncio.sleep(0.01)
+        await request_hosts(scheduler, 5000)
+
+    asyncio.run(requests())
+
+    assert len(scheduler._buckets) <= 2 * SWEEP_BUCKETS
+
+
+def test_rate_is_kept_while_the_host_waits():
+    scheduler = HostScheduler(max_connections=10,
+                              max_per_host=2,
+                              host_rate=10,
+                              host_burst=1)
+
+    async def requests():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        for _ in range(3):
+            async with scheduler.slot("host.test"):
+                pass
+
+        # The bucket is empty, so it isn't forgotten
+        scheduler._sweep_buckets()
+
+        return loop.time() - started
+
+    elapsed = asyncio.run(requests())
+
+    assert elapsed >= 0.15
+    assert "host.test" in scheduler._buckets
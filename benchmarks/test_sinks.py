@@ -0,0 +1,38 @@
+import asyncio
+
+from festin.sinks import ResultsWriter
+
+
+def test_records_are_written_as_they_end(tmp_path):
+    path = str(tmp_path / "results.json")
+    flushed = []
+
+    async def write():
+        writer = ResultsWriter(path, on_flushed=flushed.extend)
+
+        await writer.write(('{"a": ', '1}'), ack=1)
+
+        # Still running: the record is already in the file
+        with open(path) as f:
+            assert f.read() == '{"a": 1}\n'
+
+        assert flushed == [1]
+
+        await writer.close()
+
+    asyncio.run(write())
+
+
+def test_compressed_records_wait_for_a_frame(tmp_path):
+    path = str(tmp_path / "results.json")
+
+    async def write():
+        writer = ResultsWriter(path, compression="gzip", flush_interval=60)
+
+        await writer.write(('{"a": 1}',))
+        assert not (tmp_path / "results.json.gz").stat().st_size
+
+        await writer.close()
+        assert (tmp_path / "results.json.gz").stat().st_size
+
+    asyncio.run(write())
@@ -0,0 +1,116 @@
+import asyncio
+
+from festin.s3 import S3Bucket, S3Objects
+from festin.state import CrawlState, result_record
+from festin.shards import ShardPool, ShardedFrontierQueue, shard_of
+
+ORIGIN = ("site0.bench.test", 2)
+
+
+def found_bucket(part: int = 0) -> S3Bucket:
+    return S3Bucket(domain=ORIGIN[0],
+                    bucket_name="http://site0.bench.test",
+                    objects=S3Objects(["a", "b"]),
+                    part=part,
+                    origin=ORIGIN)
+
+
+def analyze(state: CrawlState, *buckets: S3Bucket):
+    """Queue the origin, find the buckets and finish its analysis"""
+    state.add_frontier(*ORIGIN)
+
+    for bucket in buckets:
+        state.hold_result(bucket.origin)
+        assert state.claim_result(bucket)
+
+    state.frontier_done(*ORIGIN, visited=True)
+
+
+def saved(path: str):
+    state = CrawlState(path)
+
+    try:
+        return (list(state.load_visited()),
+                state.pop_frontier(),
+                state.connection.execute(
+                    "SELECT COUNT(*) FROM result_parts"
+                ).fetchone()[0])
+    finally:
+        state.connection.close()
+
+
+def test_origin_stays_pending_until_its_results_are_written(tmp_path):
+    path = str(tmp_path / "crawl.state")
+    bucket = found_bucket()
+
+    state = CrawlState(path)
+    analyze(state, bucket)
+    state.commit()
+
+    # Crash before the results file writes the bucket
+    assert saved(path) == ([], [ORIGIN], 0)
+
+    state.add_results([result_record(bucket)])
+    state.commit()
+
+    assert saved(path) == ([ORIGIN[0]], [], 1)
+
+
+def test_origin_waits_for_every_part(tmp_path):
+    path = str(tmp_path / "crawl.state")
+    parts = [found_bucket(0), found_bucket(1)]
+
+    state = CrawlState(path)
+    analyze(state, *parts)
+
+    state.add_results([result_record(parts[0])])
+    state.commit()
+    assert saved(path) == ([], [ORIGIN], 1)
+
+    state.add_results([result_record(parts[1])])
+    state.commit()
+    assert saved(path) == ([ORIGIN[0]], [], 2)
+
+
+def test_repeated_results_are_released(tmp_path):
+    state = CrawlState(str(tmp_path / "crawl.state"))
+    bucket = found_bucket()
+
+    analyze(state, bucket)
+    state.add_results([result_record(bucket)])
+
+    # Found again by another analysis
+    state.hold_result(bucket.origin)
+
+    assert not state.claim_result(bucket)
+    asyncio.run(asyncio.wait_for(state.wait_results(), 1))
+
+
+def test_shard_stores_results_written_by_the_coordinator(tmp_path):
+    path = str(tmp_path / "crawl.state")
+    bucket = found_bucket()
+
+    pool = ShardPool(2)
+    state = CrawlState(path)
+    frontier = ShardedFrontierQueue(
+        shard=pool.contexts[shard_of(ORIGIN[0], pool.count)],
+        state=state
+    )
+
+    async def crawl():
+        receiving = asyncio.create_task(frontier.receive())
+
+        analyze(state, bucket)
+
+        # The coordinator writes the result sent by the shard
+        pool.send_flushed([result_record(bucket)])
+
+        await asyncio.wait_for(state.wait_results(), 1)
+
+        frontier.stop_receiving()
+        await receiving
+
+    asyncio.run(crawl())
+    state.commit()
+
+    assert saved(path) == ([ORIGIN[0]], [], 1)
@@ -1,6 +1,20 @@
 from .logo import *
 from .redis import *
+from .rules import *
 from .utils import *
+from .session import *
+from .state import *
+from .queues import *
+from .metrics import *
+from .bloom import *
+from .resolver import *
+from .dnsengine import *
 from .analysis import *
-from .s3 import S3Bucket, download_s3_objects
+from .s3 import S3Bucket, S3Object, S3Objects, download_s3_objects
+from .manifest import *
+from .downloads import *
+from .sinks import *
+from .tail import *
+from .shards import *
+from .cluster import *
 from .black_list import *
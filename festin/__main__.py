@@ -1,164 +1,212 @@
 import re
 import os
+import time
 import asyncio
 import argparse
 import platform
 
-from typing import Set, List
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Set
+from types import SimpleNamespace
 
-import aiofiles
 import pkg_resources
 
 from colorama import Fore, Style
 from watchgod import awatch
+from async_dns.core import types
 
 from festin import *
 from festin.events import *
+from festin.sinks import zstandard
 
 SK = f"{Fore.YELLOW}SKIP{Style.RESET_ALL}"
 SKR = f"{Fore.CYAN}SKIP-RECURSION{Style.RESET_ALL}"
+SKD = f"{Fore.YELLOW}SKIP-DNS{Style.RESET_ALL}"
 
 async def analyze(cli_args: argparse.Namespace,
                   domain: str,
                   recursion_level: int,
                   results_queue: asyncio.Queue,
                   sem: asyncio.Semaphore,
-                  input_domains_queue: asyncio.Queue):
+                  input_domains_queue: FrontierQueue):
 
     tasks = []
+
+    #
+    # Domains found by the probes are queued even if the frontier is full
+    #
+    IN_ANALYSIS.set(True)
+
     try:
+        probe_s3 = True
+        probe_links = not cli_args.no_links
+
         #
-        # Getting info from AWS
+        # Don't wait for HTTP timeouts of hosts that don't resolve. Bucket
+        # probes don't connect to the domain, so they're kept for valid
+        # bucket names
         #
-        t1 = asyncio.create_task(get_s3(
-            cli_args,
-            domain,
-            recursion_level,
-            input_domains_queue,
-            results_queue)
-        )
+        if cli_args.resolve_first:
+            stats = cli_args.resolve_stats
+            stats.checked += 1
 
-        tasks.append(t1)
+            if not await host_resolves(cli_args, domain):
+                stats.not_resolved += 1
 
-    except Exception as e:
-        print(e)
+                if not is_s3_bucket_name(domain):
+                    probe_s3 = False
+                    stats.probes_saved += 1
 
-    try:
-        #
-        # Get web links?
-        #
-        if not cli_args.no_links:
-            t2 = asyncio.create_task(get_links(
-                cli_args,
-                domain,
-                recursion_level,
-                input_domains_queue,
-                results_queue)
-            )
+                if probe_links:
+                    probe_links = False
+                    stats.probes_saved += 2
 
-            tasks.append(t2)
+                if cli_args.debug:
+                    print(f"[{SKD}] domain '{domain}' doesn't resolve. "
+                          f"Skipping HTTP probes")
 
-    except Exception as e:
-        print(e)
+        try:
+            #
+            # Getting info from AWS
+            #
+            if probe_s3:
+                t1 = asyncio.create_task(get_s3(
+                    cli_args,
+                    domain,
+                    recursion_level,
+                    input_domains_queue,
+                    results_queue)
+                )
 
-    try:
-        #
-        # Get cnames
-        #
-        # if cli_args.dns:
-        if not cli_args.no_dnsdiscover:
-            t3 = asyncio.create_task(get_dns_info(
-                cli_args,
-                domain,
-                recursion_level,
-                input_domains_queue)
-            )
+                tasks.append(t1)
+
+        except Exception as e:
+            print(e)
 
-            tasks.append(t3)
+        try:
+            #
+            # Get web links?
+            #
+            if probe_links:
+                t2 = asyncio.create_task(get_links(
+                    cli_args,
+                    domain,
+                    recursion_level,
+                    input_domains_queue,
+                    results_queue)
+                )
 
-    except Exception as e:
-        print(e)
+                tasks.append(t2)
+
+        except Exception as e:
+            print(e)
+
+        try:
+            #
+            # Get cnames
+            #
+            # if cli_args.dns:
+            if not cli_args.no_dnsdiscover:
+                t3 = asyncio.create_task(get_dns_info(
+                    cli_args,
+                    domain,
+                    recursion_level,
+                    input_domains_queue)
+                )
+
+                tasks.append(t3)
+
+        except Exception as e:
+            print(e)
 
-    try:
         await asyncio.gather(*tasks)
     finally:
         sem.release()
-        input_domains_queue.task_done()
+        input_domains_queue.done(domain, recursion_level, visited=True)
 
 
 async def analyze_domains(cli_args: argparse.Namespace,
-                          black_list: List[str],
-                          white_list: List[str],
+                          black_list: DomainRules,
+                          white_list: DomainRules,
                           processed_domains: Set[str],
                           results_queue: asyncio.Queue,
-                          input_queue_domains: asyncio.Queue,
-                          discovered_domains: asyncio.Queue,
-                          raw_discovered_domains: asyncio.Queue):
+                          input_queue_domains: FrontierQueue,
+                          discovered_domains: BoundedQueue,
+                          raw_discovered_domains: BoundedQueue):
 
     concurrency = cli_args.concurrency
     domain_regex = cli_args.domain_regex
+    metrics = cli_args.metrics
 
-    tasks = []
+    # Running analysis. Finished tasks remove themselves
+    tasks = set()
 
     sem = asyncio.Semaphore(value=concurrency)
 
-    while True:
+    async def consume_domains():
+
+        while True:
 
-        if cli_args.watch:
             domain, recursion_level = await input_queue_domains.get()
-        else:
-            try:
-                #
-                # When we execute one shot, we need a way to stop the loop ->
-                # a timeout each 5 seconds
-                #
-                domain, recursion_level = await asyncio.wait_for(
-                    input_queue_domains.get(),
-                    5
-                )
-            except asyncio.exceptions.TimeoutError:
-                if all(t.done() for t in tasks) \
-                        and input_queue_domains.empty():
-                    return
-                else:
-                    continue
 
-        if recursion_level < 0:
-            print(f"[{SKR}] Maximum recursion level reached. Omitting "
-                  f"'{domain}'")
-            continue
+            if recursion_level < 0:
+                print(f"[{SKR}] Maximum recursion level reached. Omitting "
+                      f"'{domain}'")
+                metrics.domains.inc("max_recursion")
+                input_queue_domains.done(domain, recursion_level)
+                continue
+
+            if hasattr(domain, "decode"):
+                domain = domain.decode("UTF-8")
 
-        if hasattr(domain, "decode"):
-            domain = domain.decode("UTF-8")
+            await raw_discovered_domains.put(domain)
 
-        await raw_discovered_domains.put(domain)
+            if message := valid_domain_or_link(domain):
+                print(message)
 
-        if message := valid_domain_or_link(domain):
-            print(message)
+            if not domain or domain in processed_domains:
+                print(f"[{SK}] domain '{domain}' already processed")
+                metrics.domains.inc("already_processed")
+                input_queue_domains.done(domain, recursion_level)
+                continue
 
-        if not domain or domain in processed_domains:
-            print(f"[{SK}] domain '{domain}' already processed")
-            continue
+            processed_domains.add(domain)
 
-        processed_domains.add(domain)
+            await discovered_domains.put(domain)
+
+            if domain_regex:
+                if not domain_regex.search(domain):
+                    metrics.domains.inc("filtered")
+                    input_queue_domains.done(domain,
+                                             recursion_level,
+                                             visited=True)
+                    continue
 
-        await discovered_domains.put(domain)
+            if black_list and domain in black_list:
+                metrics.domains.inc("filtered")
+                input_queue_domains.done(domain, recursion_level, visited=True)
+                continue
 
-        if domain_regex:
-            if not domain_regex.search(domain):
+            if white_list and domain not in white_list:
+                metrics.domains.inc("filtered")
+                input_queue_domains.done(domain, recursion_level, visited=True)
                 continue
 
-        if black_list and domain in black_list:
-            continue
+            metrics.domains.inc("analyzed")
 
-        if white_list and domain not in white_list:
-            continue
+            #
+            # Backpressure: no more domains are taken from the frontier
+            # until a running analysis finishes and gives its slot back
+            #
+            waiting_since = time.monotonic()
+            await sem.acquire()
+            metrics.slot_wait_seconds.observe(time.monotonic() - waiting_since)
 
-        #
-        # Launch the background task that analyzes the domain
-        #
-        tasks.append(
-            asyncio.create_task(analyze(
+            #
+            # Launch the background task that analyzes the domain
+            #
+            task = asyncio.create_task(analyze(
                 cli_args,
                 domain,
                 recursion_level,
@@ -166,50 +214,274 @@ async def analyze_domains(cli_args: argparse.Namespace,
                 sem,
                 input_queue_domains
             ))
-        )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    if cli_args.watch:
+        await consume_domains()
+        return
+
+    #
+    # When we execute one shot, the crawl finishes when every queued domain
+    # was analyzed or skipped
+    #
+    consumer = asyncio.create_task(consume_domains())
+    finished = asyncio.create_task(input_queue_domains.wait_finished())
+
+    try:
+        await asyncio.wait((consumer, finished),
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        consumer.cancel()
+        finished.cancel()
 
-        await sem.acquire()
+    for task in (consumer, finished):
+        if task.done() and not task.cancelled() and task.exception():
+            raise task.exception()
 
     await asyncio.gather(*tasks)
 
 
-async def run(cli_args: argparse.Namespace, init_domains: list):
+async def open_sinks(cli_args: argparse.Namespace,
+                     on_results_flushed=None) -> SimpleNamespace:
+    """Consumers of results and discovered domains: results and domains
+    files, printing and indexing. 'on_results_flushed' is called with the
+    records of the results written to the results file"""
+
+    #
+    # On results events
+    #
+    on_results_tasks = []
+    index_manifest = manifest_task = None
+
+    # The results file goes first, so results are persisted before they're
+    # handed to the rest of consumers
+    if not cli_args.result_file:
+        cli_args.result_file = "results.fetin"
+
+    cli_args.results_writer = ResultsWriter(
+        cli_args.result_file,
+        compression=cli_args.result_compression,
+        buffer_size=cli_args.result_buffer_size,
+        flush_interval=cli_args.result_flush_interval,
+        rotate_size=cli_args.result_rotate_size,
+        on_flushed=on_results_flushed
+    )
+    on_results_tasks.append(on_result_save_streaming_results)
+
+    if cli_args.index:
+        if cli_args.index_manifest:
+            index_manifest = ObjectManifest(cli_args.index_manifest)
+            manifest_task = asyncio.create_task(
+                index_manifest.checkpoint(cli_args.state_interval)
+            )
+
+        # One connection pool and index creation for the whole run. Objects
+        # are recorded in the manifest when their batch is stored
+        cli_args.redis_writer = RedisIndexWriter(
+            await redis_create_connection(cli_args.index_server),
+            batch_size=cli_args.index_batch_size,
+            flush_interval=cli_args.index_flush_interval,
+            on_indexed=index_manifest.update_many if index_manifest else None
+        )
+
+        # Objects of every bucket are downloaded by the same workers
+        cli_args.download_scheduler = DownloadScheduler(
+            cli_args,
+            cli_args.redis_writer.add,
+            workers=cli_args.index_workers,
+            rate=cli_args.index_rate,
+            bucket_share=cli_args.index_bucket_share,
+            max_pending=cli_args.queue_size,
+            manifest=index_manifest
+        )
+
+        on_results_tasks.append(on_results_add_to_redis)
+
+    if cli_args.cluster_server:
+        on_results_tasks.append(on_result_add_to_cluster)
+
+    if not cli_args.no_print or not cli_args.quiet:
+        on_results_tasks.append(on_result_print_results)
+
+    #
+    # On domain events
+    #
+    on_domain_filtered_tasks = []
+    on_domain_raw_domains_tasks = []
+
+    domain_writers = []
+
+    if cli_args.discovered_domains:
+        writer = DomainWriter(cli_args.discovered_domains,
+                              dedup=cli_args.domains_dedup)
+        domain_writers.append(writer)
+
+        on_domain_filtered_tasks.append((
+            on_domain_save_new_domains,
+            writer
+        ))
+    if cli_args.raw_discovered_domains:
+        writer = DomainWriter(cli_args.raw_discovered_domains,
+                              dedup=cli_args.domains_dedup)
+        domain_writers.append(writer)
+
+        on_domain_raw_domains_tasks.append((
+            on_domain_save_new_domains,
+            writer
+        ))
+
+    return SimpleNamespace(
+        on_results_tasks=on_results_tasks,
+        on_domain_filtered_tasks=on_domain_filtered_tasks,
+        on_domain_raw_domains_tasks=on_domain_raw_domains_tasks,
+        domain_writers=domain_writers,
+        index_manifest=index_manifest,
+        manifest_task=manifest_task
+    )
+
+
+async def join_sinks(cli_args: argparse.Namespace):
+    """Wait for the pending downloads of objects to index"""
+    if cli_args.index:
+        await cli_args.download_scheduler.join()
+
+
+async def close_sinks(cli_args: argparse.Namespace, sinks: SimpleNamespace):
+    quiet = cli_args.quiet
+
+    if not quiet:
+        for consumer in getattr(cli_args, "result_consumers", ()):
+            print(consumer.summary())
+
+    for writer in (cli_args.results_writer, *sinks.domain_writers):
+        await writer.close()
+
+        if not quiet:
+            print(writer.summary())
+
+    if cli_args.index:
+        cli_args.download_scheduler.close()
+
+        await cli_args.redis_writer.close()
+
+        if not quiet:
+            print(cli_args.download_scheduler.summary())
+            print(cli_args.redis_writer.summary())
+
+        if sinks.index_manifest:
+            sinks.manifest_task.cancel()
+            sinks.index_manifest.close()
+
+            if not quiet:
+                print(sinks.index_manifest.summary())
+
+
+async def start_metrics(cli_args: argparse.Namespace) -> SimpleNamespace:
+    """Metrics endpoint and periodic stats summary"""
+    metrics = cli_args.metrics
+    server = report_task = None
+
+    if cli_args.metrics_port:
+        server = await metrics.serve(cli_args.metrics_host,
+                                     cli_args.metrics_port)
+
+        if not cli_args.quiet:
+            print(f"[*] Metrics available at http://{cli_args.metrics_host}:"
+                  f"{cli_args.metrics_port}/metrics")
+
+    if cli_args.stats_interval:
+        report_task = asyncio.create_task(
+            metrics.report(cli_args.stats_interval)
+        )
+
+    return SimpleNamespace(server=server, report_task=report_task)
+
+
+async def stop_metrics(service: SimpleNamespace):
+    if service.report_task:
+        service.report_task.cancel()
+
+    if service.server:
+        service.server.close()
+        await service.server.wait_closed()
+
+
+async def run(cli_args: argparse.Namespace,
+              init_domains: list,
+              shard: ShardContext = None):
 
     async def watch_new_domains():
 
         print("[*] Watching for new domains")
-        async for _ in awatch(cli_args.file_domains):
-            async with aiofiles.open(cli_args.file_domains, mode='r') as f:
-                file_content = await f.read()
 
-                clean_content_file = set(file_content.splitlines())
+        # Only lines appended after the initial load are read
+        tail = FileTail(cli_args.file_domains,
+                        offset=cli_args.file_domains_offset)
+
+        try:
+            async for _ in awatch(cli_args.file_domains):
+                lines = await tail.read()
 
                 # Select only new domains
-                new_domains = clean_content_file.difference(domains_processed)
+                new_domains = {
+                    d for d in map(str.strip, lines)
+                    if d and d not in domains_processed
+                }
 
-                if not new_domains:
+                if lines and not new_domains:
                     print(f"[DOMAIN>>>>] Added new domain to "
                           f"'{cli_args.file_domains}' but there're already "
-                          f"in file. So skipping")
-                # Append new domains to processed domains and to the queue
-                # domains_processed.update(new_domains)
-                for d in new_domains:
-                    if not d:
-                        continue
+                          f"processed. So skipping")
 
+                for d in new_domains:
                     if not quiet:
                         print(f"[DOMAIN>>>>] Added for processing: '{d}'")
 
                     await input_domain_queue.put(
                         (d, cli_args.http_max_recursion)
                     )
+        finally:
+            tail.close()
+
+            if not quiet:
+                print(tail.summary())
+
+    async def populate_domains():
+        try:
+            for d in init_domains:
+                await input_domain_queue.put(
+                    (d, cli_args.http_max_recursion)
+                )
+
+            for d, recursion_level in resume_domains:
+                await input_domain_queue.put((d, recursion_level))
+        finally:
+            input_domain_queue.release()
 
     quiet = cli_args.quiet
-    domains_processed = set()
-    input_domain_queue = asyncio.Queue()
-    results_queue = asyncio.Queue()
-    filtered_discovered_domains = asyncio.Queue()
-    raw_discovered_domains = asyncio.Queue()
+
+    metrics = cli_args.metrics = Metrics()
+
+    if cli_args.visited_filter:
+        domains_processed = ScalableBloomFilter(
+            capacity=cli_args.visited_capacity,
+            error_rate=cli_args.visited_error_rate,
+            path=cli_args.visited_file
+        )
+    else:
+        domains_processed = set()
+
+    queue_size = cli_args.queue_size
+    queue_spill = cli_args.queue_spill
+
+    results_queue = BoundedQueue(queue_size, queue_spill, "results")
+    filtered_discovered_domains = BoundedQueue(queue_size,
+                                               queue_spill,
+                                               "discovered domains")
+    raw_discovered_domains = BoundedQueue(queue_size,
+                                          queue_spill,
+                                          "raw discovered domains")
     domain_black_list = cli_args.domain_black_list
     domain_white_list = cli_args.domain_white_list
 
@@ -218,76 +490,221 @@ async def run(cli_args: argparse.Namespace, init_domains: list):
     #
     if domain_white_list:
         with open(domain_white_list, "r") as f:
-            white_list = list(set(f.read().splitlines()))
+            white_list = DomainRules(f.read().splitlines())
     else:
-        white_list = []
+        white_list = DomainRules()
 
     if domain_black_list:
         with open(domain_black_list, "r") as f:
-            black_list = list(set(f.read().splitlines()))
+            black_list = DomainRules(f.read().splitlines())
     else:
-        black_list = []
+        black_list = DomainRules()
 
     #
-    # Check proxy connection
+    # Load crawl state
     #
-    if cli_args.tor:
-        if not await check_tor_connection(cli_args):
-            print('[!] Can\'t stablish connection to TOR')
-            exit(1)
+    crawl_state = None
+    resume_domains = []
+
+    if cli_args.state_file:
+        crawl_state = CrawlState(cli_args.state_file)
+
+        if cli_args.resume:
+            domains_processed.update(crawl_state.load_visited())
+            resume_domains = crawl_state.pop_frontier()
+
+            print(f"[*] Resuming crawl: {len(domains_processed)} domains "
+                  f"already analyzed, {len(resume_domains)} pending")
+        else:
+            crawl_state.clear()
+
+    cli_args.crawl_state = crawl_state
 
     #
-    # Populate initial domains
+    # Shared DNS resolver. With the DNS engine, CNAMEs of queued domains are
+    # resolved in background, before their analysis starts
     #
-    for d in init_domains:
-        input_domain_queue.put_nowait(
-            (d, cli_args.http_max_recursion)
+    if cli_args.dns_resolver:
+        nameservers = cli_args.dns_resolver.split(",")
+    else:
+        nameservers = None
+
+    if cli_args.dns_engine:
+        resolver = CachingResolver(
+            negative_ttl=cli_args.dns_negative_ttl,
+            max_entries=cli_args.dns_cache_size,
+            engine=DNSEngine(
+                nameservers=nameservers,
+                sockets=cli_args.dns_sockets,
+                rate=cli_args.dns_rate,
+                timeout=cli_args.dns_timeout,
+                max_outstanding=cli_args.dns_outstanding
+            ),
+            prefetch_workers=0 if cli_args.no_dnsdiscover and
+            not cli_args.resolve_first else cli_args.dns_prefetch_workers,
+            prefetch_pending=cli_args.queue_size
+        )
+    else:
+        resolver = CachingResolver(
+            nameservers=nameservers,
+            negative_ttl=cli_args.dns_negative_ttl,
+            max_entries=cli_args.dns_cache_size
         )
 
+    cli_args.resolver = resolver
+    cli_args.resolve_stats = SimpleNamespace(checked=0,
+                                             not_resolved=0,
+                                             probes_saved=0)
+
+    def prefetch_domain(item):
+        domain, recursion_level = item
+
+        if recursion_level >= 0 and domain not in domains_processed:
+            resolver.prefetch(domain, types.CNAME)
+
+            if cli_args.resolve_first:
+                resolver.prefetch(domain, types.A)
+
     #
-    # On results events
+    # Nodes of a distributed crawl share the frontier, the visited domains
+    # and the results in Redis
     #
-    on_results_tasks = []
-
-    if cli_args.index:
-        on_results_tasks.append(on_results_add_to_redis)
+    cluster = None
+
+    if cli_args.cluster_server:
+        cluster = CrawlCluster(cli_args.cluster_server,
+                               name=cli_args.cluster_name,
+                               node=cli_args.cluster_node,
+                               batch_size=cli_args.cluster_batch,
+                               claim_idle=cli_args.cluster_claim_idle)
+        await cluster.connect()
+
+        cli_args.cluster = cluster
+
+    if shard:
+        # Domains owned by other workers are sent to them
+        input_domain_queue = ShardedFrontierQueue(shard,
+                                                  state=crawl_state,
+                                                  on_put=prefetch_domain,
+                                                  maxsize=queue_size,
+                                                  spill=queue_spill,
+                                                  name="frontier")
+    elif cluster:
+        input_domain_queue = ClusterFrontierQueue(cluster,
+                                                  on_put=prefetch_domain,
+                                                  maxsize=queue_size,
+                                                  spill=queue_spill,
+                                                  name="frontier")
+    else:
+        input_domain_queue = FrontierQueue(state=crawl_state,
+                                           on_put=prefetch_domain,
+                                           maxsize=queue_size,
+                                           spill=queue_spill,
+                                           name="frontier")
+
+    for queue in (input_domain_queue,
+                  results_queue,
+                  filtered_discovered_domains,
+                  raw_discovered_domains):
+        metrics.add_queue(queue)
 
-    if not cli_args.result_file:
-        cli_args.result_file = "results.fetin"
-    on_results_tasks.append(on_result_save_streaming_results)
+    #
+    # Shared HTTP session for all of the probes
+    #
+    http_session_create(cli_args)
+
+    http_stats = cli_args.http_stats
+
+    metrics.callback("festin_http_requests_total",
+                     "HTTP requests",
+                     lambda: http_stats.requests,
+                     kind="counter")
+    metrics.callback("festin_http_connections_total",
+                     "HTTP connections opened",
+                     lambda: http_stats.created,
+                     kind="counter")
+    metrics.callback("festin_http_reused_connections_total",
+                     "HTTP requests that reused a connection",
+                     lambda: http_stats.reused,
+                     kind="counter")
+    metrics.callback("festin_http_received_bytes_total",
+                     "Bytes received in HTTP responses",
+                     lambda: http_stats.received,
+                     kind="counter")
+    metrics.callback("festin_dns_queries_total",
+                     "DNS queries of the probes",
+                     lambda: resolver.queries,
+                     kind="counter")
+    metrics.callback("festin_dns_cache_hits_total",
+                     "DNS queries answered from the cache",
+                     lambda: resolver.hits,
+                     kind="counter")
 
-    if not cli_args.no_print or not cli_args.quiet:
-        on_results_tasks.append(on_result_print_results)
+    #
+    # Worker processes for parsing web pages
+    #
+    if cli_args.parse_workers:
+        cli_args.parse_pool = ProcessPoolExecutor(cli_args.parse_workers)
+    else:
+        cli_args.parse_pool = None
 
     #
-    # On domain events
+    # Check proxy connection
     #
-    on_domain_filtered_tasks = []
-    on_domain_raw_domains_tasks = []
+    if cli_args.tor:
+        if not await check_tor_connection(cli_args):
+            print('[!] Can\'t stablish connection to TOR')
+            await http_session_close(cli_args)
+            exit(1)
 
-    if cli_args.discovered_domains:
-        on_domain_filtered_tasks.append((
-            on_domain_save_new_domains,
-            cli_args.discovered_domains
-        ))
-    if cli_args.raw_discovered_domains:
-        on_domain_raw_domains_tasks.append((
-            on_domain_save_new_domains,
-            cli_args.raw_discovered_domains
-        ))
+
+    #
+    # Results and discovered domains of a worker of a multi-process crawl
+    # are written by the coordinator
+    #
+    if shard:
+        cli_args.shard = shard
+
+        sinks = None
+        on_results_tasks = [on_result_send_to_coordinator]
+        on_domain_filtered_tasks = [(on_domain_send_to_coordinator,
+                                     "filtered")]
+        on_domain_raw_domains_tasks = [(on_domain_send_to_coordinator,
+                                        "raw")]
+    else:
+        sinks = await open_sinks(
+            cli_args,
+            crawl_state.add_results if crawl_state else None
+        )
+        on_results_tasks = sinks.on_results_tasks
+        on_domain_filtered_tasks = sinks.on_domain_filtered_tasks
+        on_domain_raw_domains_tasks = sinks.on_domain_raw_domains_tasks
 
     #
     # Launch services
     #
     wait_tasks = []
 
+    metrics_service = await start_metrics(cli_args)
+
+    # The frontier is fed by other workers or nodes
+    if shard or cluster:
+        receive_task = asyncio.create_task(input_domain_queue.receive())
+
+    #
+    # Populate initial domains. The frontier could be smaller than the
+    # domains list, so it's done in background
+    #
+    input_domain_queue.hold()
+    wait_tasks.append(asyncio.create_task(populate_domains()))
+
     wait_tasks.append(asyncio.create_task(
         on_result_event(cli_args, results_queue, on_results_tasks)
     ))
     wait_tasks.append(asyncio.create_task(
         on_domain_event(cli_args,
                         filtered_discovered_domains,
-                        init_domains,
+                        set(init_domains),
                         on_domain_filtered_tasks)
     ))
     wait_tasks.append(asyncio.create_task(
@@ -303,6 +720,11 @@ async def run(cli_args: argparse.Namespace, init_domains: list):
             asyncio.create_task(watch_new_domains())
         )
 
+    if crawl_state:
+        checkpoint_task = asyncio.create_task(
+            crawl_state.checkpoint(cli_args.state_interval)
+        )
+
     #
     # Run initial discover
     #
@@ -317,7 +739,16 @@ async def run(cli_args: argparse.Namespace, init_domains: list):
             filtered_discovered_domains,
             raw_discovered_domains
         )
+
+        # The coordinator sends back the results of the worker when it
+        # writes them. Wait for them before the inbox is closed
+        if shard and crawl_state:
+            await crawl_state.wait_results()
     finally:
+        if shard or cluster:
+            input_domain_queue.stop_receiving()
+            await receive_task
+
         if not cli_args.watch:
             await results_queue.put(STOP_KEYWORD)
             await filtered_discovered_domains.put(STOP_KEYWORD)
@@ -326,22 +757,175 @@ async def run(cli_args: argparse.Namespace, init_domains: list):
     #
     # Wait for all tasks finish
     #
-    await asyncio.wait(wait_tasks)
+    try:
+        await asyncio.wait(wait_tasks)
 
+        if sinks:
+            await join_sinks(cli_args)
+    finally:
+        await stop_metrics(metrics_service)
 
+        if sinks:
+            await close_sinks(cli_args, sinks)
 
-def main():
+        if cluster:
+            await cluster.close()
+
+            if not quiet:
+                print(cluster.summary())
+
+        await http_session_close(cli_args)
+
+        if cli_args.parse_pool:
+            cli_args.parse_pool.shutdown()
+
+        resolver.close()
+
+        if not quiet:
+            print(resolver.summary())
+
+            if resolver.engine:
+                print(resolver.engine.summary())
+
+            if cli_args.resolve_first:
+                stats = cli_args.resolve_stats
+
+                print(f"[*] Resolve first: {stats.checked} domains checked, "
+                      f"{stats.not_resolved} not resolved, "
+                      f"{stats.probes_saved} HTTP probes skipped (up to "
+                      f"{stats.probes_saved * cli_args.http_timeout}s of "
+                      f"timeouts saved)")
+
+        if crawl_state:
+            checkpoint_task.cancel()
+            crawl_state.close()
+
+        if not quiet:
+            for queue in (input_domain_queue,
+                          results_queue,
+                          filtered_discovered_domains,
+                          raw_discovered_domains):
+                print(queue.summary())
+
+        if cli_args.visited_filter:
+            if not quiet:
+                print(f"[*] Visited domains filter: "
+                      f"{len(domains_processed)} domains, "
+                      f"{len(domains_processed.filters)} slices, "
+                      f"{domains_processed.size // 1024} KB, "
+                      f"{domains_processed.fill_ratio:.1%} occupancy, "
+                      f"estimated false positive rate "
+                      f"{domains_processed.estimated_error_rate:.4%}")
+
+            domains_processed.close()
+
+        if shard:
+            shard.send(("stop", shard.index))
+
+
+def run_shard(cli_args: argparse.Namespace,
+              init_domains: list,
+              shard: ShardContext):
+    """Entry point of the worker processes of a multi-process crawl"""
+
+    # Every worker has its own crawl state and visited domains filter
+    if cli_args.state_file:
+        cli_args.state_file = f"{cli_args.state_file}.{shard.index}"
+
+    if cli_args.visited_file:
+        cli_args.visited_file = f"{cli_args.visited_file}.{shard.index}"
+
+    # The coordinator uses the metrics port, and workers the next ones
+    if cli_args.metrics_port:
+        cli_args.metrics_port += shard.index + 1
+
+    try:
+        asyncio.run(run(cli_args, init_domains, shard))
+    except KeyboardInterrupt:
+        pass
 
-    #
-    # Check python version
-    #
-    if platform.python_version_tuple() < ("3", "8"):
-        print("\n[!] Python 3.8 or above is required\n")
-        print("If you don't want to install Python 3.8. "
-              "Try with Docker:\n")
-        print("   $ docker run --rm cr0hn/festin -h")
-        exit(1)
 
+async def merge_shards(cli_args: argparse.Namespace,
+                       init_domains: list,
+                       pool: ShardPool):
+    """Coordinator of a multi-process crawl: writes the results and
+    discovered domains sent by the workers"""
+
+    queue_size = cli_args.queue_size
+    queue_spill = cli_args.queue_spill
+
+    results_queue = BoundedQueue(queue_size, queue_spill, "results")
+    domain_queues = {
+        "filtered": BoundedQueue(queue_size,
+                                 queue_spill,
+                                 "discovered domains"),
+        "raw": BoundedQueue(queue_size,
+                            queue_spill,
+                            "raw discovered domains")
+    }
+
+    cli_args.crawl_state = None
+    cli_args.metrics = Metrics()
+
+    cli_args.metrics.add_queue(results_queue)
+
+    for domain_queue in domain_queues.values():
+        cli_args.metrics.add_queue(domain_queue)
+
+    # Objects to index are downloaded by the coordinator
+    if cli_args.index:
+        http_session_create(cli_args)
+
+    # Workers checkpoint their results when the coordinator writes them
+    sinks = await open_sinks(
+        cli_args,
+        pool.send_flushed if cli_args.state_file else None
+    )
+    metrics_service = await start_metrics(cli_args)
+
+    wait_tasks = [
+        asyncio.create_task(
+            on_result_event(cli_args, results_queue, sinks.on_results_tasks)
+        ),
+        asyncio.create_task(
+            on_domain_event(cli_args,
+                            domain_queues["filtered"],
+                            set(init_domains),
+                            sinks.on_domain_filtered_tasks)
+        ),
+        asyncio.create_task(
+            on_domain_event(cli_args,
+                            domain_queues["raw"],
+                            None,
+                            sinks.on_domain_raw_domains_tasks)
+        )
+    ]
+
+    try:
+        try:
+            async for message in pool.messages():
+                if message[0] == "result":
+                    await results_queue.put(message[1])
+                else:
+                    _, kind, domain = message
+                    await domain_queues[kind].put(domain)
+        finally:
+            await results_queue.put(STOP_KEYWORD)
+
+            for domain_queue in domain_queues.values():
+                await domain_queue.put(STOP_KEYWORD)
+
+        await asyncio.wait(wait_tasks)
+        await join_sinks(cli_args)
+    finally:
+        await stop_metrics(metrics_service)
+        await close_sinks(cli_args, sinks)
+        await http_session_close(cli_args)
+
+        pool.join()
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description='Festin - the '
                     'powered S3 bucket finder and content discover'
@@ -364,12 +948,35 @@ def main():
                         default=5,
                         type=int,
                         help="max concurrency")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=int,
+                        help="number of crawler processes. Domains are "
+                             "split between them by registered domain. "
+                             "Default: 1")
+    parser.add_argument("--queue-size",
+                        default=10000,
+                        type=int,
+                        help="max number of items of internal queues (0 for "
+                             "no limit). When a queue is full, producers "
+                             "wait. Default: 10000")
+    parser.add_argument("--queue-spill",
+                        action="store_true",
+                        default=False,
+                        help="write items that don't fit in the queues to "
+                             "disk instead of waiting")
 
     group_http = parser.add_argument_group('HTTP Probes')
     group_http.add_argument("--no-links",
                             action="store_false",
                             default=False,
                             help="extract web site links")
+    group_http.add_argument("--resolve-first",
+                            action="store_true",
+                            default=False,
+                            help="resolve domains before probing them and "
+                                 "skip HTTP probes of the ones that don't "
+                                 "resolve")
     group_http.add_argument("-T", "--http-timeout",
                             type=int,
                             default=5,
@@ -378,6 +985,23 @@ def main():
                             type=int,
                             default=3,
                             help="maximum recursison when follow links")
+    group_http.add_argument("--http-max-page-size",
+                            type=int,
+                            default=2097152,
+                            help="max bytes read from each web page. "
+                                 "Default: 2097152 (2 MB)")
+    group_http.add_argument("--parse-workers",
+                            type=int,
+                            default=0,
+                            help="number of processes for parsing web pages. "
+                                 "Default: 0 (parse in the crawler process)")
+
+    group_s3 = parser.add_argument_group('S3 options')
+    group_s3.add_argument("--s3-max-objects",
+                          type=int,
+                          default=0,
+                          help="max number of objects listed for each bucket. "
+                               "Default: 0 (list all of them)")
 
     group_filtering = parser.add_argument_group('filtering')
     group_filtering.add_argument("-dr", "--domain-regex",
@@ -394,6 +1018,29 @@ def main():
     group_results.add_argument("-rr", "--result-file",
                                default=None,
                                help="results file")
+    group_results.add_argument("--result-compression",
+                               choices=("gzip", "zstd"),
+                               default=None,
+                               help="compress the results file. 'zstd' "
+                                    "needs the 'zstandard' package")
+    group_results.add_argument("--result-rotate-size",
+                               type=int,
+                               default=0,
+                               help="start a new results file when it's "
+                                    "bigger than this bytes (0 for no "
+                                    "rotation). Default: 0")
+    group_results.add_argument("--result-buffer-size",
+                               type=int,
+                               default=1048576,
+                               help="bytes of compressed results buffered "
+                                    "before writing them. Default: 1048576 "
+                                    "(1 MB)")
+    group_results.add_argument("--result-flush-interval",
+                               type=float,
+                               default=1,
+                               help="seconds between syncs of the results "
+                                    "file to disk, and writes of buffered "
+                                    "compressed results. Default: 1")
     group_results.add_argument("-rd", "--discovered-domains",
                                default=None,
                                help="file name for storing new discovered "
@@ -402,12 +1049,130 @@ def main():
                                default=None,
                                help="file name for storing any domain without "
                                     "filters")
+    group_results.add_argument("--result-workers",
+                               type=int,
+                               default=1,
+                               help="workers of each consumer of results, "
+                                    "like printing or indexing. The results "
+                                    "file always has one. Default: 1")
+    group_results.add_argument("--result-policy",
+                               choices=("block", "drop", "spill"),
+                               default="spill",
+                               help="what to do with new results when a "
+                                    "consumer has '--queue-size' results "
+                                    "waiting: block the rest of consumers, "
+                                    "drop them or spill them to disk. The "
+                                    "results file always blocks. "
+                                    "Default: spill")
+    group_results.add_argument("--domains-dedup",
+                               action="store_true",
+                               default=False,
+                               help="write every domain only once in the "
+                                    "discovered domains files")
 
     group_conn = parser.add_argument_group('Connectivity')
     group_conn.add_argument("--tor",
                             default=None,
                             action="store_true",
                             help="Use Tor as proxy")
+    group_conn.add_argument("--http-pool-size",
+                            type=int,
+                            default=100,
+                            help="max number of simultaneous HTTP "
+                                 "connections. Default: 100")
+    group_conn.add_argument("--http-pool-per-host",
+                            type=int,
+                            default=10,
+                            help="max number of simultaneous HTTP "
+                                 "connections to the same host (0 for no "
+                                 "limit). Default: 10")
+    group_conn.add_argument("--http-host-rate",
+                            type=float,
+                            default=0,
+                            help="max number of HTTP requests per second to "
+                                 "the same host (0 for no limit). Default: 0")
+    group_conn.add_argument("--http-host-burst",
+                            type=float,
+                            default=None,
+                            help="number of requests allowed in a burst over "
+                                 "'--http-host-rate'. Default: same as rate")
+    group_conn.add_argument("--http-keepalive",
+                            type=float,
+                            default=15,
+                            help="seconds to keep idle HTTP connections "
+                                 "open for reuse. Default: 15")
+    group_conn.add_argument("--http-dns-cache",
+                            type=int,
+                            default=300,
+                            help="seconds to cache host resolutions of "
+                                 "HTTP connections (0 to disable). "
+                                 "Default: 300")
+
+    group_visited = parser.add_argument_group('Visited domains')
+    group_visited.add_argument("--visited-filter",
+                               default=False,
+                               action="store_true",
+                               help="use a Bloom filter, with fixed memory "
+                                    "usage, for remembering analyzed domains "
+                                    "instead of a set")
+    group_visited.add_argument("--visited-capacity",
+                               type=int,
+                               default=1000000,
+                               help="expected number of domains of the Bloom "
+                                    "filter. When it's full a new and bigger "
+                                    "slice is added. Default: 1000000")
+    group_visited.add_argument("--visited-error-rate",
+                               type=float,
+                               default=0.001,
+                               help="max false positive rate of the Bloom "
+                                    "filter. Default: 0.001")
+    group_visited.add_argument("--visited-file",
+                               default=None,
+                               help="file to memory-map the Bloom filter. "
+                                    "Default: anonymous memory")
+
+    group_state = parser.add_argument_group('Resume')
+    group_state.add_argument("-S", "--state-file",
+                             default=None,
+                             help="file for checkpointing the crawl state, "
+                                  "allowing to resume it later")
+    group_state.add_argument("--state-interval",
+                             type=float,
+                             default=1,
+                             help="seconds between checkpoints of the crawl "
+                                  "state. Default: 1")
+    group_state.add_argument("--resume",
+                             default=False,
+                             action="store_true",
+                             help="resume the crawl stored in the state file "
+                                  "'-S'")
+
+    group_cluster = parser.add_argument_group('Distributed crawl')
+    group_cluster.add_argument("--cluster-server",
+                               default=None,
+                               help="Redis server (5.0 or above) shared by "
+                                    "the nodes of a distributed crawl. "
+                                    "Example: redis://localhost:6379")
+    group_cluster.add_argument("--cluster-name",
+                               default="festin",
+                               help="name of the distributed crawl, used as "
+                                    "prefix of its Redis keys. "
+                                    "Default: festin")
+    group_cluster.add_argument("--cluster-node",
+                               default=None,
+                               help="name of this node. Default: host name "
+                                    "and process id")
+    group_cluster.add_argument("--cluster-batch",
+                               type=int,
+                               default=100,
+                               help="max domains taken by this node at "
+                                    "once. Default: 100")
+    group_cluster.add_argument("--cluster-claim-idle",
+                               type=float,
+                               default=300,
+                               help="seconds after which domains taken by "
+                                    "a node that didn't finish them are "
+                                    "claimed by other nodes. Default: 300")
 
     group_display = parser.add_argument_group('Display options')
     group_display.add_argument("--debug",
@@ -422,6 +1187,22 @@ def main():
                                default=False,
                                action="store_true",
                                help="Use quiet mode")
+    group_display.add_argument("--stats-interval",
+                               type=float,
+                               default=0,
+                               help="seconds between one line summaries of "
+                                    "the crawl progress (0 to disable). "
+                                    "Default: 0")
+    group_display.add_argument("--metrics-port",
+                               type=int,
+                               default=0,
+                               help="serve metrics in Prometheus format at "
+                                    "'http://<metrics host>:<port>/metrics' "
+                                    "(0 to disable). Default: 0")
+    group_display.add_argument("--metrics-host",
+                               default="127.0.0.1",
+                               help="address of the metrics endpoint. "
+                                    "Default: 127.0.0.1")
 
     group_redis = parser.add_argument_group('Redis Search')
     group_redis.add_argument("--index",
@@ -432,6 +1213,42 @@ def main():
                              default="redis://localhost:6379",
                              help="Redis Search Server"
                                   "Default: redis://localhost:6379")
+    group_redis.add_argument("--index-max-size",
+                             type=int,
+                             default=10485760,
+                             help="max size in bytes of the indexed "
+                                  "objects (0 for no limit). "
+                                  "Default: 10485760 (10 MB)")
+    group_redis.add_argument("--index-manifest",
+                             default=None,
+                             help="file that keeps the ETags of indexed "
+                                  "objects between runs. Unchanged objects "
+                                  "aren't downloaded again")
+    group_redis.add_argument("--index-workers",
+                             type=int,
+                             default=20,
+                             help="concurrent downloads of objects to "
+                                  "index, for all buckets. Default: 20")
+    group_redis.add_argument("--index-rate",
+                             type=float,
+                             default=0,
+                             help="max bytes per second downloaded for "
+                                  "indexing. Default: no limit")
+    group_redis.add_argument("--index-bucket-share",
+                             type=float,
+                             default=0.5,
+                             help="max fraction of the download workers "
+                                  "used by the same bucket. Default: 0.5")
+    group_redis.add_argument("--index-batch-size",
+                             type=int,
+                             default=100,
+                             help="documents sent to Redis in each "
+                                  "pipeline. Default: 100")
+    group_redis.add_argument("--index-flush-interval",
+                             type=float,
+                             default=1,
+                             help="seconds between sends of incomplete "
+                                  "batches of documents. Default: 1")
 
     group_dns = parser.add_argument_group('DNS options')
     group_dns.add_argument("-dn", "--no-dnsdiscover",
@@ -441,8 +1258,68 @@ def main():
     group_dns.add_argument("-ds", "--dns-resolver",
                            default=None,
                            help="comma separated custom domain name servers")
+    group_dns.add_argument("--dns-negative-ttl",
+                           type=int,
+                           default=300,
+                           help="seconds to cache domains without DNS "
+                                "records when the server doesn't set it. "
+                                "Default: 300")
+    group_dns.add_argument("--dns-cache-size",
+                           type=int,
+                           default=100000,
+                           help="max names in the DNS cache. The least "
+                                "recently used are evicted (0 for no "
+                                "limit). Default: 100000")
+    group_dns.add_argument("--dns-engine",
+                           action="store_true",
+                           default=False,
+                           help="resolve with the built-in pipelined DNS "
+                                "engine, that keeps many queries "
+                                "outstanding and prefetches CNAMEs of "
+                                "queued domains")
+    group_dns.add_argument("--dns-sockets",
+                           type=int,
+                           default=4,
+                           help="UDP sockets used by the DNS engine. "
+                                "Default: 4")
+    group_dns.add_argument("--dns-rate",
+                           type=float,
+                           default=0,
+                           help="max queries per second sent to each DNS "
+                                "server by the DNS engine. Default: no limit")
+    group_dns.add_argument("--dns-timeout",
+                           type=float,
+                           default=2,
+                           help="seconds to wait for a DNS answer before "
+                                "retrying on the next server. Default: 2")
+    group_dns.add_argument("--dns-outstanding",
+                           type=int,
+                           default=2048,
+                           help="max DNS queries in flight in the DNS "
+                                "engine. Default: 2048")
+    group_dns.add_argument("--dns-prefetch-workers",
+                           type=int,
+                           default=16,
+                           help="concurrent queries of the DNS engine for "
+                                "prefetching CNAMEs of queued domains. "
+                                "Default: 16")
+
+    return parser
+
 
-    parsed = parser.parse_args()
+def main():
+
+    #
+    # Check python version
+    #
+    if platform.python_version_tuple() < ("3", "8"):
+        print("\n[!] Python 3.8 or above is required\n")
+        print("If you don't want to install Python 3.8. "
+              "Try with Docker:\n")
+        print("   $ docker run --rm cr0hn/festin -h")
+        exit(1)
+
+    parsed = build_parser().parse_args()
 
     if not parsed.quiet:
         print(LOGO)
@@ -470,13 +1347,35 @@ def main():
 
     if parsed.file_domains:
         print(f"[*] Loading '{parsed.file_domains}' file")
-        with open(parsed.file_domains, "r") as f:
-            domains.extend(f.read().splitlines())
+        with open(parsed.file_domains, "rb") as f:
+            content = f.read()
+
+        # Watch mode continues from here
+        parsed.file_domains_offset = len(content)
+
+        domains.extend(content.decode("UTF-8").splitlines())
 
     # Remove duplicates
     domains = list(set(domains))
 
-    if not domains:
+    if parsed.resume:
+        if not parsed.state_file:
+            print("[!] For resuming a crawl you must set a state file "
+                  "('-S' option)")
+            exit(1)
+
+        # With many workers each one has its own state file
+        if parsed.workers > 1:
+            state_file = f"{parsed.state_file}.0"
+        else:
+            state_file = parsed.state_file
+
+        if not os.path.exists(state_file):
+            print(f"[!] State file doesn't exits: '{state_file}'")
+            exit(1)
+
+    # Nodes of a distributed crawl could start without domains
+    elif not domains and not parsed.cluster_server:
         print("[!] You must provide at least one domain")
         exit(1)
 
@@ -501,17 +1400,44 @@ def main():
             print(f"[!] White list doesn't exits: '{parsed.parsed}'")
             exit(1)
 
+    if parsed.result_compression == "zstd" and zstandard is None:
+        print("[!] For 'zstd' compression you must install the "
+              "'zstandard' package")
+        exit(1)
+
     if parsed.watch:
         if not parsed.file_domains:
             print("[!] For running in 'Watch' mode you must set a domains "
                   "file ('-f' option)")
             exit(1)
 
+    if parsed.cluster_server:
+        if parsed.workers > 1:
+            print("[!] Distributed crawls run one worker per node "
+                  "('--workers' option)")
+            exit(1)
+
+        if parsed.state_file:
+            print("[!] The state of a distributed crawl is kept in Redis. "
+                  "You can't set a state file ('-S' option)")
+            exit(1)
+
+    if parsed.workers > 1 and parsed.watch:
+        print("[!] 'Watch' mode can't run with more than one worker "
+              "('--workers' option)")
+        exit(1)
+
     if not parsed.quiet:
         print("[*] Starting FestIN")
 
         try:
-            asyncio.run(run(parsed, domains))
+            if parsed.workers > 1:
+                pool = ShardPool(parsed.workers)
+                pool.start(run_shard, parsed, domains)
+
+                asyncio.run(merge_shards(parsed, domains, pool))
+            else:
+                asyncio.run(run(parsed, domains))
         except KeyboardInterrupt:
             print("[*] Stopping Festin")
 
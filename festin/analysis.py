@@ -1,19 +1,21 @@
+import re
 import asyncio
 import argparse
+import ipaddress
 
 from urllib.parse import urlparse
 
-import aiohttp
 import aiohttp_proxy
 
 from lxml import etree
 from async_dns.core import types
 from colorama import Fore, Back, Style
-from async_dns.resolver import ProxyResolver
-from aiohttp_proxy import ProxyConnector, ProxyType
 
 from . import valid_domain_or_link
-from .s3 import get_redirection, parse_result, S3Bucket
+from .session import http_get
+from .links import iter_links, read_content
+from .s3 import get_redirection, list_bucket_objects, ListingParser, \
+    S3Bucket, S3Objects, BucketRedirectException, BUCKET_PART_SIZE
 
 PS = f"{Fore.YELLOW}SKIP{Style.RESET_ALL}"
 PB = f"{Fore.GREEN}BUCKET{Style.RESET_ALL}"
@@ -23,68 +25,123 @@ PC3= f"{Fore.MAGENTA}CRAWLER-S3{Style.RESET_ALL}"
 PCE= f"{Fore.RED}CRAWLER-ERROR{Style.RESET_ALL}"
 PD= f"{Fore.BLUE}DNS{Style.RESET_ALL}"
 PDE= f"{Fore.RED}DNS-ERROR{Style.RESET_ALL}"
+PR= f"{Fore.YELLOW}NOT-RESOLVED{Style.RESET_ALL}"
 
-def build_tor_connector(cli_args: argparse.Namespace) \
-        -> ProxyConnector or None:
-
-    if cli_args.tor:
-        return ProxyConnector(
-            proxy_type=ProxyType.SOCKS5,
-            host='127.0.0.1',
-            port=9050,
-            verify_ssl=False
-        )
-    else:
-        return None
+S3_BUCKET_NAME = re.compile(r"^[a-z0-9][a-z0-9.-]{1,61}[a-z0-9]$")
+IPV4_ADDRESS = re.compile(r"^\d+\.\d+\.\d+\.\d+$")
 
 async def check_tor_connection(cli_args) -> bool:
 
     try:
-        async with aiohttp.ClientSession(connector=build_tor_connector(
-                cli_args),
-                timeout=aiohttp.ClientTimeout(total=cli_args.http_timeout)
-        ) as session:
-            async with session.get("https://www.google.com") as response:
-                return True
+        async with http_get(cli_args, "https://www.google.com") as response:
+            return True
     except aiohttp_proxy.errors.SocksConnectionError as e:
         return False
 
 
-class BucketRedirectException(Exception):
+def is_s3_bucket_name(name: str) -> bool:
+    """Check if a domain is also a valid S3 bucket name"""
+    return bool(S3_BUCKET_NAME.match(name)) and \
+        ".." not in name and \
+        not IPV4_ADDRESS.match(name)
+
 
-    def __init__(self, redirection):
-        self.redirection = redirection
+async def host_resolves(cli_args: argparse.Namespace, domain: str) -> bool:
+    """Check if a domain has CNAME, A or AAAA records. DNS errors don't
+    discard the domain"""
+    host = urlparse(f"//{domain}").hostname or domain
+
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        pass
 
+    for qtype in (types.CNAME, types.A, types.AAAA):
+        try:
+            if await cli_args.resolver.query(host, qtype):
+                return True
+        except Exception as e:
+            if cli_args.debug:
+                print(f"[{PDE}] Error in 'host_resolves': {str(e)}")
 
-async def get_bucket_info(cli_args, domain, bucket_name: str):
-    async with aiohttp.ClientSession(connector=build_tor_connector(
-            cli_args),
-            timeout=aiohttp.ClientTimeout(total=cli_args.http_timeout)
-    ) as session:
+            return True
 
-        if not bucket_name.startswith("http"):
-            bucket_name = f"http://{bucket_name}"
+    return False
 
-        async with session.get(bucket_name) as response:
 
-            if str(response.status).startswith("2"):
-                content = await response.text()
+def bucket_part(domain, bucket_name: str, objects: S3Objects, part: int):
+    print(f"[{PB}] Found "
+          f"'{len(objects)}' objects at "
+          f"bucket '{bucket_name}'" + (f" (part {part})" if part else ""))
 
-                if objects := parse_result(content):
-                    print(f"[{PB}] Found "
-                          f"'{len(objects)}' objects at "
-                          f"bucket '{bucket_name}'")
+    return S3Bucket(
+        domain=domain,
+        bucket_name=bucket_name,
+        objects=objects,
+        part=part
+    )
 
-                    yield S3Bucket(
-                        domain=domain,
-                        bucket_name=bucket_name,
-                        objects=[path for path in objects]
-                    )
 
-            elif response.status == 301:
-                redirection_url = get_redirection(await response.read())
+async def put_result(cli_args: argparse.Namespace,
+                     results_queue: asyncio.Queue,
+                     bucket: S3Bucket,
+                     origin: tuple):
+    """Queue a result found by the analysis of 'origin'. The crawl state
+    keeps it pending until the result is written"""
+    bucket.origin = origin
 
-                raise BucketRedirectException(redirection_url)
+    if cli_args.crawl_state:
+        cli_args.crawl_state.hold_result(origin)
+
+    await results_queue.put(bucket)
+
+
+async def get_bucket_info(cli_args,
+                          domain,
+                          bucket_name: str,
+                          objects: S3Objects = None,
+                          params: dict = None,
+                          ssl: bool = True):
+    """Yield the objects of a bucket in parts of up to 'BUCKET_PART_SIZE'
+    objects, as the pages of the listing are parsed.
+
+    'objects' are the ones of an already parsed page and 'params' the
+    parameters of the next one, if any. 'ssl' is passed to
+    'list_bucket_objects'.
+    """
+    if not bucket_name.startswith("http"):
+        bucket_name = f"http://{bucket_name}"
+
+    if objects is None:
+        objects = S3Objects()
+
+    max_objects = cli_args.s3_max_objects
+    found = len(objects)
+    part = 0
+
+    # A parsed page without a next one is the whole listing
+    if (not found or params) and not (max_objects and found >= max_objects):
+        listing = list_bucket_objects(cli_args, bucket_name, params, ssl)
+
+        try:
+            async for obj in listing:
+                if len(objects) >= BUCKET_PART_SIZE:
+                    yield bucket_part(domain, bucket_name, objects, part)
+
+                    part += 1
+                    objects = S3Objects()
+
+                objects.append(obj)
+                found += 1
+
+                if max_objects and found >= max_objects:
+                    break
+        finally:
+            await listing.aclose()
+
+    if objects:
+        yield bucket_part(domain, bucket_name, objects, part)
 
 
 async def get_links(cli_args: argparse.Namespace,
@@ -95,123 +152,122 @@ async def get_links(cli_args: argparse.Namespace,
     debug = cli_args.debug
     quiet = cli_args.quiet
 
-    # Get links
-    # found_domains= {"http": set(), "https": set()}
-    found_domains= {}
-
-    found = []
+    already_added_domains = set()
 
     for scheme in ("http", "https"):
-        try:
-            async with aiohttp.ClientSession(connector=build_tor_connector(
-                    cli_args),
-                    timeout=aiohttp.ClientTimeout(total=cli_args.http_timeout)
-            ) as session:
-
-                async with session.get(f"{scheme}://{domain}",
-                                       verify_ssl=False) as response:
-                    content = await response.text()
-
-                    header_content_type = response.headers.get("Content-Type", "")
-
-                    if "xml" in header_content_type:
-                        content_type = "xml"
-                    elif "html" in header_content_type:
-                        content_type = "html"
-                    else:
-                        continue
 
-                    if hasattr(content, "encode"):
-                        content = content.encode("UTF-8")
+        origin = f"{scheme}://{domain}"
+        stage = cli_args.metrics.stage("links")
 
-                    found_domains[scheme] = (
-                        content,
-                        content_type,
-                        response.status
-                    )
+        # Queued after the HTTP slot is released. Waiting for room in the
+        # frontier while holding it would block the probes that free it
+        discovered = []
 
-        except asyncio.exceptions.TimeoutError as e:
-            if debug:
-                print(f"[{PCE}] Error in 'get_links'. Timeout Error "
-                      f"for '{scheme}://{domain}'")
-        except Exception as e:
-            if debug:
-                print(f"[{PCE}] Error in 'get_links': {str(e)}")
-            continue
+        objects = None
+        next_page = None
 
-    #
-    # Analyze found links
-    #
-    already_added_domains = set()
+        try:
+            # Sites of any domain are crawled, also the ones with invalid
+            # certificates
+            async with http_get(cli_args, origin, ssl=False) as response:
 
-    for scheme, (content, content_type, status_code) in found_domains.items():
+                header_content_type = response.headers.get("Content-Type", "")
 
-        origin = f"{scheme}://{domain}"
+                if "xml" in header_content_type:
+                    content = await read_content(
+                        response, cli_args.http_max_page_size
+                    )
 
-        if content_type == "html":
+                    try:
+                        if str(response.status).startswith("2"):
+                            listing = ListingParser()
+                            objects = S3Objects(
+                                listing.feed(content) + listing.close()
+                            )
+                            next_page = listing.next_page_params()
+
+                        elif response.status == 301:
+                            discovered.append(get_redirection(content))
+                    except Exception as e:
+                        # Parser error
+                        continue
 
-            if not content:
-                continue
+                elif "html" in header_content_type:
 
-            tree = etree.HTML(content)
+                    #
+                    # Analyze found links while the page is downloaded
+                    #
+                    async for link in iter_links(cli_args, response):
+                        link_domain = urlparse(link).netloc
 
-            try:
-                for link in list(tree.xpath(".//@href") + tree.xpath(".//@src")):
-                    link_domain = urlparse(link).netloc
+                        if not link_domain:
+                            continue
 
-                    if not link_domain:
-                        continue
+                        if link_domain in already_added_domains:
+                            continue
+                        else:
+                            already_added_domains.add(link_domain)
+
+                        if message := valid_domain_or_link(link_domain):
+                            print(message)
+                            continue
+
+                        if not quiet:
+                            if "s3." in link:
+                                print(f"[{PC}] "
+                                      f"Possible s3 bucket found. "
+                                      f"'{origin}' -> "
+                                      f"'{link_domain}'", flush=True)
+                            else:
+                                print(f"[{PC3}] Adding "
+                                      f"domain to proposal. "
+                                      f"{origin} -> '{link_domain}'",
+                                      flush=True)
+
+                        discovered.append(link_domain)
+
+            #
+            # The rest of the pages of a listing are requested when the slot
+            # of the first one is released. Otherwise, with one connection
+            # per host, they would wait for it forever
+            #
+            if objects:
+                stage.outcome = "found"
+
+                async for bucket in get_bucket_info(cli_args,
+                                                    domain,
+                                                    origin,
+                                                    objects,
+                                                    next_page,
+                                                    ssl=False):
+                    await put_result(cli_args,
+                                     results_queue,
+                                     bucket,
+                                     (domain, recursion_level))
 
-                    if link_domain in already_added_domains:
-                        continue
-                    else:
-                        already_added_domains.add(link_domain)
+        except asyncio.exceptions.TimeoutError as e:
+            stage.outcome = "timeout"
 
-                    if message := valid_domain_or_link(link_domain):
-                        print(message)
-                        continue
+            if debug:
+                print(f"[{PCE}] Error in 'get_links'. Timeout Error "
+                      f"for '{origin}'")
+        except etree.LxmlError as e:
+            stage.outcome = "error"
 
-                    if not quiet:
-                        if "s3." in link:
-                            print(f"[{PC}] "
-                                  f"Possible s3 bucket found. "
-                                  f"'{origin}' -> "
-                                  f"'{link_domain}'", flush=True)
-                        else:
-                            print(f"[{PC3}] Adding "
-                                  f"domain to proposal. "
-                                  f"{origin} -> '{link_domain}'", flush=True)
-
-                    await input_queue.put((link_domain, recursion_level - 1))
-            except AttributeError as e:
-                print(f"[{PCE}] Error in parsing response from '{domain}'"
-                      f": {str(e)}")
-                continue
+            print(f"[{PCE}] Error in parsing response from '{domain}'"
+                  f": {str(e)}")
+        except Exception as e:
+            stage.outcome = "error"
 
-        if content_type == "xml":
+            if debug:
+                print(f"[{PCE}] Error in 'get_links': {str(e)}")
+        finally:
+            stage.finish()
+
+        # Links found before an error are also queued
+        for link_domain in discovered:
+            await input_queue.put((link_domain, recursion_level - 1))
 
-            try:
-                if str(status_code).startswith("2"):
-                    if objects := parse_result(content):
-                        print(f"[{PB}] Found "
-                              f"'{len(objects)}' objects at "
-                              f"bucket '{origin}'")
-
-                        await results_queue.put(S3Bucket(
-                            domain=domain,
-                            bucket_name=origin,
-                            objects=[path for path in objects]
-                        ))
-
-                elif response.status == 301:
-                    redirection_url = get_redirection(await response.read())
-
-                    await input_queue.put(
-                        (redirection_url, recursion_level - 1)
-                    )
-            except Exception as e:
-                # Parser error
-                continue
 
 async def get_dns_info(cli_args: argparse.Namespace,
                        domain: str,
@@ -220,39 +276,24 @@ async def get_dns_info(cli_args: argparse.Namespace,
 
     debug = cli_args.debug
 
-    if cli_args.dns_resolver:
-        dns_servers =[(None, cli_args.dns_resolver.split(","))]
-    else:
-        dns_servers = None
     try:
-        resolver = ProxyResolver(proxies=dns_servers)
+        with cli_args.metrics.stage("dns"):
+            answers = await cli_args.resolver.query(domain, types.CNAME)
     except Exception as e:
-        pass
-
-    for _ in range(3):
-        try:
-            cname_response = await resolver.query(domain, types.CNAME)
-        except Exception as e:
-            if debug:
-                print(f"[{PDE}] Error in 'get_dns_info': : {str(e)}")
-            return
-
-        try:
-            for resp in cname_response.an:
-                if resp.data and resp.qtype==types.CNAME:
-                    print(f"[{PD}] Found new CNAME. '{domain}' -> "
-                          f"'{resp.data}'", flush=True)
-
-                    if message := valid_domain_or_link(resp.data):
-                        print(message)
-                        continue
+        if debug:
+            print(f"[{PDE}] Error in 'get_dns_info': : {str(e)}")
+        return
 
-                    await input_queue.put((resp.data, recursion_level - 1))
+    for answer in answers:
+        if answer.data and answer.qtype == types.CNAME:
+            print(f"[{PD}] Found new CNAME. '{domain}' -> "
+                  f"'{answer.data}'", flush=True)
 
-            break
+            if message := valid_domain_or_link(answer.data):
+                print(message)
+                continue
 
-        except AttributeError:
-            await asyncio.sleep(1)
+            await input_queue.put((answer.data, recursion_level - 1))
 
 
 async def get_s3(cli_args: argparse.Namespace,
@@ -264,6 +305,9 @@ async def get_s3(cli_args: argparse.Namespace,
     debug = cli_args.debug
     quiet = cli_args.quiet
 
+    stage = cli_args.metrics.stage("s3")
+    origin = (domain, recursion_level)
+
     try:
 
         if domain.endswith("s3.amazonaws.com"):
@@ -284,7 +328,9 @@ async def get_s3(cli_args: argparse.Namespace,
                         domain,
                         bucket_name
                 ):
-                    await results_queue.put(bucket)
+                    stage.outcome = "found"
+
+                    await put_result(cli_args, results_queue, bucket, origin)
             except BucketRedirectException as red:
                 if quiet:
                     print(
@@ -296,12 +342,19 @@ async def get_s3(cli_args: argparse.Namespace,
 
 
     except asyncio.exceptions.TimeoutError as e:
+        stage.outcome = "timeout"
+
         if debug:
             print(f"[{PBE}] Error in 'get_s3'. Timeout Error "
                   f"for '{bucket_name}'")
     except Exception as e:
+        stage.outcome = "error"
+
         if debug:
             print(f"[{PBE}] Error in 'get_s3': {str(e)} ")
+    finally:
+        stage.finish()
 
 
-__all__ = ("get_s3", "get_dns_info", "get_links", "check_tor_connection")
+__all__ = ("get_s3", "get_dns_info", "get_links", "check_tor_connection",
+           "host_resolves", "is_s3_bucket_name")
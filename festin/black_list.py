@@ -46,7 +46,7 @@ BLACK_LIST_FLD = {
     "jquery.org",
     "adobe.com",
     "adobelogin.com",
-    "stackoverflow.com"
+    "stackoverflow.com",
     "jqueryui.com",
     "jquerymobile.com",
     "adform.net",
@@ -0,0 +1,176 @@
+import math
+import mmap
+import hashlib
+
+from typing import Iterable
+
+
+class BloomFilter:
+    """Fixed capacity Bloom filter stored in a memory map.
+
+    If 'path' is set the bits are stored in that file, so the OS could page
+    them out instead of keeping them in the process memory. The file is
+    cleaned when the filter is created.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, path: str = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+
+        self.bits = math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.count = 0
+        self.bits_set = 0
+
+        size = (self.bits + 7) // 8
+
+        if path:
+            with open(path, "wb") as f:
+                f.truncate(size)
+
+            self._file = open(path, "r+b")
+            self._map = mmap.mmap(self._file.fileno(), size)
+        else:
+            self._file = None
+            self._map = mmap.mmap(-1, size)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode("UTF-8"),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def __contains__(self, item: str) -> bool:
+        bit_map = self._map
+
+        return all(
+            bit_map[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def __len__(self):
+        return self.count
+
+    def add(self, item: str) -> bool:
+        """Add an item. Returns False if it was (probably) already added"""
+        bit_map = self._map
+        new_bits = 0
+
+        for position in self._positions(item):
+            index = position >> 3
+            mask = 1 << (position & 7)
+            value = bit_map[index]
+
+            if not value & mask:
+                bit_map[index] = value | mask
+                new_bits += 1
+
+        if not new_bits:
+            return False
+
+        self.bits_set += new_bits
+        self.count += 1
+
+        return True
+
+    @property
+    def fill_ratio(self) -> float:
+        return self.bits_set / self.bits
+
+    @property
+    def estimated_error_rate(self) -> float:
+        return self.fill_ratio ** self.hashes
+
+    def close(self):
+        self._map.close()
+
+        if self._file:
+            self._file.close()
+
+
+class ScalableBloomFilter:
+    """Bloom filter that adds new slices when the last one is full.
+
+    Each slice has 'growth' times the capacity of the previous one and a
+    tighter error rate, so the total false positive rate stays below
+    'error_rate'. Slices are stored in '<path>.<n>' files when 'path' is set.
+    """
+
+    def __init__(self,
+                 capacity: int,
+                 error_rate: float,
+                 path: str = None,
+                 growth: int = 2,
+                 tightening: float = 0.5):
+        self.initial_capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+
+        self._add_filter()
+
+    def _add_filter(self):
+        n = len(self.filters)
+
+        self.filters.append(BloomFilter(
+            capacity=self.initial_capacity * self.growth ** n,
+            error_rate=self.error_rate * (1 - self.tightening) *
+                       self.tightening ** n,
+            path=f"{self.path}.{n}" if self.path else None
+        ))
+
+    def __contains__(self, item: str) -> bool:
+        return any(item in f for f in reversed(self.filters))
+
+    def __len__(self):
+        return sum(len(f) for f in self.filters)
+
+    def add(self, item: str) -> bool:
+        if item in self:
+            return False
+
+        last = self.filters[-1]
+
+        if last.count >= last.capacity:
+            self._add_filter()
+            last = self.filters[-1]
+
+        return last.add(item)
+
+    def update(self, items: Iterable[str]):
+        for item in items:
+            self.add(item)
+
+    @property
+    def size(self) -> int:
+        """Bytes used by the filter"""
+        return sum((f.bits + 7) // 8 for f in self.filters)
+
+    @property
+    def fill_ratio(self) -> float:
+        return sum(f.bits_set for f in self.filters) / \
+               sum(f.bits for f in self.filters)
+
+    @property
+    def estimated_error_rate(self) -> float:
+        no_error = 1.0
+
+        for f in self.filters:
+            no_error *= 1 - f.estimated_error_rate
+
+        return 1 - no_error
+
+    def close(self):
+        for f in self.filters:
+            f.close()
+
+
+__all__ = ("BloomFilter", "ScalableBloomFilter")
@@ -0,0 +1,316 @@
+import os
+import socket
+import asyncio
+
+from typing import Dict, List, Set, Tuple
+
+import aioredis
+
+from .queues import FrontierQueue
+
+# Seconds that a node waits for new domains in each read of the frontier
+READ_TIMEOUT = 1
+
+# Domains delivered this many times are probably killing their nodes. They're
+# dropped instead of claimed again
+MAX_DELIVERIES = 3
+
+
+def default_node_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class CrawlCluster:
+    """Crawl shared by many nodes through a Redis server (5.0 or above).
+
+    - '<name>:frontier': stream of queued domains. Nodes read it with the
+      consumer group '<name>:nodes' and acknowledge (and delete) every domain
+      when its analysis finishes.
+    - '<name>:visited': set of the domains already queued by any node. Only
+      new domains are added to the frontier.
+    - '<name>:results': stream of found buckets.
+
+    Domains not acknowledged after 'claim_idle' seconds, because their node
+    died, are claimed by other nodes. Each node takes up to 'batch_size'
+    domains at once.
+    """
+
+    def __init__(self,
+                 server: str,
+                 name: str = "festin",
+                 node: str = None,
+                 batch_size: int = 100,
+                 claim_idle: float = 300):
+        self.server = server
+        self.name = name
+        self.node = node or default_node_name()
+        self.batch_size = max(batch_size, 1)
+        self.claim_idle = claim_idle
+
+        self.frontier_key = f"{name}:frontier"
+        self.group = f"{name}:nodes"
+        self.visited_key = f"{name}:visited"
+        self.results_key = f"{name}:results"
+
+        self.redis = None
+        self._reader = None
+
+        self.results = 0
+
+    async def connect(self):
+        self.redis = await aioredis.create_redis_pool(self.server)
+
+        # Blocking reads would stall the commands pipelined behind them in a
+        # shared connection
+        self._reader = await aioredis.create_redis(self.server)
+
+        try:
+            await self.redis.xgroup_create(self.frontier_key,
+                                           self.group,
+                                           latest_id="0",
+                                           mkstream=True)
+        except aioredis.ReplyError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def add_domain(self, domain: str, recursion_level: int) -> bool:
+        """Queue a domain in the frontier. False if it was already queued"""
+        if not await self.redis.sadd(self.visited_key, domain):
+            return False
+
+        await self.redis.xadd(self.frontier_key,
+                              {"domain": domain, "level": recursion_level})
+
+        return True
+
+    async def read(self, count: int) -> list:
+        """New domains of the frontier for this node, as a list of (entry
+        id, fields)"""
+        entries = await self._reader.xread_group(
+            self.group,
+            self.node,
+            [self.frontier_key],
+            timeout=READ_TIMEOUT * 1000,
+            count=count,
+            latest_ids=[">"]
+        )
+
+        return [(entry_id, fields) for _, entry_id, fields in entries]
+
+    async def ack(self, *entry_ids):
+        await self.redis.xack(self.frontier_key, self.group, *entry_ids)
+
+        # Finished domains aren't needed in the frontier anymore
+        await self.redis.execute(b"XDEL", self.frontier_key, *entry_ids)
+
+    async def claim_stale(self, held: Set[bytes]) -> Tuple[list, int]:
+        """Claim the domains of dead nodes. Returns the claimed entries, as
+        in 'read', and the number of dropped ones"""
+        pending = await self.redis.xpending(self.frontier_key,
+                                            self.group,
+                                            "-",
+                                            "+",
+                                            self.batch_size)
+
+        min_idle = int(self.claim_idle * 1000)
+        stale = []
+        dropped = []
+
+        for entry_id, _, idle, deliveries in pending:
+            # Restarted nodes with the same name don't hold their old entries
+            if idle < min_idle or entry_id in held:
+                continue
+
+            if deliveries >= MAX_DELIVERIES:
+                dropped.append(entry_id)
+            else:
+                stale.append(entry_id)
+
+        if dropped:
+            await self.ack(*dropped)
+
+        if not stale:
+            return [], len(dropped)
+
+        claimed = await self.redis.xclaim(self.frontier_key,
+                                          self.group,
+                                          self.node,
+                                          min_idle,
+                                          *stale)
+
+        return claimed, len(dropped)
+
+    async def is_finished(self) -> bool:
+        """No domain is being analyzed or waiting in the frontier"""
+        transaction = self.redis.multi_exec()
+        pending = transaction.xpending(self.frontier_key, self.group)
+        groups = transaction.xinfo_groups(self.frontier_key)
+        stream = transaction.xinfo_stream(self.frontier_key)
+        await transaction.execute()
+
+        if (await pending)[0]:
+            return False
+
+        group = self.group.encode("UTF-8")
+        last_delivered = next(g[b"last-delivered-id"] for g in await groups
+                              if g[b"name"] == group)
+
+        return last_delivered == (await stream)[b"last-generated-id"]
+
+    async def add_result(self, bucket):
+        self.results += 1
+
+        await self.redis.xadd(self.results_key, {
+            "domain": bucket.domain,
+            "bucket_name": bucket.bucket_name,
+            "part": bucket.part,
+            "result": "".join(bucket.iter_json())
+        })
+
+    async def close(self):
+        for connection in (self._reader, self.redis):
+            if connection is not None:
+                connection.close()
+                await connection.wait_closed()
+
+    def summary(self) -> str:
+        return f"[*] Cluster '{self.name}' (node '{self.node}'): " \
+               f"{self.results} results sent"
+
+
+class ClusterFrontierQueue(FrontierQueue):
+    """Frontier of a node of a distributed crawl. Queued domains are added
+    to the cluster frontier, and the local queue is fed from it"""
+
+    def __init__(self, cluster: CrawlCluster, **kwargs):
+        super().__init__(**kwargs)
+        self.cluster = cluster
+
+        # Stream entries of the domains queued in this node
+        self._entries: Dict[Tuple[str, int], List[bytes]] = {}
+        self._acks = set()
+        self._room = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self._receiving = None
+
+        self.pulled = 0
+        self.claimed = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    async def put(self, item):
+        domain, recursion_level = item
+
+        # Out of recursion domains are only reported by this node
+        if recursion_level < 0:
+            return await super().put(item)
+
+        if hasattr(domain, "decode"):
+            domain = domain.decode("UTF-8")
+
+        if not await self.cluster.add_domain(domain, recursion_level):
+            self.skipped += 1
+
+    def done(self, domain, recursion_level: int, visited: bool = False):
+        super().done(domain, recursion_level, visited)
+
+        key = (domain, recursion_level)
+
+        if entry_ids := self._entries.get(key):
+            self._ack(entry_ids.pop())
+
+            if not entry_ids:
+                del self._entries[key]
+
+        self._room.set()
+
+    def _ack(self, entry_id: bytes):
+        task = asyncio.create_task(self.cluster.ack(entry_id))
+        self._acks.add(task)
+        task.add_done_callback(self._acks.discard)
+
+    async def _queue_entries(self, entries: list):
+        for entry_id, fields in entries:
+            domain = fields[b"domain"].decode("UTF-8")
+            recursion_level = int(fields[b"level"])
+
+            self._entries.setdefault(
+                (domain, recursion_level), []
+            ).append(entry_id)
+
+            await super().put((domain, recursion_level))
+
+    async def _pull(self):
+        while not self._stopped.is_set():
+            # Domains taken by a node can't be analyzed by the rest
+            room = self.cluster.batch_size - self._unfinished_tasks
+
+            if room <= 0:
+                self._room.clear()
+
+                try:
+                    await asyncio.wait_for(self._room.wait(), READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            entries = await self.cluster.read(room)
+            self.pulled += len(entries)
+
+            await self._queue_entries(entries)
+
+    async def _reclaim(self):
+        while not self._stopped.is_set():
+            held = {
+                entry_id
+                for entry_ids in self._entries.values()
+                for entry_id in entry_ids
+            }
+            entries, dropped = await self.cluster.claim_stale(held)
+
+            self.claimed += len(entries)
+            self.dropped += dropped
+
+            await self._queue_entries(entries)
+
+            try:
+                await asyncio.wait_for(self._stopped.wait(),
+                                       self.cluster.claim_idle / 2)
+            except asyncio.TimeoutError:
+                pass
+
+    async def receive(self):
+        """Queue the domains of the cluster frontier, until
+        'stop_receiving' is called"""
+        self._receiving = asyncio.current_task()
+
+        await asyncio.gather(self._pull(), self._reclaim())
+
+        # Acknowledgements still being sent
+        await asyncio.gather(*self._acks)
+
+    def stop_receiving(self):
+        self._stopped.set()
+
+    async def wait_finished(self):
+        while True:
+            await self.join()
+
+            # Errors talking with the cluster
+            if self._receiving and self._receiving.done():
+                self._receiving.result()
+
+            if await self.cluster.is_finished():
+                return
+
+            await asyncio.sleep(READ_TIMEOUT)
+
+    def summary(self) -> str:
+        return f"{super().summary()}, {self.pulled} domains taken from " \
+               f"the cluster, {self.skipped} already queued, " \
+               f"{self.claimed} claimed from dead nodes, " \
+               f"{self.dropped} dropped"
+
+
+__all__ = ("CrawlCluster", "ClusterFrontierQueue")
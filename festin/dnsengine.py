@@ -0,0 +1,478 @@
+import random
+import socket
+import struct
+import asyncio
+import ipaddress
+
+from typing import Dict, List, Tuple
+
+from async_dns.core import types
+
+from .resolver import DNSAnswer
+from .scheduler import TokenBucket
+
+DNS_PORT = 53
+
+# Header flags
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+# Response codes
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_REFUSED = 5
+
+CLASS_IN = 1
+
+SOCKET_BUFFER_SIZE = 1 << 20
+
+HEADER = struct.Struct("!HHHHHH")
+RR_HEADER = struct.Struct("!HHIH")
+
+# Record types whose data is a domain name
+NAME_TYPES = (types.CNAME, types.NS, types.PTR)
+
+
+class DNSError(Exception):
+    pass
+
+
+class DNSMessage:
+    """Decoded DNS response. Records of the answer and authority sections
+    are in 'an' and 'ns'"""
+
+    __slots__ = ("qid", "flags", "rcode", "question", "an", "ns")
+
+    def __init__(self,
+                 qid: int,
+                 flags: int,
+                 question: Tuple[str, int],
+                 an: List[DNSAnswer],
+                 ns: List[DNSAnswer]):
+        self.qid = qid
+        self.flags = flags
+        self.rcode = flags & 0xF
+        self.question = question
+        self.an = an
+        self.ns = ns
+
+    @property
+    def truncated(self) -> bool:
+        return bool(self.flags & FLAG_TC)
+
+
+def encode_query(qid: int, name: str, qtype: int) -> bytes:
+    """Build a recursive query for 'name'"""
+    qname = bytearray()
+
+    for label in name.rstrip(".").split("."):
+        label = label.encode("idna")
+
+        if not 0 < len(label) < 64:
+            raise DNSError(f"invalid domain name '{name}'")
+
+        qname.append(len(label))
+        qname.extend(label)
+
+    qname.append(0)
+
+    return HEADER.pack(qid, FLAG_RD, 1, 0, 0, 0) + \
+           bytes(qname) + \
+           struct.pack("!HH", qtype, CLASS_IN)
+
+
+def _read_name(data: bytes, offset: int) -> Tuple[str, int]:
+    """Read a, maybe compressed, domain name. Returns the name and the
+    offset after it"""
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        length = data[offset]
+
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+
+            jumps += 1
+
+            if jumps > 32:
+                raise DNSError("compression loop")
+
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+
+        elif length:
+            offset += 1
+            labels.append(data[offset:offset + length].decode("ascii",
+                                                              "replace"))
+            offset += length
+
+        else:
+            offset += 1
+            break
+
+    return ".".join(labels).lower(), end if end is not None else offset
+
+
+def _read_rdata(data: bytes, offset: int, rtype: int, length: int) -> str:
+    if rtype in NAME_TYPES:
+        return _read_name(data, offset)[0]
+    elif rtype == types.A and length == 4:
+        return str(ipaddress.IPv4Address(data[offset:offset + 4]))
+    elif rtype == types.AAAA and length == 16:
+        return str(ipaddress.IPv6Address(data[offset:offset + 16]))
+    elif rtype == types.MX:
+        return _read_name(data, offset + 2)[0]
+    elif rtype == types.SOA:
+        return _read_name(data, offset)[0]
+    elif rtype == types.TXT:
+        chunks = []
+        end = offset + length
+
+        while offset < end:
+            size = data[offset]
+            chunks.append(data[offset + 1:offset + 1 + size].decode(
+                "UTF-8", "replace"
+            ))
+            offset += size + 1
+
+        return "".join(chunks)
+    else:
+        return data[offset:offset + length].hex()
+
+
+def decode_response(data: bytes) -> DNSMessage:
+    """Parse a DNS response. Additional records are ignored"""
+    try:
+        qid, flags, qdcount, ancount, nscount, _ = HEADER.unpack_from(data)
+        offset = HEADER.size
+        question = ("", 0)
+
+        for _ in range(qdcount):
+            qname, offset = _read_name(data, offset)
+            qtype, _ = struct.unpack_from("!HH", data, offset)
+            offset += 4
+            question = (qname, qtype)
+
+        sections = ([], [])
+
+        for section, count in zip(sections, (ancount, nscount)):
+            for _ in range(count):
+                name, offset = _read_name(data, offset)
+                rtype, _, ttl, length = RR_HEADER.unpack_from(data, offset)
+                offset += RR_HEADER.size
+
+                section.append(DNSAnswer(
+                    name=name,
+                    qtype=rtype,
+                    data=_read_rdata(data, offset, rtype, length),
+                    ttl=ttl
+                ))
+                offset += length
+
+    except (IndexError, struct.error) as e:
+        raise DNSError(f"malformed DNS response: {e}")
+
+    return DNSMessage(qid, flags, question, *sections)
+
+
+def parse_nameserver(text: str) -> Tuple[str, int]:
+    """Parse name servers like '8.8.8.8', 'udp://8.8.8.8:53' or
+    '[::1]:5353'"""
+    text = text.strip()
+
+    if "://" in text:
+        text = text.split("://", 1)[1]
+
+    text = text.rstrip("/")
+
+    if text.startswith("["):
+        host, _, port = text[1:].partition("]")
+        port = port.lstrip(":")
+    elif text.count(":") == 1:
+        host, port = text.split(":")
+    else:
+        host, port = text, ""
+
+    return host, int(port) if port else DNS_PORT
+
+
+def system_nameservers(path: str = "/etc/resolv.conf") -> List[str]:
+    try:
+        with open(path, "r") as f:
+            return [
+                line.split()[1]
+                for line in f
+                if line.startswith("nameserver") and len(line.split()) > 1
+            ]
+    except OSError:
+        return []
+
+
+class _NameServer:
+
+    def __init__(self, address: Tuple[str, int], rate: float):
+        self.address = address
+        self.family = socket.AF_INET6 if ":" in address[0] \
+            else socket.AF_INET
+        self.bucket = TokenBucket(rate) if rate else None
+
+        self.sent = 0
+        self.timeouts = 0
+        self.truncated = 0
+
+
+class _UDPSocket(asyncio.DatagramProtocol):
+    """UDP socket shared by many outstanding queries. Responses are matched
+    by server address, query ID and question"""
+
+    def __init__(self):
+        self.transport = None
+        self.pending: Dict[Tuple[Tuple[str, int], int],
+                           Tuple[asyncio.Future, str, int]] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address):
+        if len(data) < HEADER.size:
+            return
+
+        qid = struct.unpack_from("!H", data)[0]
+        key = (address[:2], qid)
+
+        try:
+            future, name, qtype = self.pending[key]
+        except KeyError:
+            # Late or spoofed response
+            return
+
+        try:
+            message = decode_response(data)
+        except DNSError:
+            return
+
+        if message.question != (name, qtype) or \
+                not message.flags & FLAG_QR:
+            return
+
+        del self.pending[key]
+
+        if not future.done():
+            future.set_result(message)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        for future, _, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(DNSError("socket closed"))
+
+        self.pending.clear()
+
+    def new_id(self, address: Tuple[str, int]) -> int:
+        while True:
+            qid = random.getrandbits(16)
+
+            if (address, qid) not in self.pending:
+                return qid
+
+
+class DNSEngine:
+    """Pipelined DNS client.
+
+    Thousands of queries can be outstanding at the same time over a small
+    pool of UDP sockets. Queries are sent round robin to the name servers,
+    each one with its own rate limit ('rate' queries per second, 0 means no
+    limit). Unanswered queries are retried on the next server and truncated
+    answers are repeated over TCP.
+    """
+
+    def __init__(self,
+                 nameservers: List[str] = None,
+                 sockets: int = 4,
+                 rate: float = 0,
+                 timeout: float = 2,
+                 retries: int = 2,
+                 max_outstanding: int = 2048):
+        nameservers = nameservers or system_nameservers() or ["8.8.8.8"]
+
+        self.servers = [
+            _NameServer(parse_nameserver(n), rate) for n in nameservers
+        ]
+        self.sockets_per_family = max(sockets, 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.max_outstanding = max_outstanding
+
+        self._sockets: Dict[int, List[_UDPSocket]] = {}
+        self._sockets_lock = asyncio.Lock()
+        self._outstanding = asyncio.Semaphore(max_outstanding)
+        self._next_server = 0
+        self._next_socket = 0
+
+        self.queries = 0
+        self.failures = 0
+
+    async def _udp_sockets(self, family: int) -> List[_UDPSocket]:
+        try:
+            return self._sockets[family]
+        except KeyError:
+            pass
+
+        async with self._sockets_lock:
+            if family not in self._sockets:
+                loop = asyncio.get_running_loop()
+                local = "::" if family == socket.AF_INET6 else "0.0.0.0"
+                sockets = []
+
+                for _ in range(self.sockets_per_family):
+                    sock = socket.socket(family, socket.SOCK_DGRAM)
+                    sock.bind((local, 0))
+
+                    # Room for the answers of a burst of queries
+                    try:
+                        sock.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_RCVBUF,
+                                        SOCKET_BUFFER_SIZE)
+                    except OSError:
+                        pass
+
+                    _, protocol = await loop.create_datagram_endpoint(
+                        _UDPSocket,
+                        sock=sock
+                    )
+                    sockets.append(protocol)
+
+                self._sockets[family] = sockets
+
+        return self._sockets[family]
+
+    def _pick_server(self) -> _NameServer:
+        server = self.servers[self._next_server % len(self.servers)]
+        self._next_server += 1
+
+        return server
+
+    async def _query_udp(self,
+                         server: _NameServer,
+                         name: str,
+                         qtype: int) -> DNSMessage:
+        sockets = await self._udp_sockets(server.family)
+        udp = sockets[self._next_socket % len(sockets)]
+        self._next_socket += 1
+
+        address = server.address
+        qid = udp.new_id(address)
+        key = (address, qid)
+        future = asyncio.get_running_loop().create_future()
+
+        udp.pending[key] = (future, name, qtype)
+
+        try:
+            udp.transport.sendto(encode_query(qid, name, qtype), address)
+            server.sent += 1
+
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            udp.pending.pop(key, None)
+
+    async def _query_tcp(self,
+                         server: _NameServer,
+                         name: str,
+                         qtype: int) -> DNSMessage:
+        qid = random.getrandbits(16)
+        query = encode_query(qid, name, qtype)
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*server.address), self.timeout
+        )
+
+        try:
+            writer.write(struct.pack("!H", len(query)) + query)
+
+            length, = struct.unpack(
+                "!H", await asyncio.wait_for(reader.readexactly(2),
+                                             self.timeout)
+            )
+            message = decode_response(await asyncio.wait_for(
+                reader.readexactly(length), self.timeout
+            ))
+        finally:
+            writer.close()
+
+        if message.qid != qid or message.question != (name, qtype):
+            raise DNSError(f"unexpected TCP response for '{name}'")
+
+        return message
+
+    async def query(self, name: str, qtype: int) -> DNSMessage:
+        """Resolve 'name'. NXDOMAIN and empty answers are returned as
+        messages, not raised"""
+        try:
+            name = name.rstrip(".").lower().encode("idna").decode("ascii")
+        except UnicodeError:
+            raise DNSError(f"invalid domain name '{name}'")
+
+        self.queries += 1
+
+        async with self._outstanding:
+            error = None
+
+            for _ in range(self.retries + 1):
+                server = self._pick_server()
+
+                if server.bucket:
+                    await server.bucket.take()
+
+                try:
+                    message = await self._query_udp(server, name, qtype)
+
+                    if message.truncated:
+                        server.truncated += 1
+                        message = await self._query_tcp(server, name, qtype)
+
+                except asyncio.TimeoutError:
+                    server.timeouts += 1
+                    error = DNSError(f"timeout resolving '{name}'")
+                    continue
+                except (OSError, DNSError) as e:
+                    error = e
+                    continue
+
+                if message.rcode in (RCODE_SERVFAIL, RCODE_REFUSED):
+                    error = DNSError(f"server {server.address[0]} "
+                                     f"failed resolving '{name}'")
+                    continue
+
+                return message
+
+            self.failures += 1
+
+            raise error
+
+    def close(self):
+        for sockets in self._sockets.values():
+            for udp in sockets:
+                if udp.transport:
+                    udp.transport.close()
+
+        self._sockets.clear()
+
+    def summary(self) -> str:
+        servers = ", ".join(
+            f"{s.address[0]}:{s.address[1]} {s.sent} sent "
+            f"{s.timeouts} timeouts {s.truncated} truncated"
+            for s in self.servers
+        )
+
+        return f"[*] DNS engine: {self.queries} queries, " \
+               f"{self.failures} failed ({servers})"
+
+
+__all__ = ("DNSEngine", "DNSMessage", "DNSError", "encode_query",
+           "decode_response", "parse_nameserver")
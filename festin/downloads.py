@@ -0,0 +1,238 @@
+import time
+import heapq
+import asyncio
+import argparse
+import itertools
+
+from typing import Callable, Dict, List, Tuple
+
+from .session import http_get
+from .scheduler import TokenBucket
+from .s3 import read_indexable_content, S3Object, DOWNLOAD_TIMEOUT
+from .manifest import ObjectManifest, UNCHANGED, CHANGED
+
+# Extensions of objects that usually have interesting text. Downloaded
+# before the rest of objects
+TEXT_EXTENSIONS = frozenset((
+    "txt", "csv", "json", "xml", "yml", "yaml", "log", "conf", "cfg", "ini",
+    "env", "sql", "md", "html", "htm", "js", "py", "sh", "properties"
+))
+
+UNKNOWN_SIZE = 1 << 62
+
+
+def download_priority(key: str, size: int) -> Tuple[int, int]:
+    """Lower is first: text files, then smaller objects"""
+    name = key.rsplit("/", 1)[-1]
+    extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+
+    return (
+        0 if extension in TEXT_EXTENSIONS else 1,
+        size if size >= 0 else UNKNOWN_SIZE
+    )
+
+
+class DownloadScheduler:
+    """Downloads the objects to index of every bucket.
+
+    Objects are queued with 'submit' and downloaded by 'workers' tasks, by
+    priority (see 'download_priority'). A bucket can't use more than
+    'bucket_share' of the workers, so a big bucket doesn't stall the rest.
+    Downloads share a bandwidth limit of 'rate' bytes per second (0 means no
+    limit). When 'max_pending' objects are queued, 'submit' waits.
+
+    With a 'manifest', objects unchanged since they were indexed are
+    skipped, and changed ones replace their previous document. Indexed
+    objects are passed as the 'ack' of 'fulltext_add_fn', to be recorded
+    in the manifest when the index stores them.
+    """
+
+    def __init__(self,
+                 cli_args: argparse.Namespace,
+                 fulltext_add_fn: Callable,
+                 workers: int = 20,
+                 rate: float = 0,
+                 bucket_share: float = 0.5,
+                 max_pending: int = 10000,
+                 manifest: ObjectManifest = None):
+        self.cli_args = cli_args
+        self.metrics = cli_args.metrics
+        self.fulltext_add_fn = fulltext_add_fn
+        self.manifest = manifest
+        self.bucket_limit = max(int(workers * bucket_share), 1)
+        self.throttle = TokenBucket(rate) if rate else None
+
+        self._queued: Dict[str, List[Tuple]] = {}
+        self._active: Dict[str, int] = {}
+        self._order = itertools.count()
+        self._ready = asyncio.Condition()
+        self._pending = asyncio.Semaphore(max_pending) if max_pending \
+            else None
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(workers)
+        ]
+        self.metrics.callback("festin_downloads_pending",
+                              "Objects queued or being downloaded for "
+                              "indexing",
+                              lambda: self._unfinished)
+
+        self.downloaded = 0
+        self.skipped = 0
+        self.errors = 0
+        self.bytes = 0
+
+    async def submit(self, bucket_name: str, obj: S3Object):
+        replace = False
+
+        if self.manifest:
+            status = self.manifest.status(bucket_name, obj)
+
+            if status == UNCHANGED:
+                return
+
+            replace = status == CHANGED
+
+        if self._pending:
+            await self._pending.acquire()
+
+        self._unfinished += 1
+        self._finished.clear()
+
+        heapq.heappush(
+            self._queued.setdefault(bucket_name, []),
+            (download_priority(obj.key, obj.size),
+             next(self._order),
+             obj,
+             replace)
+        )
+
+        async with self._ready:
+            self._ready.notify()
+
+    def _pick(self) -> Tuple[str, S3Object, bool] or None:
+        """Best queued object of the buckets that don't exceed their
+        share"""
+        best = None
+
+        for bucket_name, queued in self._queued.items():
+            if self._active.get(bucket_name, 0) >= self.bucket_limit:
+                continue
+
+            if best is None or queued[0] < self._queued[best][0]:
+                best = bucket_name
+
+        if best is None:
+            return None
+
+        queued = self._queued[best]
+        _, _, obj, replace = heapq.heappop(queued)
+
+        if not queued:
+            del self._queued[best]
+
+        self._active[best] = self._active.get(best, 0) + 1
+
+        return best, obj, replace
+
+    async def _done(self, bucket_name: str):
+        self._active[bucket_name] -= 1
+
+        if not self._active[bucket_name]:
+            del self._active[bucket_name]
+
+        if self._pending:
+            self._pending.release()
+
+        self._unfinished -= 1
+
+        if not self._unfinished:
+            self._finished.set()
+
+        async with self._ready:
+            self._ready.notify()
+
+    async def _download(self,
+                        bucket_name: str,
+                        obj: S3Object,
+                        replace: bool):
+        # Objects could be big. Don't apply the probes timeout
+        async with http_get(self.cli_args,
+                            f"{bucket_name}/{obj.key}",
+                            timeout=DOWNLOAD_TIMEOUT) as response:
+
+            if not str(response.status).startswith("2"):
+                self.skipped += 1
+                self.metrics.downloads.inc("skipped")
+                return
+
+            content = await read_indexable_content(
+                response,
+                self.cli_args.index_max_size,
+                self.throttle
+            )
+
+        # Only storage non-binary files
+        if content is None:
+            self.skipped += 1
+            self.metrics.downloads.inc("skipped")
+        else:
+            self.downloaded += 1
+            self.bytes += len(content)
+            self.metrics.downloads.inc("indexed")
+            self.metrics.download_bytes.inc(amount=len(content))
+
+            await self.fulltext_add_fn(bucket_name,
+                                       obj.key,
+                                       content,
+                                       replace=replace,
+                                       ack=(bucket_name, obj))
+            return
+
+        if self.manifest:
+            self.manifest.update(bucket_name, obj)
+
+    async def _worker(self):
+        while True:
+            async with self._ready:
+                while (job := self._pick()) is None:
+                    await self._ready.wait()
+
+            bucket_name, obj, replace = job
+            started = time.monotonic()
+
+            try:
+                await self._download(bucket_name, obj, replace)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                self.metrics.downloads.inc("error")
+
+                if self.cli_args.debug:
+                    print(f"    !> Download error of "
+                          f"'{bucket_name}/{obj.key}': {str(e)}")
+            finally:
+                self.metrics.download_seconds.observe(
+                    time.monotonic() - started
+                )
+                await self._done(bucket_name)
+
+    async def join(self):
+        """Wait until every queued object is downloaded"""
+        await self._finished.wait()
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+
+    def summary(self) -> str:
+        return f"[*] Downloads: {self.downloaded} objects indexed " \
+               f"({self.bytes // 1024} KB), {self.skipped} skipped, " \
+               f"{self.errors} errors"
+
+
+__all__ = ("DownloadScheduler", "download_priority")
@@ -1,14 +1,13 @@
-import json
+import time
 import asyncio
 import argparse
 
-from typing import List, Tuple
-from functools import partial
-
-import aiofiles
+from typing import Callable, List, Set, Tuple
 
 from .s3 import download_s3_objects, S3Bucket
-from .redis import redis_create_connection, redis_add_document
+from .sinks import DomainWriter
+from .state import result_record
+from .queues import BoundedQueue
 
 STOP_KEYWORD = "########STOP########"
 
@@ -29,20 +28,36 @@ async def on_result_print_results(cli_args, bucket):
 
 
 async def on_result_save_streaming_results(cli_args, bucket):
-    async with aiofiles.open(cli_args.result_file, mode='a+') as f:
-        await f.write(f"{json.dumps(bucket.__dict__)}\n")
+    await cli_args.results_writer.write(bucket.iter_json(),
+                                        ack=result_record(bucket))
 
 
 async def on_domain_save_new_domains(cli_args,
                                      domain: str,
-                                     file_name: str,
-                                     initial_domains: List[str]):
+                                     writer: DomainWriter,
+                                     initial_domains: Set[str]):
 
     if initial_domains and domain in initial_domains:
         return
 
-    async with aiofiles.open(file_name, mode='a+') as f:
-        await f.write(f"{domain}\n")
+    await writer.write(domain)
+
+
+async def on_result_send_to_coordinator(cli_args, bucket):
+    """Results of a worker of a multi-process crawl are written by the
+    coordinator"""
+    cli_args.shard.send(("result", bucket))
+
+
+async def on_domain_send_to_coordinator(cli_args,
+                                        domain: str,
+                                        kind: str,
+                                        initial_domains: Set[str]):
+    cli_args.shard.send(("domain", kind, domain))
+
+
+async def on_result_add_to_cluster(cli_args, bucket):
+    await cli_args.cluster.add_result(bucket)
 
 
 async def on_results_add_to_redis(
@@ -50,17 +65,14 @@ async def on_results_add_to_redis(
         bucket: S3Bucket):
 
     print(f"    >> Indexing content for '{bucket.domain}'")
-    redis_con = await redis_create_connection(cli_args.index_server)
 
-    fulltext_add_fn = partial(redis_add_document, redis_con)
-
-    await download_s3_objects(bucket, fulltext_add_fn)
+    await download_s3_objects(cli_args, bucket)
 
 
 
 async def on_domain_event(cli_args,
                           domain_queue: asyncio.Queue,
-                          initial_domains: List or None,
+                          initial_domains: Set[str] or None,
                           consumers: List[Tuple]):
     while True:
 
@@ -69,25 +81,155 @@ async def on_domain_event(cli_args,
         if domain == STOP_KEYWORD:
             break
 
-        for fn, filename in consumers:
-            await fn(cli_args, domain, filename, initial_domains)
+        for fn, writer in consumers:
+            await fn(cli_args, domain, writer, initial_domains)
+
+
+class ResultConsumer:
+    """Runs a result consumer in its own worker tasks, fed by its own
+    bounded queue, so a slow consumer doesn't delay the rest.
+
+    When the queue is full, 'policy' decides what to do with new results:
+    "block" waits for room, "drop" discards them and "spill" writes them to
+    disk. Lag is the time that results wait in the queue.
+    """
+
+    def __init__(self,
+                 cli_args: argparse.Namespace,
+                 fn: Callable,
+                 workers: int = 1,
+                 maxsize: int = 0,
+                 policy: str = "block"):
+        self.cli_args = cli_args
+        self.fn = fn
+        self.name = fn.__name__
+        self.policy = policy
+        self.queue = BoundedQueue(maxsize,
+                                  spill=policy == "spill",
+                                  name=f"results -> {self.name}")
+        self.metrics = cli_args.metrics
+        self.metrics.add_queue(self.queue)
+
+        self.workers = [
+            asyncio.create_task(self._worker()) for _ in range(workers)
+        ]
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.lag = 0
+        self.max_lag = 0
+        self.total_lag = 0
+
+    async def put(self, bucket: S3Bucket):
+        if self.policy == "drop" and self.queue.full():
+            self.dropped += 1
+            self.metrics.results.inc(self.name, "dropped")
+            return
+
+        await self.queue.put((time.monotonic(), bucket))
+
+    async def _worker(self):
+        while True:
+            queued_at, bucket = await self.queue.get()
+
+            self.lag = time.monotonic() - queued_at
+            self.max_lag = max(self.max_lag, self.lag)
+            self.total_lag += self.lag
+            self.metrics.result_lag_seconds.observe(self.lag, self.name)
+
+            started = time.monotonic()
+
+            try:
+                await self.fn(self.cli_args, bucket)
+                self.metrics.results.inc(self.name, "ok")
+            except Exception as e:
+                self.errors += 1
+                self.metrics.results.inc(self.name, "error")
+                print(f"    !> Error in '{self.name}': {str(e)}")
+            finally:
+                self.processed += 1
+                self.metrics.result_seconds.observe(
+                    time.monotonic() - started, self.name
+                )
+                self.queue.task_done()
+
+    async def join(self):
+        """Wait for the queued results and stop the workers"""
+        await self.queue.join()
+
+        for worker in self.workers:
+            worker.cancel()
+
+    def summary(self) -> str:
+        average = self.total_lag / self.processed if self.processed else 0
+
+        message = f"[*] Consumer '{self.name}': {self.processed} results, " \
+                  f"lag avg {average:.2f}s max {self.max_lag:.2f}s, " \
+                  f"queue high-water mark {self.queue.high_water}"
+
+        if self.dropped:
+            message += f", {self.dropped} dropped"
+
+        if self.queue.spilled:
+            message += f", {self.queue.spilled} spilled to disk"
+
+        if self.errors:
+            message += f", {self.errors} errors"
+
+        return message
 
 
 async def on_result_event(cli_args,
                           results_queue: asyncio.Queue,
                           consumers: List):
 
+    #
+    # Each consumer runs in its own workers. The results file is always
+    # written in order and nothing is dropped from it, neither from the
+    # results sent to the coordinator of a multi-process crawl or to the
+    # cluster
+    #
+    result_consumers = [
+        ResultConsumer(
+            cli_args,
+            c,
+            workers=1 if c is on_result_save_streaming_results
+            else cli_args.result_workers,
+            maxsize=cli_args.queue_size,
+            policy="block" if c in (on_result_save_streaming_results,
+                                    on_result_send_to_coordinator,
+                                    on_result_add_to_cluster)
+            else cli_args.result_policy
+        )
+        for c in consumers
+    ]
+
+    cli_args.result_consumers = result_consumers
+
     while True:
 
         bucket = await results_queue.get()
 
         if bucket == STOP_KEYWORD:
-            return
+            break
+
+        # Skip buckets already emitted, also by the resumed crawl. They're
+        # checkpointed when the results file writes them
+        if cli_args.crawl_state and \
+                not cli_args.crawl_state.claim_result(bucket):
+            continue
+
+        # In order: a consumer that blocks delays the ones after it
+        for c in result_consumers:
+            await c.put(bucket)
 
-        for c in consumers:
-            await c(cli_args, bucket)
+    for c in result_consumers:
+        await c.join()
 
 
 __all__ = ("on_result_event", "on_domain_event", "on_domain_save_new_domains",
            "on_result_print_results", "on_result_save_streaming_results",
-           "on_results_add_to_redis", "STOP_KEYWORD")
+           "on_results_add_to_redis", "on_result_send_to_coordinator",
+           "on_domain_send_to_coordinator", "on_result_add_to_cluster",
+           "ResultConsumer", "STOP_KEYWORD")
@@ -0,0 +1,117 @@
+import asyncio
+import argparse
+
+from typing import List, AsyncIterator
+
+import aiohttp
+
+from lxml import etree
+
+CHUNK_SIZE = 16384
+
+
+class LinkCollector:
+    """lxml parser target that only keeps 'href' and 'src' attributes, so
+    no tree is built"""
+
+    def __init__(self):
+        self.links = []
+
+    def start(self, tag, attrib):
+        if href := attrib.get("href"):
+            self.links.append(href)
+
+        if src := attrib.get("src"):
+            self.links.append(src)
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.links
+
+    def pop_links(self) -> List[str]:
+        links = self.links
+        self.links = []
+
+        return links
+
+
+def parse_links(content: bytes) -> List[str]:
+    """Parse a whole HTML document and return its links. It runs in worker
+    processes"""
+    parser = etree.HTMLParser(target=LinkCollector())
+    parser.feed(content)
+
+    return parser.close()
+
+
+async def read_content(response: aiohttp.ClientResponse,
+                       max_size: int) -> bytes:
+    """Read a response body up to 'max_size' bytes"""
+    chunks = []
+    size = 0
+
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+
+        if max_size and size >= max_size:
+            break
+
+    return b"".join(chunks)[:max_size or None]
+
+
+async def iter_links(cli_args: argparse.Namespace,
+                     response: aiohttp.ClientResponse) -> AsyncIterator[str]:
+    """Yield links of an HTML response while it's downloaded.
+
+    At most '--http-max-page-size' bytes are read. If a parsing pool is
+    configured the document is parsed in it, otherwise chunks are fed to an
+    incremental parser as they arrive.
+    """
+    max_size = cli_args.http_max_page_size
+
+    if cli_args.parse_pool:
+        content = await read_content(response, max_size)
+
+        if not content:
+            return
+
+        links = await asyncio.get_running_loop().run_in_executor(
+            cli_args.parse_pool, parse_links, content
+        )
+
+        for link in links:
+            yield link
+
+        return
+
+    collector = LinkCollector()
+    parser = etree.HTMLParser(target=collector)
+    size = 0
+
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        if max_size:
+            chunk = chunk[:max_size - size]
+
+        size += len(chunk)
+        parser.feed(chunk)
+
+        for link in collector.pop_links():
+            yield link
+
+        if max_size and size >= max_size:
+            break
+
+    if size:
+        parser.close()
+
+        for link in collector.pop_links():
+            yield link
+
+
+__all__ = ("iter_links", "read_content", "parse_links")
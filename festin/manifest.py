@@ -0,0 +1,110 @@
+import time
+import asyncio
+import sqlite3
+
+from typing import Iterable, Tuple
+
+from .s3 import S3Object
+
+#
+# Status of a listed object compared with the manifest
+#
+NEW = 0
+CHANGED = 1
+UNCHANGED = 2
+
+
+class ObjectManifest:
+    """Objects already indexed, stored in a SQLite database that persists
+    between runs.
+
+    Objects are compared by ETag or, when the provider doesn't return it, by
+    size and last modified date. Unchanged objects don't need to be
+    downloaded again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket_name TEXT,
+                key TEXT,
+                etag TEXT,
+                size INTEGER,
+                last_modified INTEGER,
+                indexed_at INTEGER,
+                PRIMARY KEY (bucket_name, key)
+            );
+        """)
+        self.connection.commit()
+
+        self.unchanged = 0
+        self.changed = 0
+        self.new = 0
+
+    def status(self, bucket_name: str, obj: S3Object) -> int:
+        row = self.connection.execute(
+            "SELECT etag, size, last_modified FROM objects "
+            "WHERE bucket_name = ? AND key = ?",
+            (bucket_name, obj.key)
+        ).fetchone()
+
+        if row is None:
+            self.new += 1
+            return NEW
+
+        etag, size, last_modified = row
+
+        if etag and obj.etag:
+            same = etag == obj.etag
+        else:
+            same = obj.size >= 0 and \
+                   size == obj.size and \
+                   last_modified == obj.last_modified
+
+        if same:
+            self.unchanged += 1
+            return UNCHANGED
+        else:
+            self.changed += 1
+            return CHANGED
+
+    def update(self, bucket_name: str, obj: S3Object):
+        """Record an object as indexed, or discarded for indexing"""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+            (bucket_name, obj.key, obj.etag, obj.size, obj.last_modified,
+             int(time.time()))
+        )
+
+    def update_many(self, objects: Iterable[Tuple[str, S3Object]]):
+        """Record (bucket name, object) pairs as indexed"""
+        now = int(time.time())
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+            ((bucket_name, obj.key, obj.etag, obj.size, obj.last_modified,
+              now) for bucket_name, obj in objects)
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    async def checkpoint(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.commit()
+
+    def summary(self) -> str:
+        return f"[*] Index manifest: {self.new} new objects, " \
+               f"{self.changed} changed, {self.unchanged} unchanged"
+
+
+__all__ = ("ObjectManifest",)
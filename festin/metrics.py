@@ -0,0 +1,360 @@
+import time
+import bisect
+import asyncio
+
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+def _labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter, with a value for each combination of labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self.values.get(label_values, 0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self) -> Iterator[str]:
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    """Distribution of observed values, with a count of values in each
+    bucket, for each combination of labels"""
+
+    kind = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+        # Per labels: [bucket counts..., +Inf count, sum]
+        self.values: Dict[tuple, List[float]] = {}
+
+    def observe(self, value: float, *label_values):
+        try:
+            counts = self.values[label_values]
+        except KeyError:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, *label_values) -> int:
+        counts = self.values.get(label_values)
+
+        return sum(counts[:-1]) if counts else 0
+
+    def mean(self, *label_values) -> float:
+        counts = self.values.get(label_values)
+
+        return counts[-1] / sum(counts[:-1]) if counts else 0
+
+    def samples(self) -> Iterator[str]:
+        for label_values, counts in sorted(self.values.items()):
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _labels(self.labels, label_values, f'le="{bound}"')
+
+                yield f"{self.name}_bucket{labels} {cumulative}"
+
+            labels = _labels(self.labels, label_values)
+
+            yield f"{self.name}_sum{labels} {counts[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric:
+    """Metric whose value is taken from a function when it's collected, for
+    values already tracked elsewhere, like HTTP connections. With 'labels'
+    the function returns a dict of {label values: value}"""
+
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 kind: str,
+                 fn: Callable,
+                 labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.labels = labels
+
+    def value(self) -> float:
+        value = self.fn()
+
+        return sum(value.values()) if self.labels else value
+
+    def samples(self) -> Iterator[str]:
+        if not self.labels:
+            yield f"{self.name} {self.fn()}"
+            return
+
+        for label_values, value in self.fn().items():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Stage:
+    """Duration and outcome of a probe. Outcome is "ok" unless it's changed
+    before 'finish' is called. Used as a context manager, exceptions set
+    the outcome to "timeout" or "error" """
+
+    __slots__ = ("metrics", "name", "outcome", "started")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+        self.outcome = "ok"
+        self.started = time.monotonic()
+
+    def finish(self, outcome: str = None):
+        if outcome:
+            self.outcome = outcome
+
+        self.metrics.probes.inc(self.name, self.outcome)
+        self.metrics.probe_seconds.observe(time.monotonic() - self.started,
+                                           self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is asyncio.TimeoutError:
+            self.outcome = "timeout"
+        elif exc_type is not None:
+            self.outcome = "error"
+
+        self.finish()
+
+
+class Metrics:
+    """Metrics of a run. Exposed in Prometheus text format by 'serve' and as
+    a one line summary by 'report'"""
+
+    def __init__(self):
+        self._metrics = []
+        self._queues = []
+
+        self.probes = self.counter(
+            "festin_probes_total",
+            "Probes by stage and outcome",
+            ("stage", "outcome")
+        )
+        self.probe_seconds = self.histogram(
+            "festin_probe_seconds",
+            "Duration of probes by stage",
+            ("stage",)
+        )
+        self.domains = self.counter(
+            "festin_domains_total",
+            "Domains taken from the frontier by outcome",
+            ("outcome",)
+        )
+        self.slot_wait_seconds = self.histogram(
+            "festin_slot_wait_seconds",
+            "Time waiting for a free concurrency slot before analyzing a "
+            "domain"
+        )
+        self.results = self.counter(
+            "festin_results_total",
+            "Results handled by each consumer, by outcome",
+            ("consumer", "outcome")
+        )
+        self.result_seconds = self.histogram(
+            "festin_result_seconds",
+            "Duration of the handling of a result by each consumer",
+            ("consumer",)
+        )
+        self.result_lag_seconds = self.histogram(
+            "festin_result_lag_seconds",
+            "Time that results wait in the queue of each consumer",
+            ("consumer",)
+        )
+        self.downloads = self.counter(
+            "festin_downloads_total",
+            "Downloads of objects to index by outcome",
+            ("outcome",)
+        )
+        self.download_bytes = self.counter(
+            "festin_download_bytes_total",
+            "Bytes of the downloaded objects to index"
+        )
+        self.download_seconds = self.histogram(
+            "festin_download_seconds",
+            "Duration of downloads of objects to index"
+        )
+        self.callback(
+            "festin_queue_size",
+            "Items waiting in each internal queue",
+            lambda: {(q.name,): q.qsize() for q in self._queues},
+            labels=("queue",)
+        )
+        self.callback(
+            "festin_queue_high_water",
+            "Max items that each internal queue had",
+            lambda: {(q.name,): q.high_water for q in self._queues},
+            labels=("queue",)
+        )
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+
+        return metric
+
+    def histogram(self, name: str, help: str, labels=()) -> Histogram:
+        metric = Histogram(name, help, labels)
+        self._metrics.append(metric)
+
+        return metric
+
+    def callback(self, name: str, help: str, fn: Callable,
+                 kind: str = "gauge", labels=()) -> CallbackMetric:
+        metric = CallbackMetric(name, help, kind, fn, labels)
+        self._metrics.append(metric)
+
+        return metric
+
+    def add_queue(self, queue):
+        """Report the size of a 'BoundedQueue'"""
+        self._queues.append(queue)
+
+    def queue_size(self, name: str) -> int:
+        return sum(q.qsize() for q in self._queues if q.name == name)
+
+    def stage(self, name: str) -> Stage:
+        return Stage(self, name)
+
+    def get(self, name: str):
+        return next((m for m in self._metrics if m.name == name), None)
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Serve the metrics on 'http://host:port/metrics'"""
+
+        async def handle(reader, writer):
+            try:
+                request = (await reader.readline()).split()
+
+                # Skip the headers
+                while (await reader.readline()).strip():
+                    pass
+
+                if len(request) > 1 and request[1] == b"/metrics":
+                    status = "200 OK"
+                    body = self.render().encode("UTF-8")
+                else:
+                    status = "404 Not Found"
+                    body = b""
+
+                writer.write(
+                    f"HTTP/1.0 {status}\r\n"
+                    f"Content-Type: text/plain; version=0.0.4\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode("UTF-8")
+                    + body
+                )
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+    def _value(self, name: str) -> float:
+        metric = self.get(name)
+
+        if metric is None:
+            return 0
+
+        return metric.value() if isinstance(metric, CallbackMetric) \
+            else metric.total()
+
+    def summary(self, elapsed: float, previous: Dict[str, float]) -> str:
+        """One line summary. Rates are computed since the 'previous'
+        values, that are updated"""
+        current = {
+            "domains": self.domains.value("analyzed"),
+            "probes": self.probes.total(),
+            "bytes": self._value("festin_http_received_bytes_total")
+        }
+        rates = {
+            key: (value - previous.get(key, 0)) / elapsed if elapsed else 0
+            for key, value in current.items()
+        }
+        previous.update(current)
+
+        errors = found = 0
+
+        for (_, outcome), value in self.probes.values.items():
+            if outcome == "found":
+                found += value
+            elif outcome != "ok":
+                errors += value
+
+        return f"[*] Stats: {current['domains']:.0f} domains analyzed " \
+               f"({rates['domains']:.1f}/s), " \
+               f"{current['probes']:.0f} probes " \
+               f"({rates['probes']:.1f}/s, {errors:.0f} failed), " \
+               f"frontier {self.queue_size('frontier')}, " \
+               f"{found:.0f} buckets found, " \
+               f"{rates['bytes'] / 1024:.0f} KB/s received, " \
+               f"slot wait avg {self.slot_wait_seconds.mean():.2f}s"
+
+    async def report(self, interval: float):
+        """Print the summary every 'interval' seconds"""
+        previous = {}
+        last = time.monotonic()
+
+        while True:
+            await asyncio.sleep(interval)
+
+            now = time.monotonic()
+            print(self.summary(now - last, previous), flush=True)
+            last = now
+
+
+__all__ = ("Metrics", "Counter", "Histogram", "CallbackMetric", "Stage")
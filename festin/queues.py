@@ -0,0 +1,180 @@
+import pickle
+import asyncio
+import tempfile
+import contextvars
+
+from typing import Callable
+
+from .state import CrawlState
+
+#
+# Set in the tasks that analyze domains
+#
+IN_ANALYSIS = contextvars.ContextVar("festin_in_analysis", default=False)
+
+
+class BoundedQueue(asyncio.Queue):
+    """Queue with a max size that tracks its high-water mark.
+
+    When 'spill' is set, items that don't fit in memory are written to a
+    temporary file instead of making producers wait, and are read back in
+    order as the queue drains.
+    """
+
+    def __init__(self, maxsize: int = 0, spill: bool = False, name: str = ""):
+        super().__init__(maxsize)
+        self.name = name
+        self.spill = spill and maxsize > 0
+        self.high_water = 0
+        self.spilled = 0
+
+        self._spill_file = None
+        self._spill_pending = 0
+        self._spill_read_pos = 0
+
+    def full(self) -> bool:
+        if self.spill:
+            return False
+
+        return super().full()
+
+    def qsize(self) -> int:
+        return len(self._queue) + self._spill_pending
+
+    def _must_spill(self) -> bool:
+        return self.spill and len(self._queue) >= self.maxsize
+
+    def _put(self, item):
+        if self._must_spill():
+            self._spill_write(item)
+        else:
+            super()._put(item)
+
+        size = self.qsize()
+
+        if size > self.high_water:
+            self.high_water = size
+
+    def _get(self):
+        item = super()._get()
+
+        if self._spill_pending:
+            super()._put(self._spill_read())
+
+        return item
+
+    def _spill_write(self, item):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix="festin-")
+
+        self._spill_file.seek(0, 2)
+        pickle.dump(item, self._spill_file)
+
+        self._spill_pending += 1
+        self.spilled += 1
+
+    def _spill_read(self):
+        self._spill_file.seek(self._spill_read_pos)
+        item = pickle.load(self._spill_file)
+
+        self._spill_pending -= 1
+
+        if self._spill_pending:
+            self._spill_read_pos = self._spill_file.tell()
+        else:
+            # Reclaim the disk space
+            self._spill_file.truncate(0)
+            self._spill_read_pos = 0
+
+        return item
+
+    def summary(self) -> str:
+        message = f"[*] Queue '{self.name}': high-water mark " \
+                  f"{self.high_water}"
+
+        if self.maxsize:
+            message += f" (max size {self.maxsize})"
+
+        if self.spilled:
+            message += f", {self.spilled} items spilled to disk"
+
+        return message
+
+
+class FrontierQueue(BoundedQueue):
+    """Queue of domains waiting for analysis.
+
+    Items are tuples of (domain, recursion level). When a crawl state is
+    configured every queued item is checkpointed until 'done' is called for
+    it. 'on_put' is called with every queued item.
+
+    Only producers out of the analyses (like the initial domains) wait when
+    it's full. Domains found by the analyses are written to disk instead, as
+    with 'spill'. The analyses themselves are bounded by the concurrency
+    slots.
+    """
+
+    def __init__(self,
+                 state: CrawlState = None,
+                 on_put: Callable[[tuple], None] = None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.state = state
+        self.on_put = on_put
+
+    def _put(self, item):
+        super()._put(item)
+
+        if self.state:
+            self.state.add_frontier(*item)
+
+        if self.on_put:
+            self.on_put(item)
+
+    def _must_spill(self) -> bool:
+        #
+        # Analyses never wait for room: the consumer that drains the
+        # frontier waits for them to finish. What they find when it's full
+        # goes to disk
+        #
+        if self.maxsize and IN_ANALYSIS.get() and \
+                len(self._queue) >= self.maxsize:
+            return True
+
+        return super()._must_spill()
+
+    async def put(self, item):
+        if self.full() and IN_ANALYSIS.get():
+            return self._put_overflow(item)
+
+        await super().put(item)
+
+    def _put_overflow(self, item):
+        """Queue an item even if the queue is full"""
+        self._put(item)
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+
+    def done(self, domain, recursion_level: int, visited: bool = False):
+        """Mark a queued item as finished, even if it was skipped"""
+        if self.state:
+            self.state.frontier_done(domain, recursion_level, visited)
+
+        self.task_done()
+
+    async def wait_finished(self):
+        """Wait until every queued domain was analyzed or skipped"""
+        await self.join()
+
+    def hold(self):
+        """Keep 'join' waiting until 'release' is called. For producers that
+        haven't put their items yet"""
+        self._unfinished_tasks += 1
+        self._finished.clear()
+
+    def release(self):
+        self.task_done()
+
+
+__all__ = ("FrontierQueue", "BoundedQueue", "IN_ANALYSIS")
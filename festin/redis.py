@@ -1,16 +1,21 @@
+import asyncio
 import argparse
 import hashlib
 from functools import partial
 
+from typing import Any, Callable, List, Tuple
+
 import aioredis
 
+INDEX_NAME = "s3_index"
+
 
 async def redis_create_connection(connection_string: str):
     async def redis_create_index(connection):
         try:
             await connection.execute(
                 "FT.CREATE",
-                "s3_index",
+                INDEX_NAME,
 
                 "SCHEMA",
 
@@ -36,34 +41,156 @@ async def redis_create_connection(connection_string: str):
     return redis_con
 
 
+def redis_document_command(bucket_name: str,
+                           object_path: str,
+                           content: bytes,
+                           replace: bool = False) -> list:
+    """Build the FT.ADD command that indexes an object. With 'replace' a
+    previous document of the object is overwritten"""
+    object_id = f"{bucket_name}{object_path}".encode("utf-8")
+
+    return [
+        "FT.ADD",
+        INDEX_NAME,
+        hashlib.sha512(object_id).hexdigest(),
+        "1.0",
+        *(["REPLACE"] if replace else []),
+        "FIELDS",
+        "bucket",
+        bucket_name,
+        "filename",
+        object_path,
+        "content",
+        content
+    ]
+
+
+def _report_insertion_error(error: Exception):
+    message = str(error)
+    if "Document already exists" not in message:
+        print(f"    !> Insertion error: {message}")
+
+
 async def redis_add_document(connection,
                              bucket_name: str,
                              object_path: str,
                              content: bytes):
-    object_id = f"{bucket_name}{object_path}".encode("utf-8")
-
     try:
         await connection.execute(
-            "FT.ADD",
-            "s3_index",
-            hashlib.sha512(object_id).hexdigest(),
-            "1.0",
-            "FIELDS",
-            "bucket",
-            bucket_name,
-            "filename",
-            object_path,
-            "content",
-            content
+            *redis_document_command(bucket_name, object_path, content)
         )
     except Exception as e:
-        message = str(e)
-        if "Document already exists" not in message:
-            print(f"    !> Insertion error: {message}")
-
-
+        _report_insertion_error(e)
+
+
+class RedisIndexWriter:
+    """Batching writer of documents to the full text index.
+
+    Documents are buffered and sent in pipelines of 'batch_size' FT.ADD
+    commands, so indexing doesn't wait a round trip per object. Partial
+    batches are sent every 'flush_interval' seconds. Writers wait while a
+    full batch is being sent.
+
+    Documents are indexed when their batch is sent: 'on_indexed' is
+    called after each batch with the 'ack' values of the documents that the
+    server accepted.
+    """
+
+    def __init__(self,
+                 connection,
+                 batch_size: int = 100,
+                 flush_interval: float = 1,
+                 on_indexed: Callable[[List[Any]], None] = None):
+        self.connection = connection
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.on_indexed = on_indexed
+
+        self._pending: List[Tuple[list, Any]] = []
+        self._lock = asyncio.Lock()
+        self._closing = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+        self.documents = 0
+        self.batches = 0
+        self.errors = 0
+
+    async def add(self,
+                  bucket_name: str,
+                  object_path: str,
+                  content: bytes,
+                  replace: bool = False,
+                  ack: Any = None):
+        self._pending.append((
+            redis_document_command(bucket_name, object_path, content, replace),
+            ack
+        ))
+
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            batch, self._pending = self._pending, []
+
+            if not batch:
+                return
+
+            try:
+                # Commands of a connection are pipelined: they're written
+                # without waiting for the replies of the previous ones
+                async with self.connection.connection.get() as connection:
+                    results = await asyncio.gather(*[
+                        connection.execute(*command) for command, _ in batch
+                    ], return_exceptions=True)
+            except Exception as e:
+                self.errors += len(batch)
+                print(f"    !> Insertion error: {str(e)}")
+                return
+
+            self.batches += 1
+            self.documents += len(batch)
+
+            acknowledged = []
+
+            for (_, ack), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.errors += 1
+                    _report_insertion_error(result)
+
+                    if "Document already exists" not in str(result):
+                        continue
+
+                if ack is not None:
+                    acknowledged.append(ack)
+
+            if self.on_indexed and acknowledged:
+                self.on_indexed(acknowledged)
+
+    async def _flush_periodically(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    async def close(self):
+        # Cancelling the flusher could drop the batch that it's sending.
+        # Let it finish and send what's left
+        self._closing.set()
 
+        try:
+            await self._flusher
+            await self.flush()
+        finally:
+            self.connection.close()
+            await self.connection.wait_closed()
 
+    def summary(self) -> str:
+        return f"[*] Full text index: {self.documents} documents sent in " \
+               f"{self.batches} batches, {self.errors} errors"
 
 
-__all__ = ("redis_add_document", "redis_create_connection")
+__all__ = ("redis_add_document", "redis_create_connection",
+           "redis_document_command", "RedisIndexWriter")
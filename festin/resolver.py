@@ -0,0 +1,220 @@
+import time
+import asyncio
+
+from typing import Dict, List, Set, Tuple
+from functools import partial
+from collections import OrderedDict
+
+from async_dns.core import types, CacheNode
+from async_dns.resolver import ProxyResolver
+
+
+class NoCache(CacheNode):
+    """Cache of the async_dns resolver that doesn't keep anything. Its own
+    cache is never pruned, and answers are already cached (bounded) by
+    CachingResolver"""
+
+    def add(self, *args, **kwargs):
+        pass
+
+
+class DNSAnswer:
+    """Record of a DNS answer"""
+
+    __slots__ = ("name", "qtype", "data", "ttl")
+
+    def __init__(self, name: str, qtype: int, data: str, ttl: int):
+        self.name = name
+        self.qtype = qtype
+        self.data = data
+        self.ttl = ttl
+
+
+class CachingResolver:
+    """DNS resolver shared by the whole run.
+
+    Answers are cached for the TTL of their records (up to 'max_ttl').
+    Names without records (like NXDOMAIN) are cached for the TTL of the SOA
+    record of the response, or 'negative_ttl' if it's missing. Up to
+    'max_entries' names are cached (0 for no limit): the least recently
+    used ones are evicted first, expired or not. Concurrent queries for the
+    same name and type are sent only once.
+
+    Queries are sent by 'engine' (a DNSEngine) when it's given. Names can be
+    prefetched in background with 'prefetch', using up to
+    'prefetch_workers' concurrent queries. Up to 'prefetch_pending' names
+    wait for them; more are ignored.
+    """
+
+    def __init__(self,
+                 nameservers: List[str] = None,
+                 negative_ttl: int = 300,
+                 max_ttl: int = 86400,
+                 max_entries: int = 100000,
+                 engine=None,
+                 prefetch_workers: int = 0,
+                 prefetch_pending: int = 10000):
+        self.engine = engine
+
+        if engine:
+            self.resolver = None
+        elif nameservers:
+            self.resolver = ProxyResolver(cache=NoCache(),
+                                          proxies=[(None, nameservers)])
+        else:
+            self.resolver = ProxyResolver(cache=NoCache())
+
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+
+        self._cache: Dict[Tuple[str, int], Tuple[float, List[DNSAnswer]]] = \
+            OrderedDict()
+        self._in_flight: Dict[Tuple[str, int], asyncio.Future] = {}
+
+        self._prefetch = asyncio.Queue(prefetch_pending)
+        self._prefetch_pending: Set[Tuple[str, int]] = set()
+        self._prefetch_workers = [
+            asyncio.create_task(self._prefetch_worker())
+            for _ in range(prefetch_workers)
+        ]
+
+        self.queries = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.shared = 0
+        self.prefetched = 0
+        self.evicted = 0
+
+    async def _request(self, name: str, qtype: int):
+        """Send the query to the name servers. Returns the DNS message"""
+        if self.engine:
+            return await self.engine.query(name, qtype)
+
+        response = await self.resolver.query(name, qtype)
+
+        # async_dns >= 2 returns a tuple of (message, from cache)
+        if isinstance(response, tuple):
+            response = response[0]
+
+        return response
+
+    async def _resolve(self, name: str, qtype: int) -> List[DNSAnswer]:
+        response = await self._request(name, qtype)
+
+        answers = [
+            DNSAnswer(
+                name=str(record.name),
+                qtype=record.qtype,
+                data=str(getattr(record.data, "data", record.data)),
+                ttl=record.ttl
+            )
+            for record in response.an
+        ]
+
+        if answers:
+            ttl = min(a.ttl for a in answers)
+        else:
+            ttl = self.negative_ttl
+
+            for record in getattr(response, "ns", []):
+                if record.qtype == types.SOA:
+                    ttl = record.ttl
+
+        self._cache[(name, qtype)] = (
+            time.monotonic() + min(ttl, self.max_ttl),
+            answers
+        )
+
+        if self.max_entries and len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.evicted += 1
+
+        return answers
+
+    def _forget(self, key: Tuple[str, int], task: asyncio.Future):
+        self._in_flight.pop(key, None)
+
+        # Errors are raised to the waiters. Avoid 'never retrieved' warnings
+        if not task.cancelled():
+            task.exception()
+
+    async def query(self, name: str, qtype: int) -> List[DNSAnswer]:
+        key = (name, qtype)
+
+        self.queries += 1
+
+        try:
+            expires, answers = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            if expires > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+
+                if not answers:
+                    self.negative_hits += 1
+
+                return answers
+            else:
+                del self._cache[key]
+
+        try:
+            task = self._in_flight[key]
+            self.shared += 1
+        except KeyError:
+            task = asyncio.ensure_future(self._resolve(name, qtype))
+            task.add_done_callback(partial(self._forget, key))
+            self._in_flight[key] = task
+
+        return await asyncio.shield(task)
+
+    def prefetch(self, name: str, qtype: int):
+        """Resolve 'name' in background so later queries hit the cache.
+        Does nothing without prefetch workers"""
+        key = (name, qtype)
+
+        if not self._prefetch_workers or key in self._cache or \
+                key in self._in_flight or key in self._prefetch_pending:
+            return
+
+        try:
+            self._prefetch.put_nowait(key)
+        except asyncio.QueueFull:
+            return
+
+        self._prefetch_pending.add(key)
+
+    async def _prefetch_worker(self):
+        while True:
+            key = await self._prefetch.get()
+            self.prefetched += 1
+
+            try:
+                await self.query(*key)
+            except Exception:
+                # Reported when the name is queried again
+                pass
+            finally:
+                self._prefetch_pending.discard(key)
+
+    def close(self):
+        for worker in self._prefetch_workers:
+            worker.cancel()
+
+        if self.engine:
+            self.engine.close()
+
+    def summary(self) -> str:
+        hit_rate = self.hits / self.queries if self.queries else 0
+
+        return f"[*] DNS cache: {self.queries} queries, " \
+               f"{self.hits} cache hits ({hit_rate:.1%}), " \
+               f"{self.negative_hits} negative hits, " \
+               f"{self.shared} shared in-flight queries, " \
+               f"{self.prefetched} prefetched, " \
+               f"{self.evicted} evicted"
+
+
+__all__ = ("CachingResolver", "DNSAnswer")
@@ -0,0 +1,116 @@
+from typing import Iterable
+
+#
+# Flags stored in trie nodes. The key 'None' never collides with a label
+#
+MATCH_SELF = 1
+MATCH_SUBDOMAINS = 2
+
+
+def normalize_domain(domain: str) -> str:
+    """Lower case a domain or netloc, removing credentials, port and the
+    trailing dot"""
+    domain = domain.strip().lower()
+
+    if "@" in domain:
+        domain = domain.rsplit("@", 1)[1]
+
+    if not domain.startswith("["):
+        domain = domain.split(":", 1)[0]
+
+    return domain.rstrip(".")
+
+
+class DomainRules:
+    """Set of domain rules compiled for O(labels) lookups.
+
+    Supported rules:
+
+    - 'word': any domain with a label equal to the word ('cdn' matches
+      'cdn.mydomain.com')
+    - 'mydomain.com': only this domain
+    - '.mydomain.com': the domain and all of its subdomains
+    - '*.mydomain.com': only subdomains of the domain
+
+    Suffix rules are stored in a trie of reversed labels, so
+    'notgoogle.com' doesn't match a '.google.com' rule.
+    """
+
+    def __init__(self, rules: Iterable[str] = ()):
+        self._exact = set()
+        self._labels = set()
+        self._trie = {}
+        self._size = 0
+
+        for rule in rules:
+            self.add(rule)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, domain: str) -> bool:
+        return self.match(domain)
+
+    def add(self, rule: str):
+        rule = rule.strip()
+
+        if not rule or rule.startswith("#"):
+            return
+
+        if rule.startswith("*."):
+            self.add_suffix(rule[2:], include_self=False)
+        elif rule.startswith("."):
+            self.add_suffix(rule[1:])
+        elif "." in rule:
+            self.add_exact(rule)
+        else:
+            self._labels.add(rule.lower())
+            self._size += 1
+
+    def add_exact(self, domain: str):
+        self._exact.add(normalize_domain(domain))
+        self._size += 1
+
+    def add_suffix(self, domain: str, include_self: bool = True):
+        node = self._trie
+
+        for label in reversed(normalize_domain(domain).split(".")):
+            node = node.setdefault(label, {})
+
+        flags = MATCH_SUBDOMAINS | (MATCH_SELF if include_self else 0)
+        node[None] = node.get(None, 0) | flags
+        self._size += 1
+
+    def match(self, domain: str) -> bool:
+        domain = normalize_domain(domain)
+
+        if domain in self._exact:
+            return True
+
+        labels = domain.split(".")
+
+        if self._labels and not self._labels.isdisjoint(labels):
+            return True
+
+        node = self._trie
+        remaining = len(labels)
+
+        for label in reversed(labels):
+            node = node.get(label)
+
+            if node is None:
+                return False
+
+            remaining -= 1
+            flags = node.get(None, 0)
+
+            if remaining:
+                if flags & MATCH_SUBDOMAINS:
+                    return True
+            else:
+                return bool(flags & MATCH_SELF)
+
+        return False
+
+
+__all__ = ("DomainRules", "normalize_domain")
@@ -1,12 +1,18 @@
-import asyncio
+import json
+import argparse
 import xml.etree.ElementTree as et
 
-from typing import List
+from array import array
+from datetime import datetime
 from dataclasses import dataclass
+from typing import List, AsyncIterator, Iterable, Iterator
 
 import aiohttp
 import filetype
 
+from .session import http_get
+from .scheduler import TokenBucket
+
 FILE_TYPES = [
     filetype.is_audio,
     filetype.is_font,
@@ -14,12 +20,382 @@ FILE_TYPES = [
     filetype.is_video
 ]
 
+# Extensions of the file types that aren't indexed
+BINARY_EXTENSIONS = frozenset(
+    [
+        t.extension for t in filetype.image_matchers +
+        filetype.video_matchers +
+        filetype.audio_matchers +
+        filetype.font_matchers
+    ] + ["jpeg", "tiff", "mpeg", "mid", "opus"]
+)
+
+# Bytes needed by 'filetype' to detect any file type
+SNIFF_SIZE = 262
+
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+LISTING_CHUNK_SIZE = 16384
+
+# Objects of each part of a large bucket handed to the results consumers
+BUCKET_PART_SIZE = 10000
+
+# Answers of providers without ListObjectsV2 support
+V2_UNSUPPORTED_STATUS = (400, 501)
+
+
+# Storage classes stored by index. Other ones are kept by each S3Objects
+STORAGE_CLASSES = ("", "STANDARD", "REDUCED_REDUNDANCY", "GLACIER",
+                   "STANDARD_IA", "ONEZONE_IA", "INTELLIGENT_TIERING",
+                   "DEEP_ARCHIVE", "OUTPOSTS", "GLACIER_IR")
+
+STORAGE_CLASSES_IDS = {c: i for i, c in enumerate(STORAGE_CLASSES)}
+
+
+class S3Object:
+    """Object of a bucket listing"""
+
+    __slots__ = ("key", "size", "last_modified", "etag", "storage_class")
+
+    def __init__(self,
+                 key: str,
+                 size: int = -1,
+                 last_modified: int = -1,
+                 etag: str = "",
+                 storage_class: str = ""):
+        self.key = key
+        self.size = size
+        self.last_modified = last_modified
+        self.etag = etag
+        self.storage_class = storage_class
+
+
+class S3Objects:
+    """Compact, column oriented, list of the objects of a bucket.
+
+    Key prefixes (the path until the last '/') are interned and the rest of
+    the key and the ETag are packed in byte buffers. Sizes, last modified
+    timestamps (-1 when unknown) and storage classes are stored in arrays.
+    Storage classes out of 'STORAGE_CLASSES' are interned like the prefixes.
+    Iterating over it yields the keys.
+    """
+
+    def __init__(self, objects: Iterable[S3Object or str] = ()):
+        self._prefixes = []
+        self._prefixes_ids = {}
+
+        self._prefix = array("I")
+        self._names = bytearray()
+        self._names_end = array("I")
+        self._etags = bytearray()
+        self._etags_end = array("I")
+        self.size = array("q")
+        self.last_modified = array("q")
+        self._storage_class = array("B")
+        self._other_classes = []
+        self._other_classes_ids = {}
+
+        for obj in objects:
+            self.append(obj)
+
+    def append(self, obj: S3Object or str):
+        if isinstance(obj, str):
+            obj = S3Object(obj)
+
+        key = obj.key
+        split = key.rfind("/") + 1
+        prefix = key[:split]
+
+        try:
+            prefix_id = self._prefixes_ids[prefix]
+        except KeyError:
+            prefix_id = len(self._prefixes)
+            self._prefixes.append(prefix)
+            self._prefixes_ids[prefix] = prefix_id
+
+        self._prefix.append(prefix_id)
+        self._names.extend(key[split:].encode("UTF-8"))
+        self._names_end.append(len(self._names))
+        self._etags.extend(obj.etag.encode("UTF-8"))
+        self._etags_end.append(len(self._etags))
+        self.size.append(obj.size)
+        self.last_modified.append(obj.last_modified)
+
+        storage_class = STORAGE_CLASSES_IDS.get(obj.storage_class)
+
+        if storage_class is None:
+            storage_class = self._other_class_id(obj.storage_class)
+
+        self._storage_class.append(storage_class)
+
+    def _other_class_id(self, storage_class: str) -> int:
+        try:
+            return self._other_classes_ids[storage_class]
+        except KeyError:
+            class_id = len(STORAGE_CLASSES) + len(self._other_classes)
+            self._other_classes.append(storage_class)
+            self._other_classes_ids[storage_class] = class_id
+
+        # More classes than fit in a byte
+        if class_id > 0xFF and self._storage_class.typecode == "B":
+            self._storage_class = array("I", self._storage_class)
+
+        return class_id
+
+    def __len__(self):
+        return len(self._prefix)
+
+    def __bool__(self):
+        return len(self._prefix) > 0
+
+    def _slice(self, buffer: bytearray, ends: array, index: int) -> str:
+        start = ends[index - 1] if index else 0
+
+        return buffer[start:ends[index]].decode("UTF-8")
+
+    def key(self, index: int) -> str:
+        return self._prefixes[self._prefix[index]] + \
+               self._slice(self._names, self._names_end, index)
+
+    def etag(self, index: int) -> str:
+        return self._slice(self._etags, self._etags_end, index)
+
+    def storage_class(self, index: int) -> str:
+        class_id = self._storage_class[index]
+
+        if class_id < len(STORAGE_CLASSES):
+            return STORAGE_CLASSES[class_id]
+
+        return self._other_classes[class_id - len(STORAGE_CLASSES)]
+
+    def __getitem__(self, index: int) -> S3Object:
+        if index < 0:
+            index += len(self)
+
+        return S3Object(
+            key=self.key(index),
+            size=self.size[index],
+            last_modified=self.last_modified[index],
+            etag=self.etag(index),
+            storage_class=self.storage_class(index)
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self.key(index)
+
+    def records(self) -> Iterator[S3Object]:
+        for index in range(len(self)):
+            yield self[index]
+
 
 @dataclass
 class S3Bucket:
+    """Objects found in a bucket. Large buckets are emitted in several parts,
+    numbered from 0, with up to 'BUCKET_PART_SIZE' objects each. 'origin'
+    is the frontier item, (domain, recursion level), whose analysis found
+    it"""
     domain: str
     bucket_name: str
-    objects: List[str]
+    objects: S3Objects
+    part: int = 0
+    origin: tuple = None
+
+    def iter_json(self, batch_size: int = 1000) -> Iterator[str]:
+        """Serialize the bucket as a JSON document, in pieces, without
+        building the whole document in memory"""
+        objects = self.objects
+        total = len(objects)
+
+        yield f'{{"domain": {json.dumps(self.domain)}, ' \
+              f'"bucket_name": {json.dumps(self.bucket_name)}, ' \
+              f'"part": {self.part}, ' \
+              f'"objects": ['
+
+        columns = (
+            ("objects", lambda i: json.dumps(objects.key(i))),
+            ("size", lambda i: str(objects.size[i])),
+            ("last_modified", lambda i: str(objects.last_modified[i])),
+            ("etag", lambda i: json.dumps(objects.etag(i))),
+            ("storage_class", lambda i: json.dumps(objects.storage_class(i)))
+        )
+
+        for name, dump in columns:
+            if name == "size":
+                yield '], "objects_metadata": {"size": ['
+            elif name != "objects":
+                yield f'], "{name}": ['
+
+            for start in range(0, total, batch_size):
+                end = min(start + batch_size, total)
+                piece = ", ".join(dump(i) for i in range(start, end))
+
+                yield f", {piece}" if start else piece
+
+        yield "]}}"
+
+
+class BucketRedirectException(Exception):
+
+    def __init__(self, redirection):
+        self.redirection = redirection
+
+
+class ListingParser:
+    """Incremental parser of S3 ListBucket results (V1 and V2).
+
+    Chunks of the XML page are fed as they're downloaded and the objects
+    found are returned. Parsed elements are cleared to keep memory bounded.
+    """
+
+    def __init__(self):
+        self._parser = et.XMLPullParser(events=("end",))
+
+        self.is_truncated = False
+        self.next_marker = None
+        self.continuation_token = None
+        self.last_key = None
+
+    def _read_objects(self) -> List[S3Object]:
+        objects = []
+
+        for _, element in self._parser.read_events():
+            tag = element.tag.rsplit("}", 1)[-1]
+
+            if tag == "Contents":
+                obj = S3Object("")
+
+                for child in element:
+                    child_tag = child.tag.rsplit("}", 1)[-1]
+                    text = child.text
+
+                    if not text:
+                        continue
+
+                    if child_tag == "Key":
+                        obj.key = text
+                    elif child_tag == "Size":
+                        obj.size = int(text)
+                    elif child_tag == "LastModified":
+                        obj.last_modified = parse_timestamp(text)
+                    elif child_tag == "ETag":
+                        obj.etag = text.strip('"')
+                    elif child_tag == "StorageClass":
+                        obj.storage_class = text
+
+                if obj.key:
+                    objects.append(obj)
+                    self.last_key = obj.key
+
+                element.clear()
+
+            elif tag == "IsTruncated":
+                self.is_truncated = element.text == "true"
+            elif tag == "NextMarker":
+                self.next_marker = element.text
+            elif tag == "NextContinuationToken":
+                self.continuation_token = element.text
+
+        return objects
+
+    def feed(self, chunk: str or bytes) -> List[S3Object]:
+        self._parser.feed(chunk)
+
+        return self._read_objects()
+
+    def close(self) -> List[S3Object]:
+        self._parser.close()
+
+        return self._read_objects()
+
+    def next_page_params(self) -> dict or None:
+        """Query params for requesting the next page of the listing"""
+        if not self.is_truncated:
+            return None
+
+        if self.continuation_token:
+            return {
+                "list-type": "2",
+                "continuation-token": self.continuation_token
+            }
+        elif self.next_marker or self.last_key:
+            return {"marker": self.next_marker or self.last_key}
+        else:
+            return None
+
+
+async def listing_v2_unsupported(response: aiohttp.ClientResponse) -> bool:
+    """Check if an error answer to a ListObjectsV2 request means that the
+    provider doesn't support it"""
+    if response.status in V2_UNSUPPORTED_STATUS:
+        return True
+
+    # Errors are small documents. Don't read big ones
+    body = await response.content.read(LISTING_CHUNK_SIZE)
+
+    return b"<Code>InvalidArgument</Code>" in body
+
+
+async def list_bucket_objects(cli_args: argparse.Namespace,
+                              bucket_url: str,
+                              params: dict = None,
+                              ssl: bool = True) -> AsyncIterator[S3Object]:
+    """Yield the objects of a bucket, following every page of the listing.
+
+    ListObjectsV2 is used when the provider supports it. Pass 'params' to
+    start from a given page. Only a page of objects is held at once. With
+    'ssl' False, certificates of HTTPS URLs aren't verified.
+    """
+    if params is None:
+        params = {"list-type": "2"}
+        fallback_v1 = True
+    else:
+        fallback_v1 = False
+
+    while params is not None:
+
+        async with http_get(cli_args,
+                            bucket_url,
+                            params=params,
+                            ssl=ssl) as response:
+
+            if response.status == 301:
+                raise BucketRedirectException(
+                    get_redirection(await response.read())
+                )
+
+            if not str(response.status).startswith("2"):
+                if fallback_v1 and await listing_v2_unsupported(response):
+                    # Provider without ListObjectsV2 support
+                    params = {}
+                    fallback_v1 = False
+                    continue
+
+                # Private or missing buckets
+                return
+
+            fallback_v1 = False
+            listing = ListingParser()
+            page = []
+
+            async for chunk in response.content.iter_chunked(
+                    LISTING_CHUNK_SIZE):
+                page.extend(listing.feed(chunk))
+
+            page.extend(listing.close())
+
+        # Objects are yielded once the request is closed, so consumers that
+        # wait don't keep its HTTP slot
+        for obj in page:
+            yield obj
+
+        next_params = listing.next_page_params()
+
+        if next_params == params:
+            # Broken pagination. Avoid looping forever
+            return
+
+        params = next_params
 
 
 def get_redirection(text: str or bytes) -> str:
@@ -29,49 +405,105 @@ def get_redirection(text: str or bytes) -> str:
     return root.find("Endpoint").text
 
 
-async def download_content_and_index(
-        url: str,
-        bucket_name: str,
-        sem: asyncio.Semaphore,
-        fulltext_add_fn
-):
-    async with sem:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{bucket_name}/{url}") as response:
-                content = await response.read()
+def is_binary_key(key: str) -> bool:
+    """Check if the extension of an object key is a not indexable type"""
+    name = key.rsplit("/", 1)[-1]
+
+    if "." not in name:
+        return False
+
+    return name.rsplit(".", 1)[-1].lower() in BINARY_EXTENSIONS
+
+
+def is_binary_content(content: bytes) -> bool:
+    return any(f(content) for f in FILE_TYPES)
+
+
+async def read_indexable_content(response: aiohttp.ClientResponse,
+                                 max_size: int,
+                                 throttle: TokenBucket = None) \
+        -> bytes or None:
+    """Read the body of an object if it can be indexed.
+
+    The leading bytes are downloaded first to detect binary files, so the
+    rest of them is never downloaded. Returns None for binary objects and
+    objects bigger than 'max_size' (0 for no limit). Read bytes are taken
+    from 'throttle', if it's given.
+    """
+    if max_size and response.content_length and \
+            response.content_length > max_size:
+        return None
+
+    head = b""
+
+    while len(head) < SNIFF_SIZE:
+        chunk = await response.content.read(SNIFF_SIZE - len(head))
 
-            # Only storage non-binary files
-            if not any(f(content) for f in FILE_TYPES):
-                await fulltext_add_fn(bucket_name, url, content)
+        if not chunk:
+            break
 
+        head += chunk
 
-async def download_s3_objects(bucket: S3Bucket, fulltext_add_fn):
-    sem = asyncio.Semaphore(20)
+    if throttle:
+        await throttle.take(len(head))
 
-    await asyncio.gather(*[
-        download_content_and_index(
-            url,
-            bucket.bucket_name,
-            sem,
-            fulltext_add_fn
-        ) for url in bucket.objects
-    ])
+    if is_binary_content(head):
+        return None
+
+    chunks = [head]
+    size = len(head)
+
+    async for chunk in response.content.iter_chunked(LISTING_CHUNK_SIZE):
+        size += len(chunk)
+
+        if max_size and size > max_size:
+            return None
+
+        if throttle:
+            await throttle.take(len(chunk))
+
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+async def download_s3_objects(cli_args: argparse.Namespace,
+                              bucket: S3Bucket):
+    """Queue the objects of a bucket in the download scheduler, for
+    indexing. Waits while the scheduler is full"""
+    max_size = cli_args.index_max_size
+    objects = bucket.objects
+
+    for i in range(len(objects)):
+        key = objects.key(i)
+
+        # Skip what the listing already tells that won't be indexed
+        if (max_size and objects.size[i] > max_size) or is_binary_key(key):
+            continue
+
+        await cli_args.download_scheduler.submit(bucket.bucket_name,
+                                                 objects[i])
 
 
 def parse_result(content: str or bytes) -> List[str]:
     """Parse S3 XML Content """
-    root = et.fromstring(content)
-
-    contents = []
-    # Search contents in the bucket
-    for obj in root.findall(
-            "{http://s3.amazonaws.com/doc/2006-03-01/}Contents"):
-        contents.append(
-            obj.find("{http://s3.amazonaws.com/doc/2006-03-01/}Key").text
-        )
+    listing = ListingParser()
+
+    return [obj.key for obj in listing.feed(content) + listing.close()]
+
 
-    return contents
+def parse_timestamp(text: str) -> int:
+    """Parse a S3 ISO 8601 date as a UNIX timestamp"""
+    try:
+        return int(datetime.fromisoformat(
+            text.replace("Z", "+00:00")
+        ).timestamp())
+    except ValueError:
+        return -1
 
 
-__all__ = ("parse_result", "S3Bucket", "get_redirection",
-           "download_s3_objects")
+__all__ = ("parse_result", "S3Bucket", "S3Object", "S3Objects",
+           "get_redirection",
+           "download_s3_objects", "list_bucket_objects", "ListingParser",
+           "read_indexable_content", "is_binary_key", "DOWNLOAD_TIMEOUT",
+           "BucketRedirectException", "BUCKET_PART_SIZE")
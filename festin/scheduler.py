@@ -0,0 +1,196 @@
+import time
+import asyncio
+
+from typing import Dict, Deque
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
+
+# Token buckets of idle hosts are forgotten when there're this many, or
+# twice the ones left by the previous sweep
+SWEEP_BUCKETS = 1024
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    'rate' tokens are refilled per second up to 'burst'. A rate of 0 means
+    no limit.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def take(self, tokens: float = 1):
+        if not self.rate:
+            return
+
+        async with self._lock:
+            self._refill()
+
+            if self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+
+            self._tokens -= tokens
+
+    def idle(self) -> bool:
+        """Full and nobody waiting for tokens: the same as a new bucket"""
+        if self._lock.locked():
+            return False
+
+        self._refill()
+
+        return self._tokens >= self.burst
+
+
+class HostScheduler:
+    """Politeness scheduler for outbound requests.
+
+    Requests are granted when there're free global slots and the target host
+    doesn't exceed its own concurrency. Hosts with waiting requests are
+    served round robin, so a busy host can't starve the rest of them.
+
+    With a 'host_rate', every host gets a token bucket. Buckets of idle
+    hosts are dropped, so crawls of many hosts don't keep one for each.
+    """
+
+    def __init__(self,
+                 max_connections: int,
+                 max_per_host: int,
+                 host_rate: float = 0,
+                 host_burst: float = None):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+
+        self.in_flight = 0
+        self.hosts_in_flight: Dict[str, int] = {}
+
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._sweep_at = SWEEP_BUCKETS
+        self._waiters: Dict[str, Deque[asyncio.Future]] = OrderedDict()
+
+    def _bucket(self, host: str) -> TokenBucket or None:
+        if not self.host_rate:
+            return None
+
+        try:
+            return self._buckets[host]
+        except KeyError:
+            pass
+
+        if len(self._buckets) >= self._sweep_at:
+            self._sweep_buckets()
+
+        bucket = TokenBucket(self.host_rate, self.host_burst)
+        self._buckets[host] = bucket
+
+        return bucket
+
+    def _sweep_buckets(self):
+        for host in [h for h, b in self._buckets.items() if b.idle()]:
+            del self._buckets[host]
+
+        self._sweep_at = max(2 * len(self._buckets), SWEEP_BUCKETS)
+
+    def _can_run(self, host: str) -> bool:
+        if self.max_connections and self.in_flight >= self.max_connections:
+            return False
+
+        if self.max_per_host and \
+                self.hosts_in_flight.get(host, 0) >= self.max_per_host:
+            return False
+
+        return True
+
+    def _grant(self, host: str):
+        self.in_flight += 1
+        self.hosts_in_flight[host] = self.hosts_in_flight.get(host, 0) + 1
+
+    def _release(self, host: str):
+        self.in_flight -= 1
+        self.hosts_in_flight[host] -= 1
+
+        if not self.hosts_in_flight[host]:
+            del self.hosts_in_flight[host]
+
+        self._dispatch()
+
+    def _dispatch(self):
+        """Wake up waiters, one per host, round robin"""
+        granted = True
+
+        while granted and self._waiters:
+            granted = False
+
+            for host in list(self._waiters):
+                if not self._can_run(host):
+                    continue
+
+                waiters = self._waiters.pop(host)
+                fut = waiters.popleft()
+
+                # Host goes to the end of the round
+                if waiters:
+                    self._waiters[host] = waiters
+
+                if fut.done():
+                    # Cancelled while waiting
+                    granted = True
+                    continue
+
+                self._grant(host)
+                fut.set_result(None)
+                granted = True
+
+    async def _acquire(self, host: str):
+        if host not in self._waiters and self._can_run(host):
+            self._grant(host)
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(host, deque()).append(fut)
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Slot granted after the cancellation
+                self._release(host)
+            else:
+                waiters = self._waiters.get(host)
+
+                if waiters is not None and fut in waiters:
+                    waiters.remove(fut)
+
+                    if not waiters:
+                        del self._waiters[host]
+            raise
+
+    @asynccontextmanager
+    async def slot(self, host: str):
+        bucket = self._bucket(host)
+
+        if bucket:
+            await bucket.take()
+
+        await self._acquire(host)
+
+        try:
+            yield
+        finally:
+            self._release(host)
+
+
+__all__ = ("HostScheduler", "TokenBucket")
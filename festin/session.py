@@ -0,0 +1,114 @@
+import argparse
+
+from types import SimpleNamespace
+from urllib.parse import urlparse
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from aiohttp import TCPConnector
+from aiohttp_proxy import ProxyConnector, ProxyType
+
+from .scheduler import HostScheduler
+
+
+def build_connector(cli_args: argparse.Namespace) -> TCPConnector:
+    """Build the connector shared by every probe of the run. Certificates
+    are verified, unless a request is done with 'ssl=False'"""
+    options = dict(
+        limit=cli_args.http_pool_size,
+        limit_per_host=cli_args.http_pool_per_host,
+        keepalive_timeout=cli_args.http_keepalive,
+        use_dns_cache=cli_args.http_dns_cache > 0,
+        ttl_dns_cache=cli_args.http_dns_cache or None
+    )
+
+    if cli_args.tor:
+        return ProxyConnector(
+            proxy_type=ProxyType.SOCKS5,
+            host='127.0.0.1',
+            port=9050,
+            **options
+        )
+    else:
+        return TCPConnector(**options)
+
+
+def build_trace_config(stats: SimpleNamespace) -> aiohttp.TraceConfig:
+    """Count new and reused connections of the shared pool"""
+
+    async def on_connection_create_end(session, context, params):
+        stats.created += 1
+
+    async def on_connection_reuseconn(session, context, params):
+        stats.reused += 1
+
+    async def on_request_end(session, context, params):
+        stats.requests += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_request_end.append(on_request_end)
+
+    return trace_config
+
+
+def http_session_create(cli_args: argparse.Namespace) \
+        -> aiohttp.ClientSession:
+    """Create the long-lived HTTP session of the run.
+
+    The session is stored in 'cli_args.http_session' and must be created
+    inside the running event loop. Requests must be done with 'http_get' so
+    they pass through the host scheduler.
+    """
+    stats = SimpleNamespace(created=0, reused=0, requests=0, received=0)
+
+    cli_args.http_session = aiohttp.ClientSession(
+        connector=build_connector(cli_args),
+        timeout=aiohttp.ClientTimeout(total=cli_args.http_timeout),
+        trace_configs=[build_trace_config(stats)]
+    )
+    cli_args.http_stats = stats
+    cli_args.http_scheduler = HostScheduler(
+        max_connections=cli_args.http_pool_size,
+        max_per_host=cli_args.http_pool_per_host,
+        host_rate=cli_args.http_host_rate,
+        host_burst=cli_args.http_host_burst
+    )
+
+    return cli_args.http_session
+
+
+@asynccontextmanager
+async def http_get(cli_args: argparse.Namespace, url: str, **kwargs):
+    """GET an URL with the shared session, waiting for a free slot of the
+    target host"""
+    host = urlparse(url).netloc
+
+    async with cli_args.http_scheduler.slot(host):
+        async with cli_args.http_session.get(url, **kwargs) as response:
+            try:
+                yield response
+            finally:
+                cli_args.http_stats.received += response.content.total_bytes
+
+
+async def http_session_close(cli_args: argparse.Namespace):
+    session = getattr(cli_args, "http_session", None)
+
+    if session is None:
+        return
+
+    await session.close()
+
+    stats = cli_args.http_stats
+
+    if not cli_args.quiet:
+        print(f"[*] HTTP connections: {stats.requests} requests, "
+              f"{stats.created} connections opened, "
+              f"{stats.reused} reused, "
+              f"{stats.received // 1024} KB received")
+
+
+__all__ = ("http_session_create", "http_session_close", "http_get")
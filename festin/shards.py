@@ -0,0 +1,284 @@
+import queue
+import asyncio
+import hashlib
+import ipaddress
+import multiprocessing
+
+from typing import List
+
+from .rules import normalize_domain
+from .queues import FrontierQueue
+
+# Second level labels used by registries under country code TLDs, like
+# 'co.uk' or 'com.au'
+SECOND_LEVEL_LABELS = frozenset((
+    "ac", "co", "com", "edu", "gob", "go", "gov", "ne", "net", "or", "org"
+))
+
+# Seconds between checks of the global pending counter
+FINISHED_POLL_INTERVAL = 0.1
+
+
+def registered_domain(domain) -> str:
+    """Approximate registered domain: 'a.b.example.com' -> 'example.com',
+    'a.example.co.uk' -> 'example.co.uk'"""
+    if hasattr(domain, "decode"):
+        domain = domain.decode("UTF-8")
+
+    domain = normalize_domain(domain)
+
+    if domain.startswith("["):
+        return domain[1:].split("]", 1)[0]
+
+    try:
+        ipaddress.ip_address(domain)
+        return domain
+    except ValueError:
+        pass
+
+    labels = domain.split(".")
+
+    if len(labels) > 2 and \
+            len(labels[-1]) == 2 and \
+            labels[-2] in SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+
+    return ".".join(labels[-2:])
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping and Veach)"""
+    b, j = -1, 0
+
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+
+    return b
+
+
+def shard_of(domain, shards: int) -> int:
+    """Shard that owns a domain. Subdomains of the same registered domain
+    go to the same shard"""
+    digest = hashlib.blake2b(registered_domain(domain).encode("UTF-8"),
+                             digest_size=8).digest()
+
+    return jump_hash(int.from_bytes(digest, "little"), shards)
+
+
+class FlushedResults:
+    """Message from the coordinator to a shard with its results written to
+    the results file, as 'result_record' tuples"""
+
+    def __init__(self, records: List[tuple]):
+        self.records = records
+
+
+class ShardContext:
+    """Process shared objects of a shard of a multi-process crawl.
+
+    - inboxes: queue of each shard, with the domains that it owns found by
+      the other shards, and its results written by the coordinator
+    - outbox: messages to the coordinator, like results or discovered
+      domains
+    - pending: domains queued or being analyzed by any shard, plus the ones
+      being sent between them. The crawl finishes when it's 0
+    """
+
+    def __init__(self,
+                 index: int,
+                 inboxes: List[multiprocessing.Queue],
+                 outbox: multiprocessing.Queue,
+                 pending):
+        self.index = index
+        self.count = len(inboxes)
+        self.inboxes = inboxes
+        self.outbox = outbox
+        self.pending = pending
+
+    def add_pending(self, count: int):
+        with self.pending.get_lock():
+            self.pending.value += count
+
+    def is_finished(self) -> bool:
+        return self.pending.value <= 0
+
+    def send(self, message: tuple):
+        self.outbox.put(message)
+
+    def forward(self, shard: int, item: tuple):
+        self.add_pending(1)
+        self.inboxes[shard].put(item)
+
+
+class ShardedFrontierQueue(FrontierQueue):
+    """Frontier of a shard. Domains owned by other shards are forwarded to
+    them instead of being queued. Results written by the coordinator are
+    stored in the crawl state of the shard when they're received.
+
+    Every shard holds the frontier while its initial domains are queued. The
+    coordinator counts these holds in the pending counter before starting
+    the shards, so no shard can see the crawl finished before the rest of
+    them start.
+    """
+
+    def __init__(self, shard: ShardContext, **kwargs):
+        super().__init__(**kwargs)
+        self.shard = shard
+
+        self.forwarded = 0
+        self.received = 0
+
+    async def put(self, item):
+        owner = shard_of(item[0], self.shard.count)
+
+        if owner != self.shard.index:
+            self.forwarded += 1
+            self.shard.forward(owner, item)
+            return
+
+        self.shard.add_pending(1)
+        await super().put(item)
+
+    def done(self, domain, recursion_level: int, visited: bool = False):
+        super().done(domain, recursion_level, visited)
+        self.shard.add_pending(-1)
+
+    def release(self):
+        super().release()
+        self.shard.add_pending(-1)
+
+    async def receive(self):
+        """Queue the domains forwarded by other shards, until a None is
+        received"""
+        inbox = self.shard.inboxes[self.shard.index]
+        loop = asyncio.get_running_loop()
+
+        while (item := await loop.run_in_executor(None, inbox.get)) \
+                is not None:
+            if isinstance(item, FlushedResults):
+                if self.state:
+                    self.state.add_results(item.records)
+
+                continue
+
+            self.received += 1
+
+            self.shard.add_pending(1)
+            await super().put(item)
+
+            # No longer in transit
+            self.shard.add_pending(-1)
+
+    def stop_receiving(self):
+        self.shard.inboxes[self.shard.index].put(None)
+
+    async def wait_finished(self):
+        while True:
+            await self.join()
+
+            if self.shard.is_finished():
+                return
+
+            await asyncio.sleep(FINISHED_POLL_INTERVAL)
+
+    def summary(self) -> str:
+        return f"{super().summary()}, {self.forwarded} domains forwarded " \
+               f"to other workers, {self.received} received"
+
+
+class ShardPool:
+    """Worker processes of a multi-process crawl, one per shard"""
+
+    def __init__(self, count: int):
+        context = multiprocessing.get_context("spawn")
+
+        self.count = count
+        self.inboxes = [context.Queue() for _ in range(count)]
+        self.outbox = context.Queue()
+
+        # One frontier hold per shard. See 'ShardedFrontierQueue'
+        self.pending = context.Value("q", count)
+
+        self.contexts = [
+            ShardContext(i, self.inboxes, self.outbox, self.pending)
+            for i in range(count)
+        ]
+        self._context = context
+        self.processes = []
+
+    def split(self, domains: list) -> List[list]:
+        """Initial domains of every shard"""
+        shards = [[] for _ in range(self.count)]
+
+        for domain in domains:
+            shards[shard_of(domain, self.count)].append(domain)
+
+        return shards
+
+    def start(self, target, cli_args, domains: list):
+        """Run 'target(cli_args, domains, shard_context)' in every worker"""
+        for shard, shard_domains in zip(self.contexts, self.split(domains)):
+            process = self._context.Process(
+                target=target,
+                args=(cli_args, shard_domains, shard),
+                name=f"festin-worker-{shard.index}"
+            )
+            process.start()
+
+            self.processes.append(process)
+
+    def send_flushed(self, records: List[tuple]):
+        """Send results written by the coordinator back to the shards that
+        found them"""
+        shards = {}
+
+        for record in records:
+            origin = record[-1]
+
+            if origin is not None:
+                shards.setdefault(
+                    shard_of(origin[0], self.count), []
+                ).append(record)
+
+        for index, shard_records in shards.items():
+            self.inboxes[index].put(FlushedResults(shard_records))
+
+    async def messages(self):
+        """Yield the messages sent by the workers until all of them
+        finished"""
+        loop = asyncio.get_running_loop()
+        running = set(range(self.count))
+
+        while running:
+            try:
+                message = await loop.run_in_executor(
+                    None, self.outbox.get, True, 1
+                )
+            except queue.Empty:
+                for index in list(running):
+                    if not self.processes[index].is_alive():
+                        print(f"[!] Worker {index} died unexpectedly. "
+                              f"Stopping the crawl")
+                        self.terminate()
+                        return
+                continue
+
+            if message[0] == "stop":
+                running.discard(message[1])
+            else:
+                yield message
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+
+__all__ = ("ShardPool", "ShardContext", "ShardedFrontierQueue",
+           "FlushedResults", "registered_domain", "shard_of")
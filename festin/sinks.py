@@ -0,0 +1,233 @@
+import os
+import gzip
+import asyncio
+
+from typing import Any, Callable, List, Set
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_EXTENSIONS = {
+    None: "",
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+
+
+class ResultsWriter:
+    """Long-lived writer of the results file, one JSON document per line.
+
+    Every record is written to the file as soon as it ends, so a crash only
+    loses the partially written last record. Records bigger than
+    'buffer_size' bytes are written in pieces while they're built. The file
+    is synced to disk every 'flush_interval' seconds.
+
+    With 'compression' ("gzip" or "zstd") records are buffered up to
+    'buffer_size' bytes, or 'flush_interval' seconds, and every flush is
+    written as an independent gzip member / zstd frame, so what was flushed
+    can be decompressed after a crash. A crash loses the buffered records.
+
+    When the file is bigger than 'rotate_size' bytes (0 for no rotation)
+    it's renamed to 'name.N.ext' and a new one is started.
+
+    'on_flushed' is called with the 'ack' values of the records written to
+    the file by each flush.
+    """
+
+    def __init__(self,
+                 path: str,
+                 compression: str = None,
+                 buffer_size: int = 1048576,
+                 flush_interval: float = 1,
+                 rotate_size: int = 0,
+                 on_flushed: Callable[[List[Any]], None] = None):
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the 'zstandard' package")
+
+        extension = COMPRESSION_EXTENSIONS[compression]
+
+        if extension and path.endswith(extension):
+            path = path[:-len(extension)]
+
+        self.base_path = path
+        self.extension = extension
+        self.path = f"{path}{extension}"
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.rotate_size = rotate_size
+        self.on_flushed = on_flushed
+
+        self._buffer: List[bytes] = []
+        self._acks: List[Any] = []
+        self._buffered = 0
+        self._lock = asyncio.Lock()
+        self._file = open(self.path, "ab")
+        self._file_size = self._file.tell()
+        self._rotations = 0
+        self._in_record = False
+        self._unsynced = False
+        self._flusher = asyncio.create_task(
+            self._flush_periodically(flush_interval)
+        )
+
+        self.records = 0
+        self.bytes = 0
+
+    def _append(self, data: str):
+        data = data.encode("UTF-8")
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+    async def write(self, pieces, ack: Any = None):
+        """Write a record given as an iterable of strings. Big records are
+        flushed while they're written"""
+        self._in_record = True
+
+        for piece in pieces:
+            self._append(piece)
+
+            if self._buffered >= self.buffer_size:
+                await self.flush()
+
+        self._append("\n")
+        self._in_record = False
+        self.records += 1
+
+        if ack is not None:
+            self._acks.append(ack)
+
+        # Compressed records wait for a full frame. Rotation waits for the
+        # end of a record
+        if not self.compression or self._buffered >= self.buffer_size or \
+                (self.rotate_size and self._file_size >= self.rotate_size):
+            await self.flush()
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.compress(data)
+        elif self.compression == "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+        else:
+            return data
+
+    def _write_file(self, data: bytes, can_rotate: bool):
+        data = self._compress(data)
+
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+        self.bytes += len(data)
+        self._unsynced = True
+
+        if can_rotate and self.rotate_size and \
+                self._file_size >= self.rotate_size:
+            self._rotate()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+
+        while True:
+            self._rotations += 1
+            rotated = f"{self.base_path}.{self._rotations}{self.extension}"
+
+            if not os.path.exists(rotated):
+                break
+
+        os.rename(self.path, rotated)
+
+        self._file = open(self.path, "ab")
+        self._file_size = 0
+
+    async def flush(self, sync: bool = False):
+        """Write the buffered data to the file. With 'sync' the file is also
+        synced to disk"""
+        loop = asyncio.get_running_loop()
+
+        async with self._lock:
+            if self._buffer:
+                data = b"".join(self._buffer)
+                self._buffer = []
+                self._buffered = 0
+
+                acks, self._acks = self._acks, []
+
+                # Records aren't split between files
+                can_rotate = not self._in_record
+
+                if self.compression:
+                    # Compression doesn't block the event loop
+                    await loop.run_in_executor(
+                        None, self._write_file, data, can_rotate
+                    )
+                else:
+                    # Only a copy to the page cache, as the record ends
+                    self._write_file(data, can_rotate)
+
+                if self.on_flushed and acks:
+                    self.on_flushed(acks)
+
+            if sync and self._unsynced:
+                self._unsynced = False
+                await loop.run_in_executor(None, self._sync)
+
+    async def _flush_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush(sync=True)
+
+    async def close(self):
+        self._flusher.cancel()
+
+        try:
+            await self.flush(sync=True)
+        finally:
+            self._file.close()
+
+    def summary(self) -> str:
+        return f"[*] Results file '{self.path}': {self.records} results, " \
+               f"{self.bytes // 1024} KB written"
+
+
+class DomainWriter(ResultsWriter):
+    """Writer of a domains file, one domain per line. With 'dedup' every
+    domain is written only once"""
+
+    def __init__(self,
+                 path: str,
+                 dedup: bool = False,
+                 buffer_size: int = 65536,
+                 flush_interval: float = 1):
+        super().__init__(path,
+                         buffer_size=buffer_size,
+                         flush_interval=flush_interval)
+
+        self.written: Set[str] or None = set() if dedup else None
+        self.duplicated = 0
+
+    async def write(self, domain: str):
+        if self.written is not None:
+            if domain in self.written:
+                self.duplicated += 1
+                return
+
+            self.written.add(domain)
+
+        await super().write((domain,))
+
+    def summary(self) -> str:
+        message = f"[*] Domains file '{self.path}': {self.records} domains"
+
+        if self.written is not None:
+            message += f", {self.duplicated} duplicates skipped"
+
+        return message
+
+
+__all__ = ("ResultsWriter", "DomainWriter")
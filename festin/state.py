@@ -0,0 +1,204 @@
+import asyncio
+import sqlite3
+
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+
+def domain_key(domain) -> str:
+    if hasattr(domain, "decode"):
+        return domain.decode("UTF-8")
+    else:
+        return str(domain)
+
+
+class CrawlState:
+    """On-disk checkpoint of a crawl, stored in a SQLite database.
+
+    It keeps:
+
+    - visited: domains already analyzed
+    - frontier: domains waiting for analysis (or being analyzed) with their
+      recursion level
+    - result_parts: parts of buckets already emitted
+
+    Changes are committed every time 'commit' is called, so a crash only
+    loses the changes since the last checkpoint. Results are stored when the
+    results file has written them: until then they're only reserved in
+    memory. The domains that found them are held in the frontier until then
+    too (see 'hold_result'), so a resumed crawl analyzes them again instead
+    of losing the results.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS visited (
+                domain TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS frontier (
+                domain TEXT,
+                level INTEGER,
+                pending INTEGER,
+                PRIMARY KEY (domain, level)
+            );
+            CREATE TABLE IF NOT EXISTS result_parts (
+                bucket_name TEXT,
+                part INTEGER,
+                domain TEXT,
+                objects INTEGER,
+                PRIMARY KEY (bucket_name, part)
+            );
+        """)
+        self.connection.commit()
+
+        self._pending_results = set()
+
+        # Results not written yet of each frontier item, and visited items
+        # waiting for them
+        self._held: Dict[Tuple[str, int], int] = {}
+        self._deferred: Dict[Tuple[str, int], int] = {}
+        self._no_held = asyncio.Event()
+        self._no_held.set()
+
+    def clear(self):
+        self.connection.executescript("""
+            DELETE FROM visited;
+            DELETE FROM frontier;
+            DELETE FROM result_parts;
+        """)
+        self.connection.commit()
+
+    def add_frontier(self, domain, level: int):
+        self.connection.execute(
+            "INSERT INTO frontier VALUES (?, ?, 1) "
+            "ON CONFLICT (domain, level) DO UPDATE SET pending = pending + 1",
+            (domain_key(domain), level)
+        )
+
+    def frontier_done(self, domain, level: int, visited: bool = False):
+        domain = domain_key(domain)
+        key = (domain, level)
+
+        # Marked when its results are written
+        if visited and key in self._held:
+            self._deferred[key] = self._deferred.get(key, 0) + 1
+            return
+
+        self.connection.execute(
+            "UPDATE frontier SET pending = pending - 1 "
+            "WHERE domain = ? AND level = ?",
+            (domain, level)
+        )
+        self.connection.execute(
+            "DELETE FROM frontier "
+            "WHERE domain = ? AND level = ? AND pending <= 0",
+            (domain, level)
+        )
+
+        if visited:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO visited VALUES (?)", (domain,)
+            )
+
+    def hold_result(self, origin: Tuple[str, int]):
+        """Count a result found by the analysis of 'origin', a frontier item
+        of (domain, recursion level). The item isn't marked as visited until
+        its results are written or discarded"""
+        key = (domain_key(origin[0]), origin[1])
+
+        self._held[key] = self._held.get(key, 0) + 1
+        self._no_held.clear()
+
+    def release_result(self, origin: Tuple[str, int] or None):
+        if origin is None:
+            return
+
+        key = (domain_key(origin[0]), origin[1])
+        held = self._held.get(key, 0) - 1
+
+        if held > 0:
+            self._held[key] = held
+            return
+
+        self._held.pop(key, None)
+
+        for _ in range(self._deferred.pop(key, 0)):
+            self.frontier_done(*key, visited=True)
+
+        if not self._held:
+            self._no_held.set()
+
+    async def wait_results(self):
+        """Wait until every held result is written or discarded"""
+        await self._no_held.wait()
+
+    def claim_result(self, bucket) -> bool:
+        """Reserve a part of a bucket about to be emitted, until 'add_results'
+        stores it. Returns False, and releases it, if it was already
+        emitted"""
+        key = (bucket.bucket_name, bucket.part)
+
+        if key in self._pending_results or self.connection.execute(
+            "SELECT 1 FROM result_parts WHERE bucket_name = ? AND part = ?",
+            key
+        ).fetchone():
+            self.release_result(bucket.origin)
+            return False
+
+        self._pending_results.add(key)
+
+        return True
+
+    def add_results(self, records: Iterable[tuple]):
+        """Store parts of buckets already written to the results file, given
+        as 'result_record' tuples, and release them"""
+        records = list(records)
+
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO result_parts VALUES (?, ?, ?, ?)",
+            (record[:4] for record in records)
+        )
+
+        for bucket_name, part, _, _, origin in records:
+            self._pending_results.discard((bucket_name, part))
+            self.release_result(origin)
+
+    def load_visited(self) -> Iterator[str]:
+        for (domain,) in self.connection.execute("SELECT domain FROM visited"):
+            yield domain
+
+    def pop_frontier(self) -> List[Tuple[str, int]]:
+        """Return pending domains of a previous run and forget them. They're
+        stored again when they're put in the new frontier queue"""
+        frontier = self.connection.execute(
+            "SELECT domain, level FROM frontier"
+        ).fetchall()
+
+        self.connection.execute("DELETE FROM frontier")
+
+        return frontier
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    async def checkpoint(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.commit()
+
+
+def result_record(bucket) -> tuple:
+    """What the crawl state stores of a written result: (bucket name, part,
+    domain, objects, origin)"""
+    return (bucket.bucket_name, bucket.part, bucket.domain,
+            len(bucket.objects), bucket.origin)
+
+
+__all__ = ("CrawlState", "result_record")
@@ -0,0 +1,88 @@
+import os
+import asyncio
+
+from typing import List
+
+
+class FileTail:
+    """Reads the lines appended to a file since the last read.
+
+    The read position is kept as a byte offset, so each read only costs the
+    new data. When the file is truncated it's read again from the start.
+    When it's rotated (the path points to a new file) the rest of the old
+    file is read before starting with the new one. Incomplete last lines
+    wait for the next read.
+    """
+
+    def __init__(self, path: str, offset: int = 0):
+        self.path = path
+
+        self._file = open(path, "rb")
+        self._file.seek(offset)
+        self._inode = self._stat_inode(os.fstat(self._file.fileno()))
+        self._partial = b""
+
+        self.lines = 0
+        self.truncations = 0
+        self.rotations = 0
+
+    @staticmethod
+    def _stat_inode(stat: os.stat_result) -> tuple:
+        return stat.st_dev, stat.st_ino
+
+    def _read_lines(self) -> List[str]:
+        data = self._partial + self._file.read()
+
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+
+        return data[:end].decode("UTF-8", errors="replace").splitlines()
+
+    def _read(self) -> List[str]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Rotated but the new file doesn't exist yet
+            return self._read_lines()
+
+        if self._stat_inode(stat) != self._inode:
+            # Lines written to the old file before the rotation
+            lines = self._read_lines()
+
+            if self._partial:
+                lines.append(self._partial.decode("UTF-8", errors="replace"))
+                self._partial = b""
+
+            self._file.close()
+            self._file = open(self.path, "rb")
+            self._inode = self._stat_inode(os.fstat(self._file.fileno()))
+            self.rotations += 1
+
+            return lines + self._read_lines()
+
+        if stat.st_size < self._file.tell():
+            self._file.seek(0)
+            self._partial = b""
+            self.truncations += 1
+
+        return self._read_lines()
+
+    async def read(self) -> List[str]:
+        """New complete lines of the file"""
+        lines = await asyncio.get_running_loop().run_in_executor(
+            None, self._read
+        )
+        self.lines += len(lines)
+
+        return lines
+
+    def close(self):
+        self._file.close()
+
+    def summary(self) -> str:
+        return f"[*] Watched file '{self.path}': {self.lines} new lines " \
+               f"read, {self.truncations} truncations, " \
+               f"{self.rotations} rotations"
+
+
+__all__ = ("FileTail",)
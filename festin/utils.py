@@ -1,20 +1,30 @@
 from colorama import Fore, Back, Style
 
 from .black_list import *
+from .rules import DomainRules, normalize_domain
+
+BLACK_LIST_RULES = DomainRules()
+
+for _domain in BLACK_LIST_FLD:
+    BLACK_LIST_RULES.add_suffix(_domain)
+
+for _domain in BLACK_LIST_DOMAINS:
+    BLACK_LIST_RULES.add_exact(_domain)
+
+BLACK_LIST_PREFISES_TUPLE = tuple(BLACK_LIST_PREFISES)
 
 
 def valid_domain_or_link(domain_or_link: str) -> None or str:
     colored_prefix = f"{Fore.YELLOW}SKIP{Style.RESET_ALL}"
-    if any(domain_or_link.endswith(d) for d in BLACK_LIST_FLD):
+    domain = normalize_domain(domain_or_link)
+
+    if domain in BLACK_LIST_RULES:
         return f"[{colored_prefix}] domain '{domain_or_link}' is in blacklist"
 
-    if any(domain_or_link.startswith(d) for d in BLACK_LIST_PREFISES):
+    if domain.startswith(BLACK_LIST_PREFISES_TUPLE):
         return f"[{colored_prefix}] domain '{domain_or_link}' has a prefix " \
                f"blacklisted"
 
-    if domain_or_link in BLACK_LIST_DOMAINS:
-        return f"[{colored_prefix}] domain '{domain_or_link}' is in blacklist"
-
     return None
 
 